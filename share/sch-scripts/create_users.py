@@ -5,12 +5,86 @@
 
 import datetime
 import gi
-from gi.repository import Gtk
+from gi.repository import Gtk, GObject
 
 import config
+import homes
 import libuser
 gi.require_version('Gtk', '3.0')
 
+# How many of the colliding usernames to show in the tooltip
+MAX_COLLISIONS = 10
+
+
+class BatchModel(GObject.Object, Gtk.TreeModel):
+    """A list model that computes the rows of a libuser.Batch when they're shown.
+
+    The iters keep the row index + 1 in user_data, as it can't be NULL.
+    """
+
+    def __init__(self, batch):
+        super(BatchModel, self).__init__()
+        self.batch = batch
+        self.last = (None, None)
+
+    def make_iter(self, index):
+        if 0 <= index < len(self.batch):
+            itr = Gtk.TreeIter()
+            itr.user_data = index + 1
+            return True, itr
+        return False, None
+
+    def row(self, itr):
+        """Return the row of itr, remembering the last one for its other columns."""
+        index = itr.user_data - 1
+        if self.last[0] != index:
+            self.last = (index, self.batch.row(index))
+        return self.last[1]
+
+    def do_get_flags(self):
+        return Gtk.TreeModelFlags.LIST_ONLY | Gtk.TreeModelFlags.ITERS_PERSIST
+
+    def do_get_n_columns(self):
+        return 4
+
+    def do_get_column_type(self, _column):
+        return GObject.TYPE_STRING
+
+    def do_get_iter(self, path):
+        indices = path.get_indices()
+        if len(indices) != 1:
+            return False, None
+        return self.make_iter(indices[0])
+
+    def do_get_path(self, itr):
+        return Gtk.TreePath((itr.user_data - 1,))
+
+    def do_get_value(self, itr, column):
+        return self.row(itr)[column]
+
+    def do_iter_next(self, itr):
+        return self.make_iter(itr.user_data)
+
+    def do_iter_previous(self, itr):
+        return self.make_iter(itr.user_data - 2)
+
+    def do_iter_children(self, parent):
+        return self.do_iter_nth_child(parent, 0)
+
+    def do_iter_has_child(self, _itr):
+        return False
+
+    def do_iter_n_children(self, itr):
+        return len(self.batch) if itr is None else 0
+
+    def do_iter_nth_child(self, parent, num):
+        if parent is not None:
+            return False, None
+        return self.make_iter(num)
+
+    def do_iter_parent(self, _child):
+        return False, None
+
 
 class NewUsersDialog:
     """Create users dialog."""
@@ -24,7 +98,7 @@ class NewUsersDialog:
         self.glade.connect_signals(self)
         self.dialog = self.glade.get_object('create_users_dialog')
         self.user_tree = self.glade.get_object('user_treeview')
-        self.user_store = self.glade.get_object('user_liststore')
+        self.batch = None
         self.classes = None
         self.computers = None
         self.username_tmpl = None
@@ -39,12 +113,23 @@ class NewUsersDialog:
             if group in self.system.groups:
                 self.groups.append(group)
         self.glade.get_object('groups_template_entry').set_text("{c} "+" ".join(self.groups))
+        self.dialog.connect('destroy', self.on_dialog_destroy)
         self.dialog.show()
 
     def on_template_changed(self, _widget=None):
-        """Check the validity of characters in the classes entry and in the username entry."""
+        """Check the classes and the username template when the typing pauses."""
+        classes_str = self.glade.get_object('classes_entry').get_text().strip()
+        computers = self.glade.get_object('computers_number_spin').get_value_as_int()
+        username_tmpl = self.glade.get_object('username_template_entry').get_text()
+        self.glade.get_object('button_apply').set_sensitive(False)
+        self.system.validator.submit(self, 'template', 'template',
+                                     (username_tmpl, classes_str, computers),
+                                     self.on_template_checked)
+
+    def on_template_checked(self, result):
+        """Show the validity of the templates and the preview of the users."""
+        classes_valid, username_valid, collisions = result
         classes_str = self.glade.get_object('classes_entry').get_text().strip()
-        self.classes = classes_str.split()
         self.computers = self.glade.get_object('computers_number_spin').\
             get_value_as_int()
         self.username_tmpl = self.glade.get_object('username_template_entry').\
@@ -55,55 +140,40 @@ class NewUsersDialog:
             get_text()
 
         button_apply = self.glade.get_object('button_apply')
-
-        # Check the validity of characters in the classes entry#FIXME: libuser
         classes_validity_image = self.glade.get_object('classes_validity_image')
-        if not (classes_str.replace(' ', '') + 'foo').isalnum():
+        username_validity_image = self.glade.get_object(
+            'username_validity_image')
+        username_validity_image.set_tooltip_text("")
+        if not classes_valid:
             classes_validity_image.set_from_stock(Gtk.STOCK_DIALOG_ERROR,
                                                   Gtk.IconSize.SMALL_TOOLBAR)
-            button_apply.set_sensitive(False)
             return
-        else:
-            if self.classes == []:
-                self.classes = ['']
-            classes_validity_image.set_from_stock(Gtk.STOCK_OK,
-                                                  Gtk.IconSize.SMALL_TOOLBAR)
-            button_apply.set_sensitive(True)
-
-        # Check the validity of characters in the username entry #FIXME: libuser
-        username_validity_image = self.glade.get_object(
-            'username_validity_image')
-        if (not self.username_tmpl.replace('{c}', 'a').replace('{0i}',
-                                                               'a').replace('{i}', 'a').replace('-', '').replace('_', '').isalnum()) or \
-          (len(self.classes) == 1 and self.computers > 1 and not '{i}' in self.username_tmpl and \
-          not '{0i}' in self.username_tmpl) or (self.computers == 1 and len(self.classes) > 1 and \
-          not '{c}' in self.username_tmpl) or (self.computers > 1 and len(self.classes) > 1 and \
-          (not '{c}' in self.username_tmpl or (not '{0i}' in self.username_tmpl and \
-          not '{i}' in self.username_tmpl))):
-
+        classes_validity_image.set_from_stock(Gtk.STOCK_OK,
+                                              Gtk.IconSize.SMALL_TOOLBAR)
+        if not username_valid:
             username_validity_image.set_from_stock(Gtk.STOCK_DIALOG_ERROR,
                                                    Gtk.IconSize.SMALL_TOOLBAR)
-            button_apply.set_sensitive(False)
             return
+
+        self.batch = libuser.Batch(classes_str.split(), self.computers, self.username_tmpl,
+                                   self.name_tmpl, self.password_tmpl)
+        self.classes = self.batch.classes
+        self.user_tree.set_model(BatchModel(self.batch))
+        if collisions:
+            username_validity_image.set_from_stock(Gtk.STOCK_DIALOG_ERROR,
+                                                   Gtk.IconSize.SMALL_TOOLBAR)
+            names = ', '.join(collisions[:MAX_COLLISIONS])
+            if len(collisions) > MAX_COLLISIONS:
+                names += '...'
+            username_validity_image.set_tooltip_text(
+                "Υπάρχουν ήδη %d από αυτά τα ονόματα: %s" % (len(collisions), names))
         else:
             username_validity_image.set_from_stock(Gtk.STOCK_OK,
                                                    Gtk.IconSize.SMALL_TOOLBAR)
             button_apply.set_sensitive(True)
-        self.user_store.clear()
-
-        # Repopulate the store
-        for classn in self.classes:
-            for compn in range(1, self.computers+1):
-                if len(self.user_store) == 300:
-                    break
-                evaluate_user_template = lambda x: x.replace('{c}', classn.strip()).replace('{i}',
-                                                                         str(compn)).replace('{0i}', '%02d' %compn)
-                self.user_store.append([evaluate_user_template(self.username_tmpl), evaluate_user_template(self.name_tmpl),
-                                        '/home/'+evaluate_user_template(self.username_tmpl), evaluate_user_template(self.password_tmpl)])
-
-        users_number = self.computers * len(self.classes)
+
         self.glade.get_object('users_number_label').set_text(
-            'Θα δημιουργηθούν οι παρακάτω %d λογαριασμοί' %users_number)
+            'Θα δημιουργηθούν οι παρακάτω %d λογαριασμοί' %len(self.batch))
 
     def on_button_apply_clicked(self, _widget):
         """On click apply changes.
@@ -121,7 +191,7 @@ class NewUsersDialog:
         progress_dialog.set_transient_for(self.dialog)
         progress_dialog.show()
         progressbar = self.glade.get_object('users_progressbar')
-        total_users = self.computers * len(self.classes)
+        total_users = len(self.batch)
         total_groups = len(self.classes)
         users_created = 0
         groups_created = 0
@@ -167,48 +237,69 @@ class NewUsersDialog:
                     self.oneself.add([classn])
 
 
-        # And finally, create the users
-        cmd_error = str()
-        for classn in self.classes:
-            for compn in range(1, self.computers+1):
-                while Gtk.events_pending():
-                    Gtk.main_iteration()
-                progressbar.set_text('Δημιουργία χρήστη %d από %d...'
-                                     %(users_created+1, total_users))
-
-                evaluate_user_template = lambda x: x.replace('{c}', classn.strip()).replace('{i}',
-                                                                         str(compn)).replace('{0i}', '%02d'%compn)
-                epoch = datetime.datetime.utcfromtimestamp(0)
-                uname = evaluate_user_template(self.username_tmpl)
-                tmp_uid = self.system.get_free_uid(exclude=set_uids)
-                set_uids.append(tmp_uid)
-                tmp_gid = self.system.get_free_gid(exclude=set_gids)
-                tmp_password = evaluate_user_template(self.password_tmpl)
-                # Create the UPG
-                grp = libuser.Group(uname, tmp_gid)
-                self.system.add_group(grp)
-                usr = libuser.User(name=uname, uid=tmp_uid,
-                                   gid=tmp_gid, rname=evaluate_user_template(self.name_tmpl),
-                                   directory=('/home/'+evaluate_user_template(self.username_tmpl)),
-                                   lstchg=(datetime.datetime.today() - epoch).days,
-                                   groups=[classn],
-                                   password=self.system.encrypt(tmp_password))
-                self.system.add_user(usr)
-                self.system.load()
-                users_created += 1
-                progressbar.set_fraction(float(users_created) / float(total_users))
-
-        #TODO expect returned value from add_user
-        if False and cmd_error != "":
-            self.glade.get_object('error_label').set_text(cmd_error.strip())
-            self.glade.get_object('error_hbox').show()
-            button_close.set_sensitive(True)
-            return
+        # And finally, create the users; their homes are created afterwards
+        epoch = datetime.datetime.utcfromtimestamp(0)
+        user_homes = []
+        for index in range(len(self.batch)):
+            while Gtk.events_pending():
+                Gtk.main_iteration()
+            progressbar.set_text('Δημιουργία χρήστη %d από %d...'
+                                 %(users_created+1, total_users))
+
+            classn = self.batch.at(index)[0]
+            uname, rname, directory, tmp_password = self.batch.row(index)
+            tmp_uid = self.system.get_free_uid(exclude=set_uids)
+            set_uids.append(tmp_uid)
+            tmp_gid = self.system.get_free_gid(exclude=set_gids)
+            set_gids.append(tmp_gid)
+            # Create the UPG
+            grp = libuser.Group(uname, tmp_gid)
+            self.system.add_group(grp)
+            usr = libuser.User(name=uname, uid=tmp_uid,
+                               gid=tmp_gid, rname=rname,
+                               directory=directory,
+                               lstchg=(datetime.datetime.today() - epoch).days,
+                               groups=[classn],
+                               password=self.system.encrypt(tmp_password))
+            self.system.add_user(usr, create_home=False)
+            user_homes.append((directory, tmp_uid, tmp_gid))
+            users_created += 1
+            progressbar.set_fraction(float(users_created) / float(total_users))
+
+        # Copy the skeleton to the homes in the background
+        progressbar.set_text('Δημιουργία αρχικών καταλόγων...')
+        progressbar.set_fraction(0)
+        provisioner = homes.Provisioner(user_homes, progress=self.on_homes_progress)
+        dfr = provisioner.start()
+        dfr.addCallback(self.on_homes_created)
+        dfr.addErrback(self.on_homes_failed)
 
+    def on_homes_progress(self, done, total):
+        progressbar = self.glade.get_object('users_progressbar')
+        progressbar.set_text('Δημιουργία αρχικών καταλόγων %d από %d...' % (done, total))
+        progressbar.set_fraction(float(done) / float(total))
+
+    def on_homes_created(self, errors):
+        """Show the homes that failed and make the Close button sensitive."""
+        if errors:
+            self.glade.get_object('error_label').set_text('\n'.join(
+                '%s: %s' % (path, error) for path, error in errors))
+            self.glade.get_object('error_hbox').show()
         # Display a success message and make the Close button sensitive
         #TODO self.glade.get_object('success_hbox').show()
-        progressbar.set_text("Η διαδικασία ολοκληρώθηκε.")
-        button_close.set_sensitive(True)
+        self.glade.get_object('users_progressbar').set_text("Η διαδικασία ολοκληρώθηκε.")
+        self.glade.get_object('button_close').set_sensitive(True)
+
+    def on_homes_failed(self, fail):
+        """Show why the homes couldn't be created and make Close sensitive."""
+        self.glade.get_object('error_label').set_text(
+            "Αδυναμία δημιουργίας των αρχικών καταλόγων: %s" % fail.getErrorMessage())
+        self.glade.get_object('error_hbox').show()
+        self.glade.get_object('users_progressbar').set_text("Η διαδικασία απέτυχε.")
+        self.glade.get_object('button_close').set_sensitive(True)
+
+    def on_dialog_destroy(self, _widget):
+        self.system.validator.cancel(self)
 
     def on_prog_button_close_clicked(self, _widget):
         """Close the dialog before the process is completed."""
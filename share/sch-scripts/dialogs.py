@@ -86,3 +86,34 @@ class ErrorDialog(Gtk.MessageDialog):
         response = self.run()
         self.destroy()
         return response
+
+class ProgressDialog(Gtk.MessageDialog):
+    """A message dialog with a progress bar, for background operations.
+
+    If on_cancel is set, a Cancel button calls it.
+    """
+
+    def __init__(self, message, title="", on_cancel=None):
+        super(ProgressDialog, self).__init__(type=Gtk.MessageType.INFO,
+                                             buttons=Gtk.ButtonsType.NONE,
+                                             message_format=message)
+        self.set_title(title)
+        self.on_cancel = on_cancel
+        self.progressbar = Gtk.ProgressBar(show_text=True)
+        self.get_message_area().pack_start(self.progressbar, False, False, 12)
+        if on_cancel is not None:
+            self.add_button(Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL)
+        self.connect('response', self.on_response)
+        self.connect('delete-event', lambda _widget, _event: True)
+        self.show_all()
+
+    def set_progress(self, done, total):
+        """Show that done out of total steps are completed."""
+        self.progressbar.set_fraction(float(done) / total if total else 1)
+        self.progressbar.set_text("%d / %d" % (done, total))
+
+    def on_response(self, _widget, response):
+        if response == Gtk.ResponseType.CANCEL and self.on_cancel is not None:
+            self.set_response_sensitive(Gtk.ResponseType.CANCEL, False)
+            self.progressbar.set_text("Ακύρωση...")
+            self.on_cancel()
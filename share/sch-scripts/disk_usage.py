@@ -0,0 +1,363 @@
+# This file is part of sch-scripts, https://launchpad.net/sch-scripts
+# Copyright 2009-2018 the sch-scripts team, see AUTHORS.
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""Incremental disk usage of the shared folders and the homes."""
+
+import os
+import pickle
+import stat
+import sys
+import time
+from twisted.internet import inotify
+from twisted.python import filepath
+import libuser
+
+CACHE = '/var/cache/sch-scripts/disk-usage.pickle'
+CACHE_VERSION = 1
+# Seconds to wait for more inotify events before rescanning the dirty dirs
+REFRESH_DELAY = 5
+# Seconds between the refreshes that rescan the dirs with a new mtime, e.g.
+# the unwatched ones where entries were created or removed
+REFRESH_INTERVAL = 600
+# Seconds between the refreshes that list all the dirs again, to catch the
+# files that were written in the unwatched ones
+FULL_REFRESH_INTERVAL = 3600
+# At most that many directories are watched; the rest rely on the periodic
+# refreshes
+MAX_WATCHES = 8192
+
+
+def format_size(size):
+    """Return size in bytes as a short human readable string, e.g. 1,5 GB."""
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = 'TB'
+    if unit == 'B':
+        return '%d %s' % (size, unit)
+    return ('%.1f %s' % (size, unit)).replace('.', ',')
+
+
+class DirUsage:
+    """The mtime, the size of the files and the subdirs of a directory."""
+    __slots__ = ('mtime', 'files', 'subdirs', 'total')
+
+    def __init__(self, mtime, files, subdirs):
+        self.mtime = mtime
+        self.files = files
+        self.subdirs = subdirs
+        self.total = files
+
+    def __getstate__(self):
+        return (self.mtime, self.files, self.subdirs, self.total)
+
+    def __setstate__(self, state):
+        self.mtime, self.files, self.subdirs, self.total = state
+
+
+class DiskUsage:
+    """The totals of the directories under some roots, updated incrementally.
+
+    A directory is listed again only if its mtime changed, i.e. if entries
+    were created, removed or renamed in it, or if it was marked dirty, e.g.
+    by inotify because a file in it was written. The rest cost one lstat.
+    Sizes are allocated blocks, like du; a file with n hardlinks counts 1/n
+    in each of them, so that it's counted once when all of them are indexed.
+    Mount points under the roots are skipped, like du -x.
+    """
+
+    def __init__(self, cache=CACHE):
+        self.cache = cache
+        self.dirs = {}
+        self.roots = {}
+        # The directories to list again and whether to list all, in update()
+        self.dirty = set()
+        self.full = False
+        if cache:
+            self.load()
+
+    def load(self):
+        """Read the index that the previous run saved, if it's usable."""
+        if os.geteuid() != 0:
+            return
+        try:
+            with open(self.cache, 'rb') as _file:
+                # It's unpickled as root
+                status = os.fstat(_file.fileno())
+                if status.st_uid != 0 or status.st_mode & 0o022:
+                    return
+                version, roots, dirs = pickle.load(_file)
+        except Exception:
+            return
+        if version == CACHE_VERSION:
+            self.roots, self.dirs = roots, dirs
+
+    def save(self):
+        """Save the index for the next run."""
+        if not self.cache or os.geteuid() != 0:
+            return
+        tmp = self.cache + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.cache), mode=0o700, exist_ok=True)
+            with open(tmp, 'wb') as _file:
+                os.fchmod(_file.fileno(), 0o600)
+                pickle.dump((CACHE_VERSION, self.roots, self.dirs), _file, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, self.cache)
+        except (OSError, pickle.PicklingError) as exc:
+            sys.stderr.write("Αδυναμία αποθήκευσης του %s: %s\n" % (self.cache, exc))
+
+    def update(self, roots, dirty=(), full=False):
+        """Rescan what changed under roots and return {root: total bytes}.
+
+        dirty are directories to list again even if their mtime is the same;
+        full lists all of them again.
+        """
+        self.dirty = set(dirty)
+        self.full = full
+        totals = {}
+        for root in roots:
+            try:
+                dev = os.lstat(root).st_dev
+            except OSError:
+                self.roots.pop(root, None)
+                self.forget(root)
+                continue
+            totals[root] = self.roots[root] = self.scan(root, dev)
+        self.save()
+        return totals
+
+    def prune(self, roots):
+        """Remove the roots that aren't in roots from the index."""
+        for root in set(self.roots) - set(roots):
+            del self.roots[root]
+            self.forget(root)
+
+    def scan(self, path, dev):
+        """Update the entry of path and its subdirs, return its total."""
+        try:
+            status = os.lstat(path)
+        except OSError:
+            status = None
+        if status is None or not stat.S_ISDIR(status.st_mode) or status.st_dev != dev:
+            self.forget(path)
+            return 0
+        entry = self.dirs.get(path)
+        mtime = status.st_mtime_ns
+        if self.full or entry is None or entry.mtime != mtime or path in self.dirty:
+            files = status.st_blocks * 512
+            subdirs = []
+            try:
+                with os.scandir(path) as entries:
+                    for dentry in entries:
+                        try:
+                            if dentry.is_dir(follow_symlinks=False):
+                                subdirs.append(dentry.name)
+                            else:
+                                status = dentry.stat(follow_symlinks=False)
+                                files += status.st_blocks * 512 // status.st_nlink
+                        except OSError:
+                            pass
+            except OSError:
+                pass
+            if entry is not None:
+                for name in set(entry.subdirs) - set(subdirs):
+                    self.forget(os.path.join(path, name))
+            entry = DirUsage(mtime, files, subdirs)
+            self.dirs[path] = entry
+        total = entry.files
+        for name in entry.subdirs:
+            total += self.scan(os.path.join(path, name), dev)
+        entry.total = total
+        return total
+
+    def forget(self, path):
+        """Remove path and its subdirs from the index."""
+        entry = self.dirs.pop(path, None)
+        if entry is not None:
+            for name in entry.subdirs:
+                self.forget(os.path.join(path, name))
+
+    def total(self, path):
+        """Return the total bytes under path, or None if it's not indexed."""
+        entry = self.dirs.get(path)
+        if entry is None:
+            return None
+        return entry.total
+
+
+def share_dir(system, group, share_root):
+    """Return the shared folder of group, or None if it doesn't have one."""
+    if group not in system.share_groups:
+        return None
+    return os.path.join(share_root, group)
+
+
+def home_dirs(system):
+    """Return the homes of the normal users that are under HOME_PREFIX."""
+    prefix = os.path.join(libuser.HOME_PREFIX, '')
+    return [user.directory for user in system.users.values()
+            if not user.is_system_user() and user.directory
+            and user.directory.startswith(prefix)]
+
+
+def group_dirs(system, share_root):
+    """Return the directories that the groups view needs the totals of."""
+    shares = [share_dir(system, group, share_root) for group in system.groups]
+    return sorted(set(path for path in shares if path) | set(home_dirs(system)))
+
+
+def group_usage(system, totals, share_root):
+    """Return {group: (shared folder bytes, members' homes bytes)}.
+
+    The members are the secondary ones and the users of the primary group.
+    """
+    usage = {}
+    for group in system.groups.values():
+        names = set(group.members) | system.primary.get(group.gid, set())
+        homes = set(system.users[name].directory for name in names if name in system.users)
+        share = share_dir(system, group.name, share_root)
+        usage[group.name] = (totals.get(share, 0) if share else 0,
+                             sum(totals.get(home, 0) for home in homes))
+    return usage
+
+
+class Monitor:
+    """Keep a DiskUsage of the shares and the homes current, for the GUI.
+
+    The directories are watched with inotify, and the ones with events are
+    marked dirty and rescanned after REFRESH_DELAY, in a thread. Every
+    REFRESH_INTERVAL the dirs with a new mtime are rescanned too, and every
+    FULL_REFRESH_INTERVAL all of them, since files written in place don't
+    change the mtime of their dir and the watches are limited.
+    callback(totals) is called in the reactor thread after each refresh.
+    """
+
+    def __init__(self, system, share_root, callback, usage=None):
+        self.system = system
+        self.share_root = share_root
+        self.callback = callback
+        self.usage = usage
+        self.dirty = set()
+        self.watched = set()
+        self.running = False
+        self.pending = False
+        self.full = False
+        self.last_full = time.monotonic()
+        self.call = None
+        self.loop = None
+        self.notifier = None
+
+    def start(self):
+        """Load the index and start the first refresh."""
+        # Imported here so that importing disk_usage doesn't install a reactor
+        from twisted.internet import reactor
+        try:
+            self.notifier = inotify.INotify()
+            self.notifier.startReading()
+        except inotify.INotifyError:
+            self.notifier = None
+        self.refresh()
+        self.loop = reactor.callLater(REFRESH_INTERVAL, self.on_interval)
+
+    def on_interval(self):
+        from twisted.internet import reactor
+        full = time.monotonic() - self.last_full >= FULL_REFRESH_INTERVAL
+        if full:
+            self.last_full = time.monotonic()
+        self.refresh(full)
+        self.loop = reactor.callLater(REFRESH_INTERVAL, self.on_interval)
+
+    def refresh(self, full=False):
+        """Rescan the dirty dirs and the ones with a new mtime, in a thread.
+
+        full lists all the dirs again; if a refresh is running, it's done
+        in the next one.
+        """
+        from twisted.internet import threads
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+        self.full = self.full or full
+        if self.running:
+            self.pending = True
+            return
+        self.running = True
+        dirty, self.dirty = self.dirty, set()
+        full, self.full = self.full, False
+        dirs = group_dirs(self.system, self.share_root)
+        dfr = threads.deferToThread(self.update, dirs, dirty, full)
+        dfr.addCallback(self.on_refreshed)
+        dfr.addErrback(self.on_refresh_failed)
+
+    def update(self, dirs, dirty, full=False):
+        """Run in a thread; the first time it also reads the index."""
+        if self.usage is None:
+            self.usage = DiskUsage()
+        self.usage.prune(dirs)
+        return self.usage.update(dirs, dirty, full)
+
+    def on_refreshed(self, totals):
+        self.running = False
+        self.update_watches()
+        self.callback(group_usage(self.system, totals, self.share_root))
+        if self.pending:
+            self.pending = False
+            self.refresh()
+
+    def on_refresh_failed(self, fail):
+        self.running = False
+        fail.printTraceback()
+
+    def update_watches(self):
+        """Watch the directories of the index, up to MAX_WATCHES of them."""
+        if self.notifier is None:
+            return
+        dirs = self.usage.dirs
+        for path in [path for path in self.watched if path not in dirs]:
+            self.unwatch(path)
+        mask = inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_MOVED_FROM \
+            | inotify.IN_MOVED_TO | inotify.IN_CLOSE_WRITE
+        # Not IN_DELETE_SELF, which makes twisted close the notifier
+        for path in dirs:
+            if len(self.watched) >= MAX_WATCHES:
+                break
+            if path in self.watched:
+                continue
+            try:
+                self.notifier.watch(filepath.FilePath(path), mask,
+                                    callbacks=[self.on_dir_changed])
+            except inotify.INotifyError:
+                # Probably fs.inotify.max_user_watches; the periodic
+                # refreshes cover the rest
+                break
+            self.watched.add(path)
+
+    def unwatch(self, path):
+        self.watched.discard(path)
+        try:
+            self.notifier.ignore(filepath.FilePath(path))
+        except KeyError:
+            pass
+
+    def on_dir_changed(self, _ignored, path, mask):
+        """Mark the directory of the event dirty and schedule a refresh."""
+        from twisted.internet import reactor
+        path = os.fsdecode(path.path)
+        if mask & inotify.IN_IGNORED:
+            # The kernel dropped the watch, e.g. the directory was removed
+            if path in self.watched:
+                self.unwatch(path)
+            return
+        self.dirty.add(os.path.dirname(path))
+        if self.call is None:
+            self.call = reactor.callLater(REFRESH_DELAY, self.refresh)
+
+    def stop(self):
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        if self.loop is not None and self.loop.active():
+            self.loop.cancel()
+        if self.notifier is not None:
+            self.notifier.loseConnection()
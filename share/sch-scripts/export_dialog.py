@@ -9,10 +9,9 @@ import parsers
 import common
 
 class ExportDialog:
-    """Choose a filename and export the attributes of a user."""
+    """Choose a filename and a format and export the attributes of a user."""
 
     def __init__(self, system, users):
-        self.csv = parsers.CSV()
         chooser = Gtk.FileChooserDialog(title="Επιλέξτε όνομα αρχείου για εξαγωγή",
                                         action=Gtk.FileChooserAction.SAVE,
                                         buttons=(Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
@@ -21,20 +20,49 @@ class ExportDialog:
         chooser.set_icon_from_file('/usr/share/pixmaps/sch-scripts.svg')
         chooser.set_default_response(Gtk.ResponseType.OK)
         chooser.set_do_overwrite_confirmation(True)
+        self.filters = {}
+        for title, ext, parser in parsers.EXPORTERS:
+            file_filter = Gtk.FileFilter()
+            file_filter.set_name(title)
+            # The passwd, shadow and group files are written in a folder
+            file_filter.add_pattern('*%s' % ext if ext else '*')
+            chooser.add_filter(file_filter)
+            self.filters[file_filter] = (ext, parser)
         homepath = os.path.expanduser('~')
         chooser.set_current_folder(homepath)
-        filename = 'users_%s_%s.csv' % (os.uname()[1], common.date())
+        filename = 'users_%s_%s' % (os.uname()[1], common.date())
         i = 1
-        while os.path.isfile(os.path.join(homepath, filename)):
-            filename = 'users_%s_%s.%d.csv' % (os.uname()[1], common.date(), i)
+        while os.path.exists(os.path.join(homepath, filename + '.csv')):
+            filename = 'users_%s_%s.%d' % (os.uname()[1], common.date(), i)
             i += 1
-        chooser.set_current_name(filename)
+        chooser.set_current_name(filename + '.csv')
+        chooser.connect('notify::filter', self.on_chooser_filter_changed)
         resp = chooser.run()
         if resp == Gtk.ResponseType.OK:
             filename = chooser.get_filename()
-            if filename[-4:] != '.csv':
-                filename += '.csv'
-            self.csv.write(filename, system, users)
-            os.chown(filename, int(os.environ['SUDO_UID']), int(os.environ['SUDO_GID']))
+            ext, parser = self.filters[chooser.get_filter()]
+            # A .gz name writes a compressed file
+            if ext and not filename.endswith((ext, ext + '.gz')):
+                filename += ext
+            parser().write(filename, system, users)
+            self.chown(filename, int(os.environ['SUDO_UID']), int(os.environ['SUDO_GID']))
 
         chooser.destroy()
+
+    def on_chooser_filter_changed(self, chooser, _param):
+        """Replace the extension of the file name with the one of the format."""
+        name = chooser.get_current_name()
+        for ext, _parser in self.filters.values():
+            if ext and name.endswith(ext):
+                name = name[:-len(ext)]
+                break
+        ext = self.filters[chooser.get_filter()][0]
+        chooser.set_current_name(name + ext)
+
+    @classmethod
+    def chown(cls, path, uid, gid):
+        """Give the exported file, or folder and its files, to the sudo user."""
+        os.chown(path, uid, gid)
+        if os.path.isdir(path):
+            for name in os.listdir(path):
+                os.chown(os.path.join(path, name), uid, gid)
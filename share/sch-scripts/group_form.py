@@ -48,6 +48,8 @@ class GroupForm(object):
                 activatable = True
             self.users_store.append([user_obj, False, user, activatable])
 
+        self.dialog.connect('destroy', self.on_dialog_destroy)
+
     def on_show_sys_users_toggled(self, _widget):
         """Show the system users."""
         self.show_sys_users = not self.show_sys_users
@@ -66,34 +68,26 @@ class GroupForm(object):
     def on_name_entry_changed(self, _widget):
         """Edit the name entry for a group.
 
-        Also check if the new entry is availabe and valid.
+        Also check if the new entry is availabe and valid, when the typing pauses.
         """
-        groupname = _widget.get_text()
-        valid_name = self.system.name_is_valid(groupname)
-        free_name = groupname not in self.system.groups
-        if self.mode == 'edit':
-            free_name = free_name or groupname == self.group.name
-
-        if valid_name and free_name:
-            icon = Gtk.STOCK_OK
-        else:
-            icon = Gtk.STOCK_CANCEL
+        own = self.group.name if self.mode == 'edit' else None
+        self.system.validator.submit(self, 'name', 'groupname', _widget.get_text(),
+                                     self.on_name_checked, own)
+        self.set_apply_sensitivity()
+
+    def on_name_checked(self, valid):
+        icon = Gtk.STOCK_OK if valid else Gtk.STOCK_CANCEL
         self.gname_valid_icon.set_from_stock(icon, Gtk.IconSize.BUTTON)
         self.set_apply_sensitivity()
 
     def on_gid_changed(self, _widget):
-        gid = _widget.get_text()
-        try:
-            gid = int(gid)
-        except:
-            self.gid_valid_icon.set_from_stock(Gtk.STOCK_CANCEL, Gtk.IconSize.BUTTON)
-            self.set_apply_sensitivity()
-            return
-
-        if (self.mode == 'edit' and gid == self.group.gid) or self.system.gid_is_free(gid):
-            icon = Gtk.STOCK_OK
-        else:
-            icon = Gtk.STOCK_CANCEL
+        own = self.group.gid if self.mode == 'edit' else None
+        self.system.validator.submit(self, 'gid', 'gid', _widget.get_text(),
+                                     self.on_gid_checked, own)
+        self.set_apply_sensitivity()
+
+    def on_gid_checked(self, valid):
+        icon = Gtk.STOCK_OK if valid else Gtk.STOCK_CANCEL
         self.gid_valid_icon.set_from_stock(icon, Gtk.IconSize.BUTTON)
         self.set_apply_sensitivity()
 
@@ -105,13 +99,17 @@ class GroupForm(object):
         self.users_store[path][1] = not self.users_store[path][1]
 
     def set_apply_sensitivity(self):
-        sen = self.gid_valid_icon.get_stock()[0] == self.gname_valid_icon.get_stock()[0] == Gtk.STOCK_OK
+        sen = not self.system.validator.pending(self) and \
+            self.gid_valid_icon.get_stock()[0] == self.gname_valid_icon.get_stock()[0] == Gtk.STOCK_OK
         self.builder.get_object('apply_button').set_sensitive(sen)
 
     def on_dialog_delete_event(self, _widget, _event):
         """Close the dialog."""
         self.dialog.destroy()
 
+    def on_dialog_destroy(self, _widget):
+        self.system.validator.cancel(self)
+
     def on_cancel_clicked(self, _widget):
         """Cancel the dialog."""
         self.dialog.destroy()
@@ -191,12 +189,8 @@ class EditGroupDialog(GroupForm):
         self.group.gid = int(self.gid_entry.get_text())
         self.group.members = {u[0].name : u[0] for u in self.users_store if u[1]}
 
-        self.system.edit_group(old_name, self.group)
-
-        # Remove the group from users that are no more members of this group
-        for user in old_members.values():
-            if user not in self.group.members.values():
-                self.system.remove_user_from_groups(user, [self.group])
+        # This also removes the users that are no more members of this group
+        self.system.edit_group(old_name, self.group, old_members, old_gid)
         if self.shared_state and not self.has_shared.get_active():
             # Shared folders were active but now they are not
             self.oneself.remove([self.group.name])
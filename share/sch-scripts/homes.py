@@ -0,0 +1,209 @@
+# This file is part of sch-scripts, https://launchpad.net/sch-scripts
+# Copyright 2009-2018 the sch-scripts team, see AUTHORS.
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""Home directory provisioning from the skeleton, in worker threads."""
+
+import fcntl
+import hashlib
+import os
+import shutil
+import stat
+from twisted.internet import defer, threads
+
+SKEL = '/etc/skel'
+LOGIN_DEFS = '/etc/login.defs'
+# How many homes each worker thread task creates; progress is reported per batch
+BATCH_SIZE = 16
+# How many batches are copied at the same time
+WORKERS = 4
+# Skeleton files up to this size are kept in memory, once per content hash
+MAX_CACHED_SIZE = 256 * 1024
+# The ioctl that makes a copy-on-write clone of a file, on btrfs, xfs etc
+FICLONE = 0x40049409
+
+
+def home_mode(path=LOGIN_DEFS):
+    """Return the mode of the new homes, from HOME_MODE or UMASK of login.defs."""
+    values = {}
+    try:
+        with open(path) as _file:
+            for line in _file:
+                fields = line.split()
+                if len(fields) == 2 and fields[0] in ('HOME_MODE', 'UMASK'):
+                    values[fields[0]] = int(fields[1], 8)
+    except (OSError, ValueError):
+        pass
+    if 'HOME_MODE' in values:
+        return values['HOME_MODE']
+    return 0o777 & ~values.get('UMASK', 0o022)
+
+
+def clone_file(src, dst_fd):
+    """Copy the src file to dst_fd, as a reflink if the filesystem allows it."""
+    with open(src, 'rb') as src_file:
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_file.fileno())
+            return
+        except OSError:
+            pass
+        with open(dst_fd, 'wb', closefd=False) as dst_file:
+            shutil.copyfileobj(src_file, dst_file, 1024 * 1024)
+
+
+class SkelEntry:
+    """A file, directory or symlink of the skeleton."""
+
+    def __init__(self, path, relpath, lstat):
+        self.path = path
+        self.relpath = relpath
+        self.mode = stat.S_IMODE(lstat.st_mode)
+        self.stamp = (lstat.st_mtime_ns, lstat.st_size, lstat.st_ino)
+        self.size = lstat.st_size
+        self.is_dir = stat.S_ISDIR(lstat.st_mode)
+        self.target = os.readlink(path) if stat.S_ISLNK(lstat.st_mode) else None
+        self.digest = None
+
+
+class Skeleton:
+    """The entries of the skeleton directory, with their contents hashed.
+
+    The small files are kept in memory once per content hash, so copying them
+    to many homes doesn't read them again; the rest are cloned or copied from
+    the skeleton each time. A new Skeleton reuses the hashes and the contents
+    of the unchanged small files of the previous one.
+    """
+
+    def __init__(self, path=SKEL, previous=None):
+        self.path = path
+        self.entries = []
+        self.contents = {}
+        old = {} if previous is None else {entry.relpath: entry for entry in previous.entries}
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for name in dirnames + sorted(filenames):
+                full = os.path.join(dirpath, name)
+                entry = SkelEntry(full, os.path.relpath(full, path), os.lstat(full))
+                self.entries.append(entry)
+                if entry.is_dir or entry.target is not None or entry.size > MAX_CACHED_SIZE:
+                    continue
+                prev = old.get(entry.relpath)
+                if prev is not None and prev.stamp == entry.stamp:
+                    entry.digest = prev.digest
+                    if entry.digest in previous.contents:
+                        self.contents[entry.digest] = previous.contents[entry.digest]
+                    continue
+                self.hash(entry)
+
+    def hash(self, entry):
+        """Hash the small file of entry and keep its contents."""
+        with open(entry.path, 'rb') as _file:
+            data = _file.read()
+        entry.digest = hashlib.sha256(data).hexdigest()
+        self.contents.setdefault(entry.digest, data)
+
+    def copy_to(self, home, uid, gid, mode):
+        """Create home with a copy of the skeleton, owned by uid:gid.
+
+        An existing home is left alone, like useradd -m does. Return True if
+        it was created. If the copy fails, the partial home is removed and the
+        error is raised.
+        """
+        try:
+            os.mkdir(home)
+        except FileExistsError:
+            return False
+        try:
+            os.chown(home, uid, gid)
+            os.chmod(home, mode)
+            for entry in self.entries:
+                dst = os.path.join(home, entry.relpath)
+                if entry.is_dir:
+                    os.mkdir(dst)
+                    os.chown(dst, uid, gid)
+                    os.chmod(dst, entry.mode)
+                elif entry.target is not None:
+                    os.symlink(entry.target, dst)
+                    os.lchown(dst, uid, gid)
+                else:
+                    fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                    try:
+                        data = self.contents.get(entry.digest)
+                        if data is not None:
+                            with open(fd, 'wb', closefd=False) as dst_file:
+                                dst_file.write(data)
+                        else:
+                            clone_file(entry.path, fd)
+                        os.fchown(fd, uid, gid)
+                        os.fchmod(fd, entry.mode)
+                    finally:
+                        os.close(fd)
+        except BaseException:
+            shutil.rmtree(home, ignore_errors=True)
+            raise
+        return True
+
+
+SKELETON = None
+
+def get_skeleton(path=SKEL):
+    """Return the Skeleton of path, rehashing only the files that changed."""
+    global SKELETON
+    if SKELETON is None or SKELETON.path != path:
+        SKELETON = Skeleton(path)
+    else:
+        SKELETON = Skeleton(path, SKELETON)
+    return SKELETON
+
+
+class Provisioner:
+    """Create the homes of new users from the skeleton, in worker threads.
+
+    homes is a list of (path, uid, gid). progress(done, total) is called
+    after each batch. The deferred fires with the list of (path, error)
+    of the homes that failed.
+    """
+
+    def __init__(self, homes, skel=SKEL, progress=None, workers=WORKERS, batch_size=BATCH_SIZE):
+        self.homes = list(homes)
+        self.skel = skel
+        self.progress = progress
+        self.workers = workers
+        self.batch_size = batch_size
+        self.mode = home_mode()
+        self.done = 0
+        self.errors = []
+        self.deferred = None
+
+    def start(self):
+        """Start creating the homes and return the Deferred."""
+        self.deferred = threads.deferToThread(get_skeleton, self.skel)
+        self.deferred.addCallback(self.on_skeleton)
+        return self.deferred
+
+    def on_skeleton(self, skeleton):
+        semaphore = defer.DeferredSemaphore(self.workers)
+        dfrs = []
+        for i in range(0, len(self.homes), self.batch_size):
+            batch = self.homes[i:i+self.batch_size]
+            dfr = semaphore.run(threads.deferToThread, self.copy_batch, skeleton, batch)
+            dfr.addCallback(self.on_batch_copied, batch)
+            dfrs.append(dfr)
+        dfr = defer.DeferredList(dfrs, consumeErrors=True)
+        dfr.addCallback(lambda _result: self.errors)
+        return dfr
+
+    def copy_batch(self, skeleton, batch):
+        """Copy the skeleton to a batch of homes; return their errors."""
+        errors = []
+        for path, uid, gid in batch:
+            try:
+                skeleton.copy_to(path, uid, gid, self.mode)
+            except OSError as exc:
+                errors.append((path, str(exc)))
+        return errors
+
+    def on_batch_copied(self, errors, batch):
+        self.errors.extend(errors)
+        self.done += len(batch)
+        if self.progress is not None:
+            self.progress(self.done, len(self.homes))
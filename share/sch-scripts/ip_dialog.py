@@ -3,23 +3,33 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 """Connection information and creation dialog."""
 
-import re
+import os
 import uuid
-import struct, socket
 from binascii import unhexlify, hexlify
 import dbus
+from dbus.mainloop.glib import DBusGMainLoop
 from gi.repository import Gtk, Gdk, GObject
+from twisted.internet import defer, threads, utils
 import dialogs
 import common
+import ip_scanner
+import ipv4
 import parsers
 
 
 
 ## Define global variables
 
-IP_REG = r"^(([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\.){3}([1-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-4])$"
-BUS = dbus.SystemBus()
+# The signals of the cached NetworkManager model need a main loop
+BUS = dbus.SystemBus(mainloop=DBusGMainLoop())
+IPCONFIG = '/usr/lib/klibc/bin/ipconfig'
 DBUS_SERVICE_NAME = 'org.freedesktop.NetworkManager'
+PROPERTIES_INTERFACE = 'org.freedesktop.DBus.Properties'
+NM_PATH = '/org/freedesktop/NetworkManager'
+NM_INTERFACE = 'org.freedesktop.NetworkManager'
+SETTINGS_PATH = '/org/freedesktop/NetworkManager/Settings'
+SETTINGS_INTERFACE = 'org.freedesktop.NetworkManager.Settings'
+CONNECTION_INTERFACE = 'org.freedesktop.NetworkManager.Settings.Connection'
 MSG_PC_CONFLICT_IP = 'Η διεύθυνση {0} χρησιμοποιείται ήδη από άλλον υπολογιστή. Παρακάλω δώστε μια διαφορετική.'
 MSG_ROUTE_CONFLICT_IP = 'Η διεύθυνση {0} χρησιμοποείται ήδη σαν προεπιλεγμένη διαδρομή. Παρακάλω δώστε μια διαφορετική.'
 MSG_WRONG_REGEX_IP = 'Μη-έγκυρη διεύθυνση IP. θα πρέπει να είναι της μορφής x.y.z.w όπου x, y, z, w παίρνουν τιμές ' \
@@ -41,50 +51,135 @@ MSG_DNSMASQ_RESTART_FAIL_ENABLE = 'Η δημιουργία των συνδέσε
                                   'dnsmasq απέτυχε καθώς οι συνδέσεις δεν ενεργοποιήθηκαν.'
 MSG_DNSMASQ_RESTART_FAIL = 'Η δημιουργία των συνδέσεων έγινε επιτυχώς αλλά η επαναδημιουργία του αρχείου ρυθμίσεων ' \
                            'του dnsmasq απέτυχε.'
+WATCH_TIMEOUT = 30000
 TITLE_ERROR = 'Σφάλμα'
+# Shared by all the dialogs, so that reopening one reuses the cached probes
+SCANNER = ip_scanner.Scanner()
 TITLE_INFO = 'Πληροφορία'
 TITLE_SUCCESS = 'Επιτυχία'
 
-## Define global functions
+## Define Network Manager classes
 
-def string_to_int32(address):
-    """Convert ip to int32."""
-    return struct.unpack("I", socket.inet_aton(address))[0]
+class NetworkManagerModel(object):
+    """A cache of the NetworkManager objects, shared by all the dialog pages.
 
+    The properties of each object are fetched with a single GetAll call and
+    are then kept current by the PropertiesChanged signals, without polling.
+    """
 
-def int32_to_string(num):
-    """Convert int32 to ip."""
-    return socket.inet_ntoa(struct.pack("I", num))
+    def __init__(self):
+        self.proxies = {}
+        self.properties = {}
+        self.settings = {}
+        self.devices = None
+        self.connections = None
+        self.callbacks = []
+        BUS.add_signal_receiver(self.on_state_changed, 'StateChanged', bus_name=DBUS_SERVICE_NAME)
+        BUS.add_signal_receiver(self.on_properties_changed, 'PropertiesChanged', bus_name=DBUS_SERVICE_NAME,
+                                path_keyword='path', interface_keyword='interface')
+        BUS.add_signal_receiver(self.on_devices_changed, 'DeviceAdded', NM_INTERFACE, DBUS_SERVICE_NAME)
+        BUS.add_signal_receiver(self.on_devices_changed, 'DeviceRemoved', NM_INTERFACE, DBUS_SERVICE_NAME)
+        BUS.add_signal_receiver(self.on_connections_changed, 'NewConnection', SETTINGS_INTERFACE,
+                                DBUS_SERVICE_NAME)
+        BUS.add_signal_receiver(self.on_connection_changed, 'Updated', CONNECTION_INTERFACE, DBUS_SERVICE_NAME,
+                                path_keyword='path')
+        BUS.add_signal_receiver(self.on_connection_changed, 'Removed', CONNECTION_INTERFACE, DBUS_SERVICE_NAME,
+                                path_keyword='path')
+
+    def subscribe(self, callback):
+        """Call callback() whenever the state or the properties change."""
+        self.callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self.callbacks:
+            self.callbacks.remove(callback)
+
+    def notify(self):
+        for callback in list(self.callbacks):
+            callback()
+
+    def get_proxy(self, object_path):
+        """Return the proxy of an object, creating it only once."""
+        if object_path not in self.proxies:
+            self.proxies[object_path] = BUS.get_object(DBUS_SERVICE_NAME, object_path)
+        return self.proxies[object_path]
+
+    def get_properties(self, object_path, interface_name):
+        """Return all the properties of an object interface."""
+        key = (object_path, interface_name)
+        if key not in self.properties:
+            self.properties[key] = self.get_proxy(object_path).GetAll(
+                interface_name, dbus_interface=PROPERTIES_INTERFACE)
+        return self.properties[key]
 
+    def get_devices(self):
+        """Return the device paths."""
+        if self.devices is None:
+            self.devices = self.get_proxy(NM_PATH).GetDevices(dbus_interface=NM_INTERFACE)
+        return self.devices
+
+    def get_connections(self):
+        """Return the connection settings paths."""
+        if self.connections is None:
+            self.connections = self.get_proxy(SETTINGS_PATH).ListConnections(dbus_interface=SETTINGS_INTERFACE)
+        return self.connections
+
+    def get_settings(self, object_path):
+        """Return the settings of a connection."""
+        if object_path not in self.settings:
+            self.settings[object_path] = self.get_proxy(object_path).GetSettings(
+                dbus_interface=CONNECTION_INTERFACE)
+        return self.settings[object_path]
+
+    def on_properties_changed(self, *args, path=None, interface=None):
+        """Update the cached properties."""
+        if interface == PROPERTIES_INTERFACE:
+            interface, changed, invalidated = args
+        else:
+            # Older NetworkManager versions emit it on their own interfaces
+            changed, invalidated = args[0], []
+        key = (path, interface)
+        if key not in self.properties:
+            return
+        if invalidated:
+            del self.properties[key]
+        else:
+            self.properties[key].update(changed)
+        self.notify()
 
-def bits_to_subnet(bits):
-    """Convert bits to subnet mask."""
-    try:
-        bits = int(bits)
-        if bits <= 0 or bits > 32:
-            raise Exception
-    except:
-        return "255.255.255.255"
-    num = ((1<<bits)-1)<<(32-bits)
-    return socket.inet_ntoa(struct.pack("!I", num))
+    def on_state_changed(self, *_args):
+        self.notify()
 
+    def on_devices_changed(self, _device_path):
+        self.devices = None
 
-def subnet_to_bits(subnet):
-    """Convert mask to bits."""
-    return sum([bin(int(x)).count('1') for x in subnet.split('.')])
+    def on_connections_changed(self, _object_path):
+        self.connections = None
 
+    def on_connection_changed(self, path=None):
+        self.settings.pop(path, None)
+        self.connections = None
+
+
+MODEL = None
+
+def get_model():
+    """Return the shared NetworkManagerModel."""
+    global MODEL
+    if MODEL is None:
+        MODEL = NetworkManagerModel()
+    return MODEL
 
-## Define Network Manager classes
 
 class NetworkManagerDBus(object):
     """Return NetworkManager DBus."""
 
     def __init__(self, object_path, interface_name):
         """Return NetworkManager DBus."""
-        self.proxy = BUS.get_object(DBUS_SERVICE_NAME, object_path)
+        self.proxy = get_model().get_proxy(object_path)
         self.interface = dbus.Interface(self.proxy, interface_name)
         try:
-            self.properties = self.interface.get_dbus_method('GetAll', dbus_interface='org.freedesktop.DBus.Properties')(interface_name)
+            self.properties = get_model().get_properties(object_path, interface_name)
         except dbus.exceptions.DBusException:
             pass
 
@@ -94,13 +189,13 @@ class NetworkManager(NetworkManagerDBus):
 
     def __init__(self):
         """Return NetworkManager interface from NetworkManager object."""
-        self.object_path = '/org/freedesktop/NetworkManager'
-        self.interface_name = 'org.freedesktop.NetworkManager'
+        self.object_path = NM_PATH
+        self.interface_name = NM_INTERFACE
         super(NetworkManager, self).__init__(self.object_path, self.interface_name)
 
     def get_devices(self):
         """Return Device object."""
-        return self.interface.GetDevices()
+        return get_model().get_devices()
 
     def get_active_connections(self):
         """Return current active connections."""
@@ -192,13 +287,13 @@ class Settings(NetworkManagerDBus):
 
     def __init__(self):
         """Return Settings interface from Settings object."""
-        self.object_path = '/org/freedesktop/NetworkManager/Settings'
-        self.interface_name = 'org.freedesktop.NetworkManager.Settings'
+        self.object_path = SETTINGS_PATH
+        self.interface_name = SETTINGS_INTERFACE
         super(Settings, self).__init__(self.object_path, self.interface_name)
 
     def get_list_connections(self):
         """Return all connection settings (Setting object)."""
-        return self.interface.ListConnections()
+        return get_model().get_connections()
 
 
 class ConnectionSettings(NetworkManagerDBus):
@@ -207,12 +302,12 @@ class ConnectionSettings(NetworkManagerDBus):
     def __init__(self, connection_settings_name):
         """Return Connection interface from Setting/X object."""
         self.object_path = connection_settings_name
-        self.interface_name = 'org.freedesktop.NetworkManager.Settings.Connection'
+        self.interface_name = CONNECTION_INTERFACE
         super(ConnectionSettings, self).__init__(self.object_path, self.interface_name)
 
     def get_settings(self):
         """Return connection settings, eg: ipv4, dns, etc."""
-        return self.interface.GetSettings()
+        return get_model().get_settings(self.object_path)
 
 
 ## Define Information class
@@ -231,7 +326,7 @@ class Info:
     def set_values(self, dict=None):
         """Set info values."""
         if dict:
-            self.ip_add = dict['ipad']
+            self.ip_add = dict['ip']
             self.mask = dict['mask']
             self.route = dict['route']
             self.dnss = dict['dnss']
@@ -246,7 +341,7 @@ class Info:
     def _calculate_subnet(self):
         """Calculate subnet."""
         if self.ip_add:
-            self.subnet = '.'.join(self.ip_add.split('.')[:3]) + '.0'
+            self.subnet = ipv4.network(self.ip_add) if ipv4.is_address(self.ip_add) else None
 
 
 ## Define Interface class
@@ -265,8 +360,8 @@ class Interface:
         self.conflict = None
         self.connection = None
         self.existing_info = None
-        self.dhcp_request_info = None
         self.has_active_connection = False
+        self.dhcp_request_info = Info()
         self._set_ips()
 
     def __getattr__(self, item):
@@ -288,23 +383,34 @@ class Interface:
             ip4config = IP4Config(self.ip4config_path)
             ip_add, mask, route, dnss = ip4config.get_properties()
             self.existing_info.set_values({
-                'ip': int32_to_string(ip_add),
-                'mask': bits_to_subnet(mask),
-                'route': int32_to_string(route),
-                'dnss': [int32_to_string(x) for x in dnss]
+                'ip': ipv4.nm_to_string(ip_add),
+                'mask': ipv4.bits_to_mask(mask),
+                'route': ipv4.nm_to_string(route),
+                'dnss': ipv4.nm_to_strings(dnss)
             })
             self.has_active_connection = True
 
-        self.dhcp_request_info = Info()
-        sample = common.run_command(['/usr/lib/klibc/bin/ipconfig', '-n', '-t2', self.interface], True)
-        while sample.poll() is None:
-            while Gtk.events_pending():
-                Gtk.main_iteration()
-        if sample.returncode == 0:
-            dhcp_parser = parsers.DHCP()
-            dhcp_dict = dhcp_parser.parse(self.interface)
-            self.has_active_connection = True
-            self.dhcp_request_info.set_values(dhcp_dict)
+    def probe_dhcp(self):
+        """Send a DHCP request without configuring the interface.
+
+        Return a Deferred that fires when dhcp_request_info is filled in.
+        """
+        dfr = utils.getProcessValue(IPCONFIG, ['-n', '-t2', self.interface], env=os.environ)
+        dfr.addCallback(self.on_dhcp_probed)
+        return dfr
+
+    def on_dhcp_probed(self, returncode):
+        """Parse the ipconfig results in a thread."""
+        if returncode != 0:
+            return None
+        dfr = threads.deferToThread(parsers.DHCP.parse, self.interface)
+        dfr.addCallback(self.on_dhcp_parsed)
+        return dfr
+
+    def on_dhcp_parsed(self, ipconfig):
+        self.has_active_connection = True
+        if ipconfig is not None:
+            self.dhcp_request_info.set_values(ipconfig.get_values())
 
 
 ## Define Page class
@@ -394,6 +500,8 @@ class IpDialog:
         self.interfaces = []
         self.interfaces_diff_subnet = []
         self.timeout = 0
+        self.watched_interfaces = []
+        self.prefered_hostname = None
         self.settings = None
         self.ts_dns = ['127.0.0.1', '194.63.238.4', '8.8.8.8']
         self.ltsp_ips = dict(ip='192.168.67.1', mask='255.255.255.0', route='0.0.0.0')
@@ -418,7 +526,7 @@ class IpDialog:
 
         # Hide some widget and show loading widget until dhcp request finished
         self.main_dlg_action_area.hide()
-        self.main_dlg_grid.attach(self.loading_box, 0, 1, 2, 1)
+        self.main_dlg_grid.attach(self.loading_box, 0, 2, 2, 1)
         self.main_dlg.show()
 
         GObject.idle_add(self.initialize_interfaces)
@@ -426,10 +534,8 @@ class IpDialog:
     def initialize_interfaces(self):
         """Initialize interfaces.
 
-        Find devices, populate GUI, show all widgets and destroy loading widget,
-        set the appropriate method to each device and
-        if subnet has change alert message,
-        which define devices with different subnet.
+        Find devices and send the DHCP requests of all of them in parallel;
+        each page is added as soon as its own request completes.
         """
         self.settings = Settings()
         device_paths = self.netman.get_devices()
@@ -450,12 +556,34 @@ class IpDialog:
             return
         self.interfaces.sort(key=lambda interface: interface.interface)
 
-        # Populate GUI
+        probes = []
+        for interface in self.interfaces:
+            dfr = interface.probe_dhcp()
+            dfr.addErrback(self.on_dhcp_probe_failed, interface)
+            dfr.addCallback(self.on_dhcp_probe_done, interface)
+            probes.append(dfr)
+        defer.DeferredList(probes).addCallback(self.on_interfaces_initialized)
+
+    def on_dhcp_probe_failed(self, fail, interface):
+        print("Σφάλμα κατά το DHCP request της %s:" % interface.interface)
+        print(fail.getErrorMessage())
+
+    def on_dhcp_probe_done(self, _result, interface):
+        """Populate the page of an interface."""
+        self.populate_pages(interface)
+
+    def on_interfaces_initialized(self, _results):
+        """All the DHCP requests completed.
+
+        Show all widgets and destroy loading widget,
+        set the appropriate method to each device and
+        if subnet has change alert message,
+        which define devices with different subnet.
+        """
         for interface in self.interfaces:
             if interface.dhcp_request_info.subnet and interface.existing_info.subnet and \
                             interface.dhcp_request_info.subnet != interface.existing_info.subnet:
                 self.interfaces_diff_subnet.append(interface)
-            self.populate_pages(interface)
 
         # Show all widgets and destroy loading widget. Dialog is ready
         self.main_dlg.set_deletable(True)
@@ -479,19 +607,27 @@ class IpDialog:
             info_dialog.showup()
 
     def populate_pages(self, interface):
+        # The pages are added as the DHCP requests complete; keep them sorted
+        position = len([l_interface for l_interface in self.interfaces
+                        if l_interface.page is not None and l_interface.interface < interface.interface])
         page = Page()
         interface.page = page
         page.ip_entry.connect('changed', self.on_ip_entry_changed, interface)
         page.method_entry.connect('changed', self.on_method_entry_changed, interface)
         page.fill_entries(interface, **interface.existing_info.get_values(dnss=True))
+        for l_interface in self.interfaces:
+            if l_interface.page is not None and l_interface.page.method_entry.get_active() == 3:
+                page.method_entry.get_model()[3][1] = False
         if Gdk.Screen.get_default().get_height() <= 768:
             scrolledwindow = Gtk.ScrolledWindow()
             scrolledwindow.add_with_viewport(page.grid)
             scrolledwindow.show()
-            self.main_dlg_notebook.append_page(scrolledwindow, Gtk.Label('Ethernet (%s)' % interface.interface))
+            self.main_dlg_notebook.insert_page(scrolledwindow, Gtk.Label('Ethernet (%s)' % interface.interface),
+                                               position)
             self.main_dlg_notebook.set_tab_reorderable(scrolledwindow, True)
         else:
-            self.main_dlg_notebook.append_page(page.grid, Gtk.Label('Ethernet (%s)' % interface.interface))
+            self.main_dlg_notebook.insert_page(page.grid, Gtk.Label('Ethernet (%s)' % interface.interface),
+                                               position)
             self.main_dlg_notebook.set_tab_reorderable(page.grid, True)
 
     def set_default(self):
@@ -515,77 +651,106 @@ class IpDialog:
         self.main_dlg_notebook.set_current_page(0)
 
     def watch_nm(self, interest_interfaces, prefered_hostname):
-        self.timeout += 1000
-        break_bool = True
-        for interface in interest_interfaces:
-            if interface.carrier != 1:
-                continue
-            #TODO: Change it (do not create new instances)
-            device = Device(interface.device_path)
-            ip4config_path, interface, _driver, _device_type, _managed = device.get_properties()
+        """Wait until all the connected interfaces get an IPv4 config.
+
+        The NetworkManager signals are watched instead of polling; after
+        WATCH_TIMEOUT msec the dnsmasq configuration isn't regenerated.
+        """
+        self.watched_interfaces = [interface for interface in interest_interfaces if interface.carrier == 1]
+        self.prefered_hostname = prefered_hostname
+        self.timeout = GObject.timeout_add(WATCH_TIMEOUT, self.on_watch_nm_timeout)
+        get_model().subscribe(self.on_nm_changed)
+        self.on_nm_changed()
+
+    def stop_watch_nm(self):
+        get_model().unsubscribe(self.on_nm_changed)
+        GObject.source_remove(self.timeout)
+        self.timeout = 0
+
+    def on_nm_changed(self):
+        """Regenerate the dnsmasq configuration when all the IPv4 configs are there."""
+        if not self.timeout:
+            return
+        for interface in self.watched_interfaces:
+            ip4config_path = Device(interface.device_path).get_properties()[0]
             if ip4config_path == '/':
-                break_bool = False
-
-        if break_bool:
-            sample = common.run_command(['sh', '-c', 'ltsp-config dnsmasq --enable-dns --overwrite'], True)
-            while sample.poll() is None:
-                while Gtk.events_pending():
-                    Gtk.main_iteration()
-
-            if sample.returncode == 0:
-                msg = MSG_DNSMASQ_RESTART_SUCCESS
-                if prefered_hostname:
-                    msg = MSG_SUGGEST_HOSTNAME.format(prefered_hostname) + msg
-
-                success_dialog = dialogs.InfoDialog(MSG_TITLE_CONNECTIONS_CREATE, TITLE_SUCCESS)
-                success_dialog.format_secondary_markup(msg)
-                success_dialog.set_transient_for(self.main_dlg)
-                success_dialog.showup()
-                self.main_dlg.destroy()
-            else:
-                error_dialog = dialogs.ErrorDialog(MSG_TITLE_DNSMASQ_RESTART_FAIL, TITLE_ERROR)
-                error_dialog.format_secondary_markup(MSG_DNSMASQ_RESTART_FAIL)
-                error_dialog.set_transient_for(self.main_dlg)
-                error_dialog.showup()
-                self.main_dlg.destroy()
-            return False
-        elif not break_bool and self.timeout == 30000:
-            msg = MSG_DNSMASQ_RESTART_FAIL_ENABLE
-            if prefered_hostname:
-                msg = MSG_SUGGEST_HOSTNAME.format(prefered_hostname) + msg
+                return
+        self.stop_watch_nm()
+        dfr = utils.getProcessValue('sh', ['-c', 'ltsp-config dnsmasq --enable-dns --overwrite'], env=os.environ)
+        dfr.addErrback(lambda _fail: 1)
+        dfr.addCallback(self.on_dnsmasq_configured)
+
+    def on_dnsmasq_configured(self, returncode):
+        if returncode == 0:
+            msg = MSG_DNSMASQ_RESTART_SUCCESS
+            if self.prefered_hostname:
+                msg = MSG_SUGGEST_HOSTNAME.format(self.prefered_hostname) + msg
 
             success_dialog = dialogs.InfoDialog(MSG_TITLE_CONNECTIONS_CREATE, TITLE_SUCCESS)
             success_dialog.format_secondary_markup(msg)
             success_dialog.set_transient_for(self.main_dlg)
             success_dialog.showup()
             self.main_dlg.destroy()
-            return False
-        return True
+        else:
+            error_dialog = dialogs.ErrorDialog(MSG_TITLE_DNSMASQ_RESTART_FAIL, TITLE_ERROR)
+            error_dialog.format_secondary_markup(MSG_DNSMASQ_RESTART_FAIL)
+            error_dialog.set_transient_for(self.main_dlg)
+            error_dialog.showup()
+            self.main_dlg.destroy()
+
+    def on_watch_nm_timeout(self):
+        self.timeout = 0
+        get_model().unsubscribe(self.on_nm_changed)
+        msg = MSG_DNSMASQ_RESTART_FAIL_ENABLE
+        if self.prefered_hostname:
+            msg = MSG_SUGGEST_HOSTNAME.format(self.prefered_hostname) + msg
+
+        success_dialog = dialogs.InfoDialog(MSG_TITLE_CONNECTIONS_CREATE, TITLE_SUCCESS)
+        success_dialog.format_secondary_markup(msg)
+        success_dialog.set_transient_for(self.main_dlg)
+        success_dialog.showup()
+        self.main_dlg.destroy()
+        return False
 
     def create_update_connections(self, interest_interfaces, prefered_hostname, dnsmasq_via_carrier,
                                   dnsmasq_via_autoconnect):
+        # Test if the static ips exist in the network, all of them concurrently.
+        # Case which doesn't work: User had set .10 manual and .10 is owned by another pc,
+        # arping always fail so we can't catch the conflict.
+        candidates = []
+        if self.netman.get_active_connections():
+            for interface in interest_interfaces:
+                if interface.page.method_entry.get_active() == 2 and interface.carrier == 1:
+                    test_ip = interface.page.ip_entry.get_text()
+                    if test_ip != interface.existing_info.ip_add:
+                        candidates.append((interface.interface, test_ip))
+        # Probe again before saving, as a cached "free" may be stale by now
+        for interface, _address in candidates:
+            SCANNER.forget(interface)
+        dfr = SCANNER.scan(candidates)
+        dfr.addCallback(self.on_conflicts_scanned, interest_interfaces, prefered_hostname, dnsmasq_via_carrier,
+                        dnsmasq_via_autoconnect)
+        dfr.addErrback(self.on_conflicts_scan_failed)
+
+    def on_conflicts_scan_failed(self, fail):
+        print(fail.getErrorMessage())
+        self.main_dlg.set_sensitive(True)
+
+    def on_conflicts_scanned(self, conflicts, interest_interfaces, prefered_hostname, dnsmasq_via_carrier,
+                             dnsmasq_via_autoconnect):
+        conflicts = dict(conflicts)
         for interface in interest_interfaces:
-            # Test if static ip exists in network
-            # Case which doesn't work: User had set .10 manual and .10 is owned by another pc,
-            # arping always fail so we can't catch the conflict.
-            if interface.page.method_entry.get_active() == 2 and \
-                            interface.carrier == 1 and self.netman.get_active_connections():
-                test_ip = interface.page.ip_entry.get_text()
-                if test_ip != interface.existing_info.ip_add:
-                    sample = common.run_command(['arping', '-f', '-w1', '-I', interface.interface, test_ip], True)
-                    while sample.poll() is None:
-                        while Gtk.events_pending():
-                            Gtk.main_iteration()
-                    if sample.returncode == 0:
-                        interface.page.ip_entry.set_icon_from_stock(1, Gtk.STOCK_DIALOG_WARNING)
-                        interface.page.ip_entry.set_icon_tooltip_text(1, MSG_PC_CONFLICT_IP.format(test_ip))
-                        title = MSG_PC_CONFLICT_IP.format(test_ip)
-                        err_dialog = dialogs.ErrorDialog(title, TITLE_ERROR)
-                        err_dialog.set_transient_for(self.main_dlg)
-                        if err_dialog.showup() != Gtk.ResponseType.OK:
-                            self.main_dlg.set_sensitive(True)
-                            self.main_dlg.show()
-                            return
+            if interface.interface in conflicts:
+                test_ip = conflicts[interface.interface]
+                interface.page.ip_entry.set_icon_from_stock(1, Gtk.STOCK_DIALOG_WARNING)
+                interface.page.ip_entry.set_icon_tooltip_text(1, MSG_PC_CONFLICT_IP.format(test_ip))
+                title = MSG_PC_CONFLICT_IP.format(test_ip)
+                err_dialog = dialogs.ErrorDialog(title, TITLE_ERROR)
+                err_dialog.set_transient_for(self.main_dlg)
+                if err_dialog.showup() != Gtk.ResponseType.OK:
+                    self.main_dlg.set_sensitive(True)
+                    self.main_dlg.show()
+                    return
 
             if interface.conflict is not None:
                 interface.conflict.interface.Update(interface.connection)
@@ -602,7 +767,7 @@ class IpDialog:
                 connection_settings.interface.Update(settings)
 
         if dnsmasq_via_carrier and dnsmasq_via_autoconnect:
-            GObject.timeout_add(1000, self.watch_nm, interest_interfaces, prefered_hostname)
+            self.watch_nm(interest_interfaces, prefered_hostname)
         else:
             success_dialog = dialogs.InfoDialog(MSG_TITLE_CONNECTIONS_CREATE, TITLE_SUCCESS)
             success_dialog.set_transient_for(self.main_dlg)
@@ -617,7 +782,7 @@ class IpDialog:
                 continue
             ip_add = interface.page.ip_entry.get_text()
             method = interface.page.method_entry.get_active()
-            if not re.match(IP_REG, ip_add) and ip_add != 'Δεν βρέθηκε διεύθυνση':
+            if not ipv4.is_host(ip_add) and ip_add != 'Δεν βρέθηκε διεύθυνση':
                 check_ip = False
             if method != 4:
                 check_method = True
@@ -630,13 +795,15 @@ class IpDialog:
 
     def on_method_entry_changed(self, _method_entry, interface):
         """Callbacks."""
+        # While the DHCP requests are running some pages may not exist yet
+        pages_interfaces = [l_interface for l_interface in self.interfaces if l_interface.page is not None]
         reset_ltsp_method = True
-        for l_interface in self.interfaces:
+        for l_interface in pages_interfaces:
             if l_interface.page.method_entry.get_active() == 3:
                 reset_ltsp_method = False
 
         if reset_ltsp_method and len(self.interfaces) >= 2:
-            for l_interface in self.interfaces:
+            for l_interface in pages_interfaces:
                 l_interface.page.method_entry.get_model()[3][1] = True
 
         # Auto. We want always to show the dhcp request values
@@ -653,6 +820,7 @@ class IpDialog:
         # Manual
         elif interface.page.method_entry.get_active() == 2:
             ip_add = None
+            suggested = False
             interface.page.ip_entry.set_sensitive(True)
             interface.page.auto_checkbutton.set_sensitive(True)
             connection_settings_paths = self.settings.get_list_connections()
@@ -660,14 +828,15 @@ class IpDialog:
             if interface.ip_add.startswith('10.'):
                 if interface.existing_info.subnet and interface.dhcp_request_info.subnet and \
                                 interface.existing_info.subnet != interface.dhcp_request_info.subnet:
-                    ip_add = '.'.join(interface.ip_add.split('.')[0:3])+'.10'
+                    ip_add = ipv4.host(interface.ip_add, 10)
+                    suggested = True
                 elif self.netman.get_active_connections():
                     # if ip starts with 10. and we have active connections
                     for counter, connection_settings_path in enumerate(connection_settings_paths):
-                        connection_settings = ConnectionSettings(connection_settings_path)
-                        connection_settings_id = connection_settings.get_settings()['connection']['id']
+                        settings = ConnectionSettings(connection_settings_path).get_settings()
+                        connection_settings_id = settings['connection']['id']
                         try:
-                            connection_settings_method = connection_settings.get_settings()['ipv4']['method']
+                            connection_settings_method = settings['ipv4']['method']
                         except KeyError:
                             connection_settings_method = None
 
@@ -677,17 +846,21 @@ class IpDialog:
                             ip_add = interface.existing_info.ip_add
                             break
                         elif counter == len(connection_settings_paths) - 1:
-                            ip_add = '.'.join(interface.ip_add.split('.')[0:3])+'.10'
+                            ip_add = ipv4.host(interface.ip_add, 10)
+                            suggested = True
                 else:
                     # if ip starts with 10. and we don't have active connections load instant .10
-                    ip_add = '.'.join(interface.ip_add.split('.')[0:3])+'.10'
+                    ip_add = ipv4.host(interface.ip_add, 10)
+                    suggested = True
             interface.page.fill_entries(interface, ip_add=ip_add, dnss=[dns for dns in self.ts_dns])
+            if suggested and interface.carrier == 1:
+                self.suggest_ip(interface, ip_add)
         # Ltsp
         elif interface.page.method_entry.get_active() == 3:
             interface.page.ip_entry.set_sensitive(False)
             interface.page.auto_checkbutton.set_sensitive(True)
             interface.page.fill_entries(interface, dnss=[dns for dns in self.ts_dns], **self.ltsp_ips)
-            for l_interface in self.interfaces:
+            for l_interface in pages_interfaces:
                 if l_interface != interface:
                     l_interface.page.method_entry.get_model()[3][1] = False
         # No creation
@@ -697,12 +870,24 @@ class IpDialog:
             interface.page.fill_entries(interface, **interface.existing_info.get_values(dnss=True))
         self.check_button()
 
+    def suggest_ip(self, interface, ip_add):
+        """Sweep the subnet of ip_add for a free address, in the background."""
+        dfr = SCANNER.suggest(interface.interface, ip_add.rpartition('.')[0] + '.')
+        dfr.addCallback(self.on_ip_suggested, interface, ip_add)
+        dfr.addErrback(lambda fail: print(fail.getErrorMessage()))
+
+    def on_ip_suggested(self, free_ip, interface, ip_add):
+        """Replace the suggested ip_add, unless the user already changed it."""
+        if free_ip and free_ip != ip_add and interface.page.method_entry.get_active() == 2 and \
+                interface.page.ip_entry.get_text() == ip_add:
+            interface.page.ip_entry.set_text(free_ip)
+
     def on_ip_entry_changed(self, _ip_entry, interface):
         """Callbacks."""
         if interface.page.ip_entry.get_text() != 'Δεν βρέθηκε διεύθυνση':
             ip_add = interface.page.ip_entry.get_text()
             sub_ip = '.'.join(interface.ip_add.split('.')[0:3])+'.'
-            if not re.match(IP_REG, ip_add):
+            if not ipv4.is_host(ip_add):
                 interface.page.ip_entry.set_position(-1)
                 if ip_add != interface.page.route_entry.get_text():
                     interface.page.ip_entry.set_text(sub_ip)
@@ -739,18 +924,16 @@ class IpDialog:
 
             connection = dbus.Dictionary({'type': '802-3-ethernet', 'uuid': str(uuid.uuid4()), 'id': interface.iden})
 
-            dns = dbus.Array([dbus.UInt32(string_to_int32(self.ts_dns[0])),
-                              dbus.UInt32(string_to_int32(self.ts_dns[1])),
-                              dbus.UInt32(string_to_int32(self.ts_dns[2]))],
+            dns = dbus.Array([dbus.UInt32(num) for num in ipv4.strings_to_nm(self.ts_dns)],
                              signature=dbus.Signature('u'))
 
             ipv6 = dbus.Dictionary({'method': 'ignore'})
 
             try:
                 # This variables is used only in 2 and 3 method
-                ip_add = string_to_int32(interface.page.ip_entry.get_text().strip())
-                subnet = subnet_to_bits(interface.page.subnet_entry.get_text().strip())
-                route = string_to_int32(interface.page.route_entry.get_text().strip())
+                ip_add = ipv4.string_to_nm(interface.page.ip_entry.get_text().strip())
+                subnet = ipv4.mask_to_bits(interface.page.subnet_entry.get_text().strip())
+                route = ipv4.string_to_nm(interface.page.route_entry.get_text().strip())
 
                 addresses = dbus.Array([dbus.UInt32(ip_add),
                                         dbus.UInt32(subnet),
@@ -774,11 +957,11 @@ class IpDialog:
                                         'dhcp-send-hostname': dbus.Boolean('false'),
                                         'addresses': dbus.Array([addresses], signature=dbus.Signature('au'))})
 
-                if int32_to_string(ip_add).startswith('10.') and \
-                        (int32_to_string(ip_add).endswith('.10') or int32_to_string(ip_add).endswith('.11')) and \
+                ip_string = ipv4.nm_to_string(ip_add)
+                if ip_string.startswith('10.') and (ip_string.endswith('.10') or ip_string.endswith('.11')) and \
                         interface.carrier == 1:
                     # Try to resolve the ip and purpose hostname. We keep info if dns_search endswith sch.gr
-                    found, hostname = common.run_command(['dig', '@nic.sch.gr', '+short', '-x', int32_to_string(ip_add)])
+                    found, hostname = common.run_command(['dig', '@nic.sch.gr', '+short', '-x', ip_string])
                     if found:
                         hostname = hostname.split('\n')[0].strip('.')
                         dns_search = '.'.join(hostname.split('.')[1:])
@@ -0,0 +1,108 @@
+# This file is part of sch-scripts, https://launchpad.net/sch-scripts
+# Copyright 2009-2018 the sch-scripts team, see AUTHORS.
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""Concurrent IP address conflict scanner."""
+
+import os
+import time
+from twisted.internet import defer, utils
+
+# Seconds to remember if an address is used
+CACHE_TTL = 60
+# How many probes may run at the same time
+MAX_PROBES = 32
+# The hosts of a /24 subnet to try when suggesting a static address
+SUGGEST_HOSTS = range(10, 255)
+
+
+class ARPingProber:
+    """Probe addresses with arping."""
+
+    def probe(self, interface, address):
+        """Return a Deferred that fires with True if a host owns address."""
+        dfr = utils.getProcessValue('arping', ['-f', '-w1', '-I', interface, address], env=os.environ)
+        dfr.addCallback(lambda returncode: returncode == 0)
+        return dfr
+
+
+class FakeProber:
+    """Answer from a set of used (interface, address) pairs, without a network."""
+
+    def __init__(self, used=()):
+        self.used = set(used)
+        self.probes = []
+
+    def probe(self, interface, address):
+        self.probes.append((interface, address))
+        return defer.succeed((interface, address) in self.used)
+
+
+class Scanner:
+    """Probe addresses concurrently, caching the results per interface."""
+
+    def __init__(self, prober=None, ttl=CACHE_TTL, max_probes=MAX_PROBES):
+        self.prober = prober or ARPingProber()
+        self.ttl = ttl
+        self.max_probes = max_probes
+        self.semaphore = defer.DeferredSemaphore(max_probes)
+        # {interface: {address: (used, timestamp)}}
+        self.cache = {}
+
+    def cached(self, interface, address):
+        """Return the cached probe result, or None if there's none or it expired."""
+        result = self.cache.get(interface, {}).get(address)
+        if result is not None and time.time() - result[1] < self.ttl:
+            return result[0]
+        return None
+
+    def forget(self, interface=None):
+        """Drop the cached results of an interface, or of all of them."""
+        if interface is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(interface, None)
+
+    def probe(self, interface, address):
+        """Return a Deferred that fires with True if address is used on interface."""
+        used = self.cached(interface, address)
+        if used is not None:
+            return defer.succeed(used)
+        dfr = self.semaphore.run(self.prober.probe, interface, address)
+        dfr.addCallback(self.on_probed, interface, address)
+        return dfr
+
+    def on_probed(self, used, interface, address):
+        self.cache.setdefault(interface, {})[address] = (used, time.time())
+        return used
+
+    def scan(self, candidates):
+        """Probe (interface, address) pairs concurrently.
+
+        Return a Deferred that fires with the list of the used pairs.
+        """
+        candidates = list(candidates)
+        dfr = defer.gatherResults([self.probe(interface, address) for interface, address in candidates],
+                                  consumeErrors=True)
+        dfr.addCallback(lambda results: [pair for pair, used in zip(candidates, results) if used])
+        return dfr
+
+    def suggest(self, interface, prefix, hosts=SUGGEST_HOSTS):
+        """Sweep a subnet for a free address, e.g. prefix='10.160.31.'.
+
+        The hosts are probed in order, max_probes at a time. Return a
+        Deferred that fires with the first free address, or None.
+        """
+        hosts = list(hosts)
+        batch = ['%s%d' % (prefix, host) for host in hosts[:self.max_probes]]
+        if not batch:
+            return defer.succeed(None)
+        dfr = self.scan((interface, address) for address in batch)
+        dfr.addCallback(self.on_suggest_batch, interface, prefix, hosts[len(batch):], batch)
+        return dfr
+
+    def on_suggest_batch(self, used, interface, prefix, hosts, batch):
+        used = set(address for _interface, address in used)
+        for address in batch:
+            if address not in used:
+                return address
+        return self.suggest(interface, prefix, hosts)
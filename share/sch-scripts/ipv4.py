@@ -0,0 +1,95 @@
+# This file is part of sch-scripts, https://launchpad.net/sch-scripts
+# Copyright 2009-2018 the sch-scripts team, see AUTHORS.
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""IPv4 address validation and network math."""
+
+import re
+import socket
+import struct
+
+OCTET = r"([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])"
+# Any dotted quad address, e.g. 0.0.0.0 or 255.255.255.0
+ADDRESS_RE = re.compile(r"^(%s\.){3}%s$" % (OCTET, OCTET))
+# A host address, x.y.z.w where w is between 1 and 254
+HOST_RE = re.compile(r"^(%s\.){3}([1-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-4])$" % OCTET)
+# NetworkManager passes the addresses as uint32s with the bytes in network
+# order, i.e. unpacked in the native byte order
+NM_STRUCT = struct.Struct("=I")
+NET_STRUCT = struct.Struct("!I")
+ALL_ONES = 0xffffffff
+
+
+def is_address(address):
+    """Return True if address is a dotted quad."""
+    return ADDRESS_RE.match(address) is not None
+
+
+def is_host(address):
+    """Return True if address is a valid host address."""
+    return HOST_RE.match(address) is not None
+
+
+def to_int(address):
+    """Convert a dotted quad to an integer, e.g. 0.0.1.2 => 258."""
+    return NET_STRUCT.unpack(socket.inet_aton(address))[0]
+
+
+def to_string(num):
+    """Convert an integer to a dotted quad, e.g. 258 => 0.0.1.2."""
+    return socket.inet_ntoa(NET_STRUCT.pack(num))
+
+
+def string_to_nm(address):
+    """Convert a dotted quad to a NetworkManager uint32."""
+    return NM_STRUCT.unpack(socket.inet_aton(address))[0]
+
+
+def nm_to_string(num):
+    """Convert a NetworkManager uint32 to a dotted quad."""
+    return socket.inet_ntoa(NM_STRUCT.pack(num))
+
+
+def strings_to_nm(addresses):
+    """Convert a list of dotted quads to NetworkManager uint32s."""
+    packed = b''.join(socket.inet_aton(address) for address in addresses)
+    return list(struct.unpack("=%dI" % len(addresses), packed))
+
+
+def nm_to_strings(nums):
+    """Convert a list of NetworkManager uint32s to dotted quads."""
+    packed = struct.pack("=%dI" % len(nums), *nums)
+    return [socket.inet_ntoa(packed[i:i+4]) for i in range(0, len(packed), 4)]
+
+
+def bits_to_int(bits):
+    """Return the integer netmask of a prefix length."""
+    return (ALL_ONES << (32 - bits)) & ALL_ONES
+
+
+def bits_to_mask(bits):
+    """Convert a prefix length to a netmask, e.g. 24 => 255.255.255.0.
+
+    Invalid prefix lengths return 255.255.255.255.
+    """
+    try:
+        bits = int(bits)
+    except (TypeError, ValueError):
+        bits = 0
+    if bits <= 0 or bits > 32:
+        bits = 32
+    return to_string(bits_to_int(bits))
+
+
+def mask_to_bits(mask):
+    """Convert a netmask to a prefix length, e.g. 255.255.255.0 => 24."""
+    return bin(to_int(mask)).count('1')
+
+
+def network(address, bits=24):
+    """Return the network address of address, e.g. 10.0.0.5 => 10.0.0.0."""
+    return to_string(to_int(address) & bits_to_int(bits))
+
+
+def host(address, num, bits=24):
+    """Return the num host of the network of address, e.g. 10.0.0.5, 10 => 10.0.0.10."""
+    return to_string((to_int(address) & bits_to_int(bits)) | num)
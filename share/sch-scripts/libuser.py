@@ -7,14 +7,21 @@
 import pwd
 import os
 import spwd
+import stat
 import grp
 import operator
+import pickle
 import subprocess
 import re
 import crypt
+import ctypes
 import random
-from twisted.internet import inotify
-from twisted.python import filepath
+import shutil
+import sys
+import tarfile
+import time
+from twisted.internet import defer, inotify
+from twisted.python import failure, filepath
 import common
 import iso843
 
@@ -32,7 +39,34 @@ LAST_UID = 29999
 FIRST_GID = 1000
 LAST_GID = 29999
 NAME_REGEX = "^[a-z][-a-z0-9_]*$"
+# The placeholders of the batch creation templates: class, number, 2-digit number
+TEMPLATE_RE = re.compile(r"(\{c\}|\{i\}|\{0i\})")
+TEMPLATE_FIELDS = {'{c}': '{0}', '{i}': '{1:d}', '{0i}': '{1:02d}'}
 HOME_PREFIX = "/home"
+# Seconds to wait for a burst of /etc/group and /etc/shadow changes to end
+EVENT_WINDOW = 1
+# A root-only cache of the parsed users and groups, valid while the files
+# that it was read from have the same mtime, inode and size
+SNAPSHOT = '/var/cache/sch-scripts/accounts.pickle'
+SNAPSHOT_FILES = ('/etc/passwd', '/etc/shadow', '/etc/group')
+# Increase it when the User or Group attributes change
+SNAPSHOT_VERSION = 1
+# Seconds to wait for the typing in a form field to pause before validating it
+VALIDATE_DELAY = 0.3
+# Seconds that the home directory checks are cached, as homes may be created
+# or removed on disk without a change in the account databases
+HOME_CACHE_TTL = 2
+# How many home directories to process at the same time
+HOME_WORKERS = 4
+# Where the homes of the deleted users are archived, if asked to
+HOMES_ARCHIVE = '/var/backups/sch-scripts'
+MAIL_SPOOL = '/var/mail'
+# The account databases that delete_accounts rewrites, and the field of the
+# members and, for gshadow, of the administrators of each group
+PASSWD = '/etc/passwd'
+GROUP = '/etc/group'
+PASSWD_FILES = (PASSWD, '/etc/shadow', '/etc/subuid', '/etc/subgid')
+GROUP_FILES = {GROUP: (3,), '/etc/gshadow': (2, 3)}
 
 USER_FIELDS = ['Όνομα χρήστη', 'UID', 'Κύρια ομάδα', 'Ονοματεπώνυμο', 'Γραφείο',
                'Τηλ. γραφείου', 'Τηλ. οικίας', 'Άλλο', 'Κατάλογος', 'Κέλυφος', 'Ομάδες',
@@ -85,8 +119,8 @@ class User:
         """
         path = os.path.join(base, self.name)
         if os.isdir(path):
-            stat = os.stat(path)
-            return [stat.st_uid, stat.st_gid]
+            status = os.stat(path)
+            return [status.st_uid, status.st_gid]
         return None
 
 
@@ -109,20 +143,54 @@ class Group:
         return self.is_user_group() and self.name in self.members and len(self.members) == 1
 
 
-# TODO: Change implementation, don't use dicts since they have to be updated
-#       when the user/group_object.name changes. python sets would be good.
 class Set(object):
-    """A set of User and Group objects."""
+    """A set of User and Group objects.
+
+    Besides the users and groups dicts by name, it indexes the group names
+    of each user (member_of) and the user names of each primary gid
+    (primary), so that adding, removing and renaming costs as much as the
+    memberships of the changed object. Code that edits the dicts or the
+    Group.members directly should call reindex() afterwards.
+    """
 
     def __init__(self, users=None, groups=None):
         self.users = {} if users is None else users
         self.groups = {} if groups is None else groups
+        self.member_of = {}
+        self.primary = {}
+        self.reindex()
+
+    def replace(self, users, groups):
+        """Swap in new users and groups dicts, with their index built aside."""
+        member_of, primary = self.build_index(users, groups)
+        self.users, self.groups = users, groups
+        self.member_of, self.primary = member_of, primary
+
+    def reindex(self):
+        self.member_of, self.primary = self.build_index(self.users, self.groups)
+
+    @classmethod
+    def build_index(cls, users, groups):
+        """Return the (member_of, primary) index of users and groups."""
+        member_of = {name: set() for name in users}
+        primary = {}
+        for group in groups.values():
+            for name in group.members:
+                member_of.setdefault(name, set()).add(group.name)
+        for user in users.values():
+            # The users of parsed files may not have a gid yet
+            if user.gid is not None:
+                primary.setdefault(user.gid, set()).add(user.name)
+        return member_of, primary
 
     def add_user(self, user):
         """Add a new User object in the Set."""
         if user.name in self.users:
             raise ValueError("User '%s' exists" % user.name)
         self.users[user.name] = user
+        self.member_of.setdefault(user.name, set())
+        if user.gid is not None:
+            self.primary.setdefault(user.gid, set()).add(user.name)
 
     def remove_user(self, user):
         """Remove a User object from the Set.
@@ -130,15 +198,32 @@ class Set(object):
         This will also remove the user from the Group objects and remove from
         the Set the private Group of this user, if he had one.
         """
-        for group in user.groups:
-            if group in self.groups:
-                grup = self.groups[group]
-                if grup.is_private() and grup.name == user.name:
-                    del self.groups[grup.name]
-                else:
-                    del grup.members[user.name]
+        names = self.member_of.pop(user.name, set()) | set(user.groups)
+        for name in names:
+            grup = self.groups.get(name)
+            if grup is None:
+                continue
+            if grup.is_private() and grup.name == user.name:
+                del self.groups[grup.name]
+            else:
+                grup.members.pop(user.name, None)
+        self.primary.get(user.gid, set()).discard(user.name)
         del self.users[user.name]
 
+    def add_member(self, user, group):
+        """Make a User of the Set a member of a Group of the Set."""
+        group.members[user.name] = user
+        if group.name not in user.groups:
+            user.groups.append(group.name)
+        self.member_of.setdefault(user.name, set()).add(group.name)
+
+    def remove_member(self, user, group):
+        """Remove a User from the members of a Group."""
+        group.members.pop(user.name, None)
+        if group.name in user.groups:
+            user.groups.remove(group.name)
+        self.member_of.get(user.name, set()).discard(group.name)
+
     def add_group(self, group):
         """Add a new Group object in the Set.
 
@@ -152,25 +237,74 @@ class Set(object):
             raise ValueError("Group '%s' exists" % group.name)
         self.groups[group.name] = group
 
-        for user_obj in group.members.values():
+        for user_obj in list(group.members.values()):
             if user_obj.name not in self.users:
                 self.add_user(user_obj)
-            if group.name not in user_obj.groups:
-                user_obj.groups.append(group.name)
+            self.add_member(user_obj, group)
 
     def remove_group(self, group):
         """Remove a Group object from the Set.
 
         This will also remove the group from the User objects and remove from
-        the Set all the Users which have this group as primary.
+        the Set the Users for which it was their only group.
+        """
+        for user_obj in list(group.members.values()):
+            if user_obj.groups == [group.name] and user_obj.name in self.users:
+                self.remove_user(user_obj)
+            else:
+                self.remove_member(user_obj, group)
+        # It's already removed if it was the private group of a removed user
+        self.groups.pop(group.name, None)
+
+    def remove_class(self, group):
+        """Remove a Group, all of its members and their private groups.
+
+        Return the list of the removed User objects.
         """
-        for user_obj in self.users.values():
-            if group.name in user_obj.groups:
-                if len(user_obj.groups) == 1:
-                    del self.users[user_obj.name]
-                else:
-                    user_obj.groups.remove(group.name)
-        del self.groups[group.name]
+        removed = list(group.members.values())
+        for user_obj in removed:
+            self.remove_user(user_obj)
+        if group.name in self.groups:
+            self.remove_group(group)
+        return removed
+
+    def rename_user(self, user, new_name):
+        """Rename a User of the Set and its memberships."""
+        if new_name in self.users:
+            raise ValueError("User '%s' exists" % new_name)
+        old_name = user.name
+        del self.users[old_name]
+        user.name = new_name
+        self.users[new_name] = user
+        names = self.member_of.pop(old_name, set())
+        for name in names:
+            members = self.groups[name].members
+            del members[old_name]
+            members[new_name] = user
+        self.member_of[new_name] = names
+        if user.gid is not None:
+            primary = self.primary.setdefault(user.gid, set())
+            primary.discard(old_name)
+            primary.add(new_name)
+
+    def rename_group(self, group, new_name):
+        """Rename a Group of the Set, updating its members and primary users."""
+        if new_name in self.groups:
+            raise ValueError("Group '%s' exists" % new_name)
+        old_name = group.name
+        del self.groups[old_name]
+        group.name = new_name
+        self.groups[new_name] = group
+        for user_obj in group.members.values():
+            if old_name in user_obj.groups:
+                user_obj.groups[user_obj.groups.index(old_name)] = new_name
+            names = self.member_of[user_obj.name]
+            names.discard(old_name)
+            names.add(new_name)
+        for name in self.primary.get(group.gid, ()):
+            user_obj = self.users[name]
+            if user_obj.primary_group == old_name:
+                user_obj.primary_group = new_name
 
     def uid_is_free(self, uid):
         return uid not in [user.uid for user in self.users.values()]
@@ -213,30 +347,701 @@ class Set(object):
         return gid
 
 
+def files_stamp(paths=SNAPSHOT_FILES):
+    """Return the (mtime, inode, size) of each of the account files."""
+    stamp = []
+    for path in paths:
+        status = os.stat(path)
+        stamp.append((status.st_mtime_ns, status.st_ino, status.st_size))
+    return tuple(stamp)
+
+
+def read_snapshot():
+    """Return the (stamp, users, groups) of the snapshot, or None if it's not current."""
+    if os.geteuid() != 0:
+        return None
+    try:
+        with open(SNAPSHOT, 'rb') as _file:
+            # It contains the password hashes and it's unpickled as root
+            status = os.fstat(_file.fileno())
+            if status.st_uid != 0 or status.st_mode & 0o077:
+                return None
+            version, stamp, users, groups = pickle.load(_file)
+        if version != SNAPSHOT_VERSION or stamp != files_stamp():
+            return None
+    except Exception:
+        return None
+    return stamp, users, groups
+
+
+def write_snapshot(stamp, users, groups):
+    """Save the users and groups that were read when the files had stamp."""
+    if os.geteuid() != 0:
+        return
+    tmp = SNAPSHOT + '.tmp'
+    try:
+        os.makedirs(os.path.dirname(SNAPSHOT), mode=0o700, exist_ok=True)
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, 'wb') as _file:
+            pickle.dump((SNAPSHOT_VERSION, stamp, users, groups), _file, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, SNAPSHOT)
+    except (OSError, pickle.PicklingError) as exc:
+        sys.stderr.write("Αδυναμία αποθήκευσης του %s: %s\n" % (SNAPSHOT, exc))
+
+
+class MembershipDiff:
+    """The member names that an edit adds to and removes from a group."""
+
+    def __init__(self, old_members, new_members):
+        old_members = set() if old_members is None else set(old_members)
+        new_members = set(new_members)
+        self.added = sorted(new_members - old_members)
+        self.removed = sorted(old_members - new_members)
+
+    def __bool__(self):
+        return bool(self.added or self.removed)
+
+    def __str__(self):
+        return "+%d -%d μέλη" % (len(self.added), len(self.removed))
+
+
+class Changes:
+    """The names of the users, groups and files that changed."""
+
+    def __init__(self, users=None, groups=None, files=None):
+        self.users = set() if users is None else set(users)
+        self.groups = set() if groups is None else set(groups)
+        self.files = set() if files is None else set(files)
+
+    def __bool__(self):
+        return bool(self.users or self.groups or self.files)
+
+    def __str__(self):
+        return str(self.__dict__)
+
+    def update(self, other):
+        """Merge the other Changes into this one."""
+        self.users |= other.users
+        self.groups |= other.groups
+        self.files |= other.files
+
+
+class Subscriber:
+    """Deliver Changes to func, one call at a time.
+
+    If func returns a Deferred, the changes that arrive until it fires are
+    merged and delivered in a single call afterwards.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.busy = False
+        self.pending = None
+
+    def deliver(self, changes):
+        if self.busy:
+            if self.pending is None:
+                self.pending = Changes()
+            self.pending.update(changes)
+            return
+        self.busy = True
+        dfr = defer.maybeDeferred(self.func, changes)
+        dfr.addErrback(lambda fail: fail.printTraceback())
+        dfr.addBoth(self.on_done)
+
+    def on_done(self, _result):
+        self.busy = False
+        if self.pending is not None:
+            changes, self.pending = self.pending, None
+            self.deliver(changes)
+
+
 class Event:
-    def __init__(self):
+    """Notify the subscribers about Changes.
+
+    Notifications that arrive less than window seconds apart are merged,
+    so each subscriber gets one consolidated call per burst.
+    """
+
+    def __init__(self, window=0):
+        self.window = window
         self.subscribers = []
+        self.pending = None
+        self.timer = None
 
     def connect(self, func):
-        self.subscribers.append(func)
+        self.subscribers.append(Subscriber(func))
 
     def notify(self, arg=None, *_kwargs):
+        if not isinstance(arg, Changes):
+            arg = Changes(files=[] if arg is None else [arg])
+        if self.pending is None:
+            self.pending = Changes()
+        self.pending.update(arg)
+        if not self.window:
+            self.flush()
+        elif self.timer is not None and self.timer.active():
+            self.timer.reset(self.window)
+        else:
+            # Imported here so that importing libuser doesn't install a reactor
+            from twisted.internet import reactor
+            self.timer = reactor.callLater(self.window, self.flush)
+
+    def flush(self):
+        """Deliver the pending changes now."""
+        self.timer = None
+        changes, self.pending = self.pending, None
+        if changes is None:
+            return
         for subscriber in self.subscribers:
-            subscriber(arg)
+            subscriber.deliver(changes)
+
+
+class Template:
+    """A batch creation template, e.g. "{c}-{0i}", compiled once into a formatter."""
+
+    def __init__(self, text):
+        self.text = text
+        parts = TEMPLATE_RE.split(text)
+        fields = parts[1::2]
+        self.has_class = '{c}' in fields
+        self.has_number = '{i}' in fields or '{0i}' in fields
+        # The literal parts are at the even indexes; escape their braces
+        self.expand = ''.join(TEMPLATE_FIELDS[part] if i % 2 else
+                              part.replace('{', '{{').replace('}', '}}')
+                              for i, part in enumerate(parts)).format
+
+
+class Batch:
+    """The users of a batch creation, one for each class and computer number.
+
+    The rows are computed on demand, so a batch of any size costs nothing
+    until it's read.
+    """
+
+    def __init__(self, classes, computers, username, rname='', password=''):
+        self.classes = classes or ['']
+        self.computers = computers
+        self.username = Template(username)
+        self.rname = Template(rname)
+        self.password = Template(password)
+
+    def __len__(self):
+        return len(self.classes) * self.computers
+
+    def at(self, index):
+        """Return the (class, computer number) of the user at index."""
+        return self.classes[index // self.computers], index % self.computers + 1
+
+    def usernames(self):
+        for classn in self.classes:
+            for num in range(1, self.computers + 1):
+                yield self.username.expand(classn, num)
+
+    def row(self, index):
+        """Return the [username, real name, home, password] of the user at index."""
+        classn, num = self.at(index)
+        name = self.username.expand(classn, num)
+        return [name, self.rname.expand(classn, num), os.path.join(HOME_PREFIX, name),
+                self.password.expand(classn, num)]
+
+
+class Validator:
+    """Validate the values of the user and group forms against a System.
+
+    The results are cached until the System loads a new version of the users
+    and groups, except for the homes, which are cached per path for
+    HOME_CACHE_TTL seconds since they may change on disk meanwhile. submit() waits for the edits of a field to pause and then
+    checks only the last value, so the forms don't validate every keystroke.
+    """
+
+    def __init__(self, system, delay=VALIDATE_DELAY):
+        self.system = system
+        self.delay = delay
+        self.version = None
+        self.cache = {}
+        self.homes = {}
+        self.used = {}
+        self.timers = {}
+
+    def refresh(self):
+        """Drop the cached results if the system was reloaded since they were made."""
+        if self.version == self.system.version:
+            return
+        self.version = self.system.version
+        self.cache.clear()
+        self.used = {
+            'username': set(self.system.users),
+            'groupname': set(self.system.groups),
+            'uid': set(user.uid for user in self.system.users.values()),
+            'gid': set(group.gid for group in self.system.groups.values())}
+
+    def check(self, kind, value, own=None):
+        """Return the cached result of check_<kind>(value, own).
+
+        own is the current value of the edited user or group, which doesn't
+        conflict with itself.
+        """
+        self.refresh()
+        if kind == 'home':
+            now = time.monotonic()
+            cached = self.homes.get(value)
+            if cached is None or now - cached[0] > HOME_CACHE_TTL:
+                cached = self.homes[value] = (now, self.check_home(value, own))
+            return cached[1]
+        key = (kind, value, own)
+        if key not in self.cache:
+            self.cache[key] = getattr(self, 'check_' + kind)(value, own)
+        return self.cache[key]
+
+    def check_many(self, kind, values):
+        """Return the values that fail the check or that are given more than once."""
+        seen = set()
+        failed = []
+        for value in values:
+            if value in seen or not self.check(kind, value):
+                failed.append(value)
+            seen.add(value)
+        return failed
+
+    def submit(self, owner, field, kind, value, callback, own=None):
+        """Call callback(check(kind, value, own)) when the edits of field pause.
+
+        A new value for the same owner and field replaces the pending one.
+        """
+        timer = self.timers.get((owner, field))
+        if timer is not None and timer.active():
+            timer.cancel()
+        # Imported here so that importing libuser doesn't install a reactor
+        from twisted.internet import reactor
+        self.timers[(owner, field)] = reactor.callLater(
+            self.delay, self.on_timeout, owner, field, kind, value, callback, own)
+
+    def on_timeout(self, owner, field, kind, value, callback, own):
+        del self.timers[(owner, field)]
+        callback(self.check(kind, value, own))
+
+    def pending(self, owner):
+        """Return True if some of the values of owner haven't been checked yet."""
+        return any(key[0] is owner for key in self.timers)
+
+    def cancel(self, owner):
+        """Forget the pending values of owner, e.g. when its dialog closes."""
+        for key in [key for key in self.timers if key[0] is owner]:
+            timer = self.timers.pop(key)
+            if timer.active():
+                timer.cancel()
+
+    def check_username(self, name, own):
+        return bool(self.system.name_is_valid(name)) \
+            and (name == own or name not in self.used['username'])
+
+    def check_groupname(self, name, own):
+        return bool(self.system.name_is_valid(name)) \
+            and (name == own or name not in self.used['groupname'])
+
+    def check_uid(self, uid, own):
+        try:
+            uid = int(uid)
+        except (TypeError, ValueError):
+            return False
+        return uid == own or uid not in self.used['uid']
+
+    def check_gid(self, gid, own):
+        try:
+            gid = int(gid)
+        except (TypeError, ValueError):
+            return False
+        return gid == own or gid not in self.used['gid']
+
+    @classmethod
+    def check_home(cls, home, _own):
+        """Return the (uid, gid) of the home directory if it exists, or None."""
+        try:
+            home_stat = os.stat(home)
+        except OSError:
+            return None
+        if not stat.S_ISDIR(home_stat.st_mode):
+            return None
+        return home_stat.st_uid, home_stat.st_gid
+
+    def check_template(self, template, _own):
+        """Check the (username template, classes, computers) of a batch creation.
+
+        Return (classes_valid, username_valid, collisions). The username
+        template must have the placeholders that make the names of all the
+        users different; collisions are the generated names that are already
+        used by a user or a group, or that are generated more than once.
+        """
+        username_tmpl, classes_str, computers = template
+        if not (classes_str.replace(' ', '') + 'foo').isalnum():
+            return False, False, []
+        batch = Batch(classes_str.split(), computers, username_tmpl)
+        tmpl = batch.username
+        if not tmpl.expand('a', 1).replace('-', '').replace('_', '').isalnum():
+            return True, False, []
+        if (len(batch.classes) > 1 and not tmpl.has_class) \
+                or (computers > 1 and not tmpl.has_number):
+            return True, False, []
+        seen = set()
+        collisions = []
+        for name in batch.usernames():
+            if not self.system.name_is_valid(name):
+                return True, False, []
+            if name in seen or name in self.used['username'] or name in self.used['groupname']:
+                collisions.append(name)
+            seen.add(name)
+        return True, True, collisions
+
+
+class Cancelled(Exception):
+    """The user cancelled a background operation."""
+
+
+class AccountsLock:
+    """Lock the account databases the way the shadow tools do.
+
+    That's lckpwdf() and a <file>.lock hardlink with the pid in it, for each
+    one of the files, so that useradd, gpasswd etc wait or fail meanwhile.
+    """
+
+    def __init__(self, paths):
+        self.paths = [path for path in paths if os.path.exists(path)]
+        self.locked = []
+        self.libc = None
+
+    def __enter__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        if self.libc.lckpwdf() != 0:
+            raise OSError(ctypes.get_errno(), "lckpwdf: %s" % os.strerror(ctypes.get_errno()))
+        try:
+            for path in self.paths:
+                self.lock(path)
+        except BaseException:
+            self.__exit__()
+            raise
+        return self
+
+    def lock(self, path):
+        tmp = '%s.%d' % (path, os.getpid())
+        lock = path + '.lock'
+        with open(tmp, 'w') as _file:
+            _file.write(str(os.getpid()))
+        try:
+            try:
+                os.link(tmp, lock)
+            except FileExistsError:
+                # Take it over if the process that created it is gone
+                with open(lock) as _file:
+                    pid = int(_file.read().strip() or 0)
+                if pid <= 0 or os.path.exists('/proc/%d' % pid):
+                    raise OSError("%s is locked by process %d" % (path, pid))
+                os.unlink(lock)
+                os.link(tmp, lock)
+        finally:
+            os.unlink(tmp)
+        self.locked.append(lock)
+
+    def __exit__(self, *_args):
+        for lock in self.locked:
+            os.unlink(lock)
+        self.locked = []
+        self.libc.ulckpwdf()
+
+
+def replace_file(path, lines):
+    """Write lines to path through path+, keeping the old contents in path-.
+
+    The owner, the mode and the SELinux label of path are kept. Like the
+    rest of this module, it doesn't handle the tcb shadow layout.
+    """
+    status = os.stat(path)
+    try:
+        label = os.getxattr(path, 'security.selinux')
+    except OSError:
+        label = None
+    for name, data in ((path + '-', None), (path + '+', lines)):
+        if data is None:
+            with open(path) as _file:
+                data = _file.readlines()
+        fd = os.open(name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as _file:
+            os.fchown(fd, status.st_uid, status.st_gid)
+            os.fchmod(fd, stat.S_IMODE(status.st_mode))
+            if label is not None:
+                os.setxattr(fd, 'security.selinux', label)
+            _file.writelines(data)
+            _file.flush()
+            os.fsync(fd)
+    os.rename(path + '+', path)
+
+
+def busy_uids():
+    """Return the uids that have running processes, like userdel checks."""
+    uids = set()
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            uids.add(os.stat('/proc/' + pid).st_uid)
+        except OSError:
+            pass
+    return uids
+
+
+def delete_accounts(users, groups=()):
+    """Remove users and groups from the account databases in one locked rewrite.
+
+    users are User objects and groups are group names. The private groups of
+    the users are removed too, like userdel does with USERGROUPS_ENAB, and
+    the users are removed from the members of all the other groups. Users
+    that don't exist or that have running processes are skipped, and so are
+    the groups that are the primary group of a remaining user. Return
+    (the files that changed, the list of (name, error) of the skipped ones).
+    """
+    busy = busy_uids()
+    failed = [(user.name, "Ο χρήστης είναι συνδεδεμένος") for user in users if user.uid in busy]
+    names = set(user.name for user in users) - set(name for name, _error in failed)
+    private = dict((user.name, user.gid) for user in users if user.name in names)
+    groups = set(groups)
+    changed = []
+    with AccountsLock(PASSWD_FILES + tuple(GROUP_FILES)):
+        old = {}
+        for path in PASSWD_FILES + tuple(GROUP_FILES):
+            if os.path.exists(path):
+                with open(path) as _file:
+                    old[path] = _file.readlines()
+        new = {}
+        existing = set(line.split(':', 1)[0] for line in old[PASSWD])
+        failed.extend((name, "Ο χρήστης δεν υπάρχει") for name in sorted(names - existing))
+        names &= existing
+        for path in PASSWD_FILES:
+            if path in old:
+                new[path] = [line for line in old[path] if line.split(':', 1)[0] not in names]
+        # A private group is kept if it's the primary group of a remaining user
+        kept_gids = set()
+        for line in new[PASSWD]:
+            fields = line.split(':')
+            if len(fields) > 3 and fields[3].isdigit():
+                kept_gids.add(int(fields[3]))
+        for line in old[GROUP]:
+            fields = line.split(':')
+            if len(fields) > 2 and fields[0] in groups and fields[2].isdigit() \
+                    and int(fields[2]) in kept_gids:
+                groups.discard(fields[0])
+                failed.append((fields[0], "Η ομάδα είναι κύρια ομάδα άλλου χρήστη"))
+        for line in old[GROUP]:
+            fields = line.rstrip('\n').split(':')
+            if len(fields) == 4 and fields[0] in names and fields[2] == str(private[fields[0]]) \
+                    and private[fields[0]] not in kept_gids \
+                    and set(filter(None, fields[3].split(','))) <= names:
+                groups.add(fields[0])
+        for path, member_fields in GROUP_FILES.items():
+            if path not in old:
+                continue
+            new[path] = []
+            for line in old[path]:
+                fields = line.rstrip('\n').split(':')
+                if fields[0] in groups:
+                    continue
+                for i in member_fields:
+                    if i < len(fields) and fields[i]:
+                        fields[i] = ','.join(m for m in fields[i].split(',') if m not in names)
+                new[path].append(':'.join(fields) + line[len(line.rstrip('\n')):])
+        for path, lines in new.items():
+            if lines != old[path]:
+                replace_file(path, lines)
+                changed.append(path)
+    if changed:
+        flush_nss_caches()
+    return changed, failed
+
+
+def flush_nss_caches():
+    """Invalidate the passwd and group caches of nscd and sssd, if they run."""
+    if shutil.which('nscd'):
+        for table in ('passwd', 'group'):
+            subprocess.call(['nscd', '-i', table],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if shutil.which('sss_cache'):
+        subprocess.call(['sss_cache', '-UG'],
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def remove_tree(path, cancelled, dev=None):
+    """Like shutil.rmtree, but raise Cancelled if cancelled() before a directory.
+
+    It doesn't descend into mount points, e.g. bind mounted shared folders,
+    and raises OSError for them instead, so their contents are kept.
+    """
+    if cancelled():
+        raise Cancelled(path)
+    status = os.lstat(path)
+    if dev is None:
+        dev = status.st_dev
+    elif status.st_dev != dev:
+        raise OSError("Το %s είναι σημείο προσάρτησης" % path)
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                remove_tree(entry.path, cancelled, dev)
+            else:
+                os.unlink(entry.path)
+    os.rmdir(path)
+
+
+class UserDeletion:
+    """Delete users in the background, first their accounts and then their homes.
+
+    The accounts are deleted in a worker thread with a single rewrite of the
+    account databases, see delete_accounts. Then up to workers threads delete the homes and mail spools, optionally archiving
+    each home to archive_dir/<user>.tar.gz first. progress(done, total) is
+    called after each home. The deferred fires with the list of (name, error)
+    failures; the homes that weren't deleted because of cancel() are listed
+    in skipped.
+    """
+
+    def __init__(self, system, users, remove_homes=False, archive_dir=None,
+                 progress=None, workers=HOME_WORKERS):
+        self.system = system
+        self.users = list(users)
+        self.names = [user.name for user in self.users]
+        self.homes = {}
+        if remove_homes:
+            deleted = set(self.names)
+            shared = set(os.path.normpath(user.directory) for user in system.users.values()
+                         if user.name not in deleted and user.directory)
+            shared.update(('/', HOME_PREFIX))
+            for user in users:
+                home = self.removable_home(user, shared)
+                if home is not None:
+                    self.homes[user.name] = home
+        self.remove_homes = remove_homes
+        self.archive_dir = archive_dir
+        self.progress = progress
+        self.workers = workers
+        self.cancelled = False
+        self.done = 0
+        self.total = len(self.names)
+        self.errors = []
+        self.skipped = []
+        self.deferred = None
+
+    @classmethod
+    def removable_home(cls, user, shared):
+        """Return the home of user if it's a directory that it owns and no one shares."""
+        if not user.directory or not os.path.isabs(user.directory):
+            return None
+        home = os.path.normpath(user.directory)
+        if home in shared:
+            return None
+        try:
+            home_stat = os.lstat(home)
+        except OSError:
+            return None
+        if not stat.S_ISDIR(home_stat.st_mode) or home_stat.st_uid != user.uid:
+            return None
+        return home
+
+    def start(self):
+        """Start the deletion and return the Deferred."""
+        from twisted.internet import threads
+        self.deferred = threads.deferToThread(self.delete_accounts)
+        self.deferred.addCallback(self.on_accounts_deleted)
+        return self.deferred
+
+    def cancel(self):
+        """Stop deleting homes; the accounts are deleted anyway."""
+        self.cancelled = True
+
+    def delete_accounts(self):
+        """Delete the accounts; return (the changed files, the (name, error) failures)."""
+        return delete_accounts(self.users)
+
+    def on_accounts_deleted(self, result):
+        from twisted.internet import threads
+        changed, failed = result
+        # The renamed files escape the inotify watches, so notify directly
+        for path in changed:
+            self.system.system_event.notify(path)
+        self.errors.extend(failed)
+        if not self.remove_homes:
+            return self.errors
+        # The homes of the users that still exist are kept
+        failed = set(name for name, _error in failed)
+        self.total = len(self.names) - len(failed)
+        semaphore = defer.DeferredSemaphore(self.workers)
+        dfrs = []
+        for name in self.names:
+            if name in failed:
+                continue
+            dfr = semaphore.run(threads.deferToThread, self.remove_home, name, self.homes.get(name))
+            dfr.addBoth(self.on_home_removed, name)
+            dfrs.append(dfr)
+        dfr = defer.DeferredList(dfrs)
+        dfr.addCallback(lambda _result: self.errors)
+        return dfr
+
+    def remove_home(self, name, home):
+        """Archive and delete the home and the mail spool of name, in a thread."""
+        if self.cancelled:
+            raise Cancelled(name)
+        if home is not None:
+            if self.archive_dir:
+                self.archive_home(name, home)
+            remove_tree(home, lambda: self.cancelled)
+        spool = os.path.join(MAIL_SPOOL, name)
+        if os.path.isfile(spool):
+            os.unlink(spool)
+
+    def archive_home(self, name, home):
+        os.makedirs(self.archive_dir, mode=0o700, exist_ok=True)
+        path = os.path.join(self.archive_dir, name + '.tar.gz')
+
+        def check(tarinfo):
+            if self.cancelled:
+                raise Cancelled(name)
+            return tarinfo
+
+        try:
+            with tarfile.open(path, 'w:gz') as tar:
+                tar.add(home, arcname=name, filter=check)
+        except BaseException:
+            # Don't leave partial archives behind
+            if os.path.exists(path):
+                os.unlink(path)
+            raise
+
+    def on_home_removed(self, result, name):
+        if isinstance(result, failure.Failure):
+            if result.check(Cancelled):
+                self.skipped.append(name)
+            else:
+                self.errors.append((name, str(result.value)))
+        self.done += 1
+        if self.progress is not None:
+            self.progress(self.done, self.total)
 
 
 class System(Set):
     """Command for system modifications."""
 
-    def __init__(self):
+    def __init__(self, load=True, window=EVENT_WINDOW):
         super(System, self).__init__()
-        self.load()
+        # Increased each time that new users and groups are loaded
+        self.version = 0
+        # The stamp of the account files when the snapshot was last read or saved
+        self.snapshot_stamp = None
+        self.validator = Validator(self)
+        if load:
+            self.load()
         # These might be updated from shared_folders, if they're used
         self.teachers = 'teachers'
         self.share_groups = [self.teachers]
 
         # INotifier for /etc/group and /etc/shadow
-        self.system_event = Event()
+        self.system_event = Event(window)
         self.libuser_event = Event()
         self.system_event.connect(self.on_system_changed)
         self.mask = inotify.IN_MODIFY
@@ -249,28 +1054,53 @@ class System(Set):
 
     def add_group(self, group):
         common.run_command(['groupadd', '-g', str(group.gid), group.name])
+        existing = False
         for user in group.members.values():
-            if user in self.users.values():
-                common.run_command(['usermod', '-a', '-G', group.name, user.name])
+            if user.name in self.users:
+                existing = True
             else:
+                # usermod -G of add_user puts the new users in the group
                 self.add_user(user)
+        if existing:
+            self.set_group_members(group.name, group.members, [group.gid])
 
     @classmethod
-    def edit_group(cls, groupname, group):
-        """Edit a group."""
-        common.run_command(['groupmod', '-g', str(group.gid), '-n', group.name, groupname])
-        for user in group.members.values():
-            common.run_command(['usermod', '-a', '-G', group.name, user.name])
+    def edit_group(cls, groupname, group, old_members=None, old_gid=None):
+        """Edit a group.
+
+        If old_members is given, the member list is only rewritten if it
+        changed, and in a single command. Return the MembershipDiff.
+        """
+        start = time.time()
+        if groupname != group.name or old_gid is None or old_gid != group.gid:
+            common.run_command(['groupmod', '-g', str(group.gid), '-n', group.name, groupname])
+        diff = MembershipDiff(old_members, group.members)
+        if old_members is None or diff:
+            cls.set_group_members(group.name, group.members, [group.gid, old_gid])
+        sys.stderr.write("Επεξεργασία ομάδας %s: %s, %.2f sec\n" % (group.name, diff, time.time() - start))
+        return diff
+
+    @classmethod
+    def set_group_members(cls, groupname, members, gids):
+        """Replace the secondary members of a group in one locked rewrite.
+
+        The users whose primary gid is in gids aren't listed in it.
+        """
+        names = sorted(name for name, user in members.items() if user.gid not in gids)
+        common.run_command(['gpasswd', '-M', ','.join(names), groupname])
 
     @classmethod
     def delete_group(cls, group):
         common.run_command(['groupdel', group.name])
 
     def add_user(self, user, create_home=True):
-        """Add a new user."""
-        cmd = ["useradd"]
-        if create_home:
-            cmd.extend(['-m', '-d', user.directory])
+        """Add a new user.
+
+        With create_home=False the home isn't created; homes.Provisioner
+        creates the homes of many users faster.
+        """
+        cmd = ["useradd", '-d', user.directory]
+        cmd.append('-m' if create_home else '-M')
         cmd.extend(['-g', str(user.gid)])
         cmd.append(user.name)
         common.run_command(cmd)
@@ -333,6 +1163,12 @@ class System(Set):
         cmd.append(user.name)
         common.run_command(cmd)
 
+    def delete_users(self, users, remove_homes=False, archive_dir=None, progress=None):
+        """Delete users in the background; return the started UserDeletion."""
+        deletion = UserDeletion(self, users, remove_homes, archive_dir, progress)
+        deletion.start()
+        return deletion
+
     @classmethod
     def add_user_to_groups(cls, user, groups):
         """Add a user to a group."""
@@ -361,8 +1197,37 @@ class System(Set):
     def user_is_locked(cls, user):
         return user.password is None or user.password[0] in "!*"
 
-    def load(self):
-        """Generic operations."""
+    def load(self, snapshot=False):
+        """Load the users and groups.
+
+        If snapshot is True and the on-disk snapshot is current, load that and
+        return True; revalidate() should then be called to catch any other NSS
+        changes. Otherwise read them from NSS and return False.
+        The new dicts are built aside and swapped in at the end, so it's safe
+        to call this from a thread while the GUI reads the previous ones.
+        """
+        loaded = read_snapshot() if snapshot else None
+        if loaded is not None:
+            self.snapshot_stamp, users, groups = loaded
+            self.replace(users, groups)
+            self.version += 1
+            return True
+        self.replace(*self.read())
+        self.version += 1
+        return False
+
+    def read(self):
+        """Read and return the users and groups from NSS.
+
+        The snapshot is updated only if the files changed since it was saved.
+        """
+        # Taken first, so that changes while reading invalidate the snapshot
+        try:
+            stamp = files_stamp()
+        except OSError:
+            stamp = None
+        users = {}
+        groups = {}
         pwds = pwd.getpwall()
         spwds = spwd.getspall()
         val = {}
@@ -381,30 +1246,61 @@ class System(Set):
             usr = User(pas.pw_name, pas.pw_uid, pas.pw_gid, rname, office, wphone, hphone,
                        other, pas.pw_dir, pas.pw_shell, [grp.getgrgid(pas.pw_gid).gr_name], num.sp_lstchg, num.sp_min, num.sp_max, num.sp_warn,
                        num.sp_inact, num.sp_expire, num.sp_pwd)
-            self.users[usr.name] = usr
+            users[usr.name] = usr
 
-        groups = grp.getgrall()
-        for group in groups:
+        for group in grp.getgrall():
             grup = Group(group.gr_name, group.gr_gid)
             for member in group.gr_mem:
-                if member in self.users:
-                    ugroups = self.users[member].groups
+                if member in users:
+                    ugroups = users[member].groups
                     if group.gr_name not in ugroups:
-                        self.users[member].groups.append(group.gr_name)
-                    grup.members[member] = self.users[member]
+                        users[member].groups.append(group.gr_name)
+                    grup.members[member] = users[member]
 
-            self.groups[group.gr_name] = grup
+            groups[group.gr_name] = grup
 
-        for user in self.users.values():
+        for user in users.values():
             primary_group = grp.getgrgid(user.gid).gr_name
-            if primary_group in self.groups:
-                self.groups[primary_group].members[user.name] = user
+            if primary_group in groups:
+                groups[primary_group].members[user.name] = user
+
+        if stamp is not None and stamp != self.snapshot_stamp:
+            write_snapshot(stamp, users, groups)
+            self.snapshot_stamp = stamp
+        return users, groups
+
+    def revalidate(self):
+        """Reread NSS in a thread and notify about any differences.
 
-    def reload(self):
-        self.users = {}
-        self.groups = {}
-        self.load()
-        self.libuser_event.notify('event')
+        Return a Deferred.
+        """
+        from twisted.internet import threads
+        dfr = threads.deferToThread(self.read)
+        dfr.addCallback(lambda loaded: self.reload(loaded=loaded))
+        return dfr
+
+    def reload(self, files=None, loaded=None):
+        """Reload the users and groups and notify about the ones that changed.
+
+        loaded may be the already read (users, groups).
+        """
+        old_users, old_groups = self.users, self.groups
+        if loaded is None:
+            self.load()
+        else:
+            self.replace(*loaded)
+            self.version += 1
+        changes = Changes(files=files)
+        for name in old_users.keys() | self.users.keys():
+            if name not in old_users or name not in self.users \
+                    or old_users[name].__dict__ != self.users[name].__dict__:
+                changes.users.add(name)
+        key = lambda group: (group.gid, group.password, sorted(group.members))
+        for name in old_groups.keys() | self.groups.keys():
+            if name not in old_groups or name not in self.groups \
+                    or key(old_groups[name]) != key(self.groups[name]):
+                changes.groups.add(name)
+        self.libuser_event.notify(changes)
 
     @classmethod
     def get_valid_shells(cls):
@@ -472,9 +1368,9 @@ class System(Set):
         """Event functions."""
         self.libuser_event.connect(func)
 
-    def on_system_changed(self, _event):
-        """Event callback."""
-        self.reload()
+    def on_system_changed(self, changes):
+        """Event callback, called once per burst of file changes."""
+        self.reload(changes.files)
 
     def on_fd_changed(self, _ignored, filename, _mask):
         """INotifier callback."""
@@ -483,9 +1379,11 @@ class System(Set):
         self.notifier._addWatch(filename, self.mask, False, [self.on_fd_changed])
         self.system_event.notify(filename.path)
 
-SYSTEM = System()
+# The GUI loads SYSTEM in the background, other scripts call SYSTEM.load()
+SYSTEM = System(load=False)
 
 if __name__ == '__main__':
+    SYSTEM.load()
     print("System users:", ', '.join(SYSTEM.users))
     print("\nSystem groups:", ', '.join(SYSTEM.groups))
 
@@ -3,13 +3,10 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 """Maintenance form."""
 
-import gc
-import mimetypes
 import os
-import functools
 import gi
-from gi.repository import Gtk
-import apt
+from gi.repository import Gtk, GObject
+import apt.progress.base
 import aptdaemon.client
 from aptdaemon.enums import *
 import aptdaemon.errors
@@ -18,15 +15,16 @@ import apt_pkg
 
 
 import dialogs
+import packages
 gi.require_version('Gtk', '3.0')
 
 
 
 class Package:
     def __init__(self, src, cache=None):
-        if cache is None:
-            self.name, self.sum, self.size, self.desc, self.childs = os.path.basename(src), \
-            mimetypes.guess_type(src)[0], os.path.getsize(src), 'Debian package', []
+        if isinstance(src, packages.Entry):
+            self.name, self.sum, self.size, self.desc, self.childs = src.name, \
+            src.version, src.size, src.summary, []
         else:
             pkg_cache = cache[src]
             self.name, self.sum, self.size, self.desc, self.childs = pkg_cache.shortname, \
@@ -40,6 +38,27 @@ class Package:
 
 
 
+class CacheProgress(apt.progress.base.OpProgress):
+    """Show the progress of building the apt cache in a progress bar."""
+
+    def __init__(self, progressbar):
+        super(CacheProgress, self).__init__()
+        self.progressbar = progressbar
+        self.shown = None
+
+    def update(self, percent=None):
+        """Called from the cache building thread."""
+        super(CacheProgress, self).update(percent)
+        if self.shown != (self.op, int(self.percent)):
+            self.shown = (self.op, int(self.percent))
+            GObject.idle_add(self.show, self.op, self.percent)
+
+    def show(self, operation, percent):
+        self.progressbar.set_text(operation)
+        self.progressbar.set_fraction(percent / 100)
+        return False
+
+
 class MaintenanceDialog(object):
     """Retrieve main_dlg."""
 
@@ -56,9 +75,41 @@ class MaintenanceDialog(object):
         self.main_dlg_lbl_title = self.builder.get_object('main_dlg_lbl_title')
         self.main_dlg_lbl_space = self.builder.get_object('main_dlg_lbl_space')
         self.main_dlg_img_lbl = self.builder.get_object('main_dlg_img_lbl')
+        self.main_dlg_progressbar = self.builder.get_object('main_dlg_progressbar')
         self.main_dlg.set_transient_for(parent)
+        self.destroyed = False
+        self.main_dlg.connect('destroy', self.on_main_dlg_destroy)
         self.main_dlg.set_default_response(Gtk.ResponseType.CANCEL)
 
+    def open_cache(self, callback):
+        """Call callback with the shared apt cache, showing the progress."""
+        dfr = packages.open_cache(CacheProgress(self.main_dlg_progressbar))
+        if not dfr.called:
+            self.main_dlg_progressbar.set_text('Ανάγνωση λίστας πακέτων...')
+            self.main_dlg_progressbar.show()
+            self.main_dlg.set_response_sensitive(Gtk.ResponseType.OK, False)
+            self.main_dlg.show()
+        dfr.addCallback(self.on_cache_ready, callback)
+        dfr.addErrback(self.on_cache_failed)
+
+    def on_main_dlg_destroy(self, _widget):
+        self.destroyed = True
+
+    def on_cache_ready(self, cache, callback):
+        if self.destroyed:
+            # The user closed the dialog while the cache was being built
+            return
+        self.main_dlg_progressbar.hide()
+        self.main_dlg.set_response_sensitive(Gtk.ResponseType.OK, True)
+        callback(cache)
+
+    def on_cache_failed(self, fail):
+        if self.destroyed:
+            return
+        self.main_dlg.destroy()
+        text = 'Αδυναμία ανάγνωσης της λίστας πακέτων:\n%s' % fail.getErrorMessage()
+        dialogs.ErrorDialog(text, 'Σφάλμα').showup()
+
     def populate_treeview(self):
         """AptDeamon Callbacks."""
         tview_pkgs = []
@@ -149,8 +200,6 @@ class MaintenanceDialog(object):
 class Purge(MaintenanceDialog):
     def __init__(self, parent):
         super(Purge, self).__init__(parent)
-        self.cache = apt.Cache()
-        self.cache.open()
         self.main_dlg.set_title('Αφαίρεση παλιών πυρήνων...')
         self.main_dlg_lbl_title.set_markup(
             '<b><big>Βρέθηκαν οι παρακάτω παλιοί πυρήνες στο σύστημα\n\n</big></b>' \
@@ -158,7 +207,6 @@ class Purge(MaintenanceDialog):
         self.main_dlg_img_lbl.set_from_icon_name('applications-other', Gtk.IconSize.SMALL_TOOLBAR)
         self.main_dlg_img_lbl.set_pixel_size(-1)
         if not self.find():
-            self.clear_cache()
             dialogs.InfoDialog('Δεν βρέθηκαν παλιοί πυρήνες για διαγραφή.', 'Ειδοποίηση').showup()
             return
 
@@ -174,32 +222,17 @@ class Purge(MaintenanceDialog):
         self.main_dlg.show_all()
 
     def find(self):
-        status_path = apt_pkg.config.find_file('Dir::State::status')
-        tagf = apt_pkg.TagFile(open(status_path))
         # TODO: it would be nice to remove packages in rc state too
-        tmp_pkgs = [Package(sect['Package'], self.cache) for sect in tagf if \
-                    (sect['Package'].startswith('linux-image-') \
-                    or sect['Package'].startswith('linux-headers-')) \
-                    and sect['Source'] != 'linux-meta' \
-                    and not sect['Status'].startswith('deinstall')]
-
-        kernels = [pkg for pkg in tmp_pkgs if pkg.name.startswith('linux-image-')]
-        headers = [pkg for pkg in tmp_pkgs if pkg.name.startswith('linux-headers-')]
-        kernels.sort(key=functools.cmp_to_key(
-            lambda x, y: apt_pkg.version_compare(x.sum, y.sum)), reverse=True)
-
-        variants = []
-        for kernel in kernels:
-            version_variant = kernel.name.replace('linux-image-', '')
-            version = kernel.sum.rpartition('.')[0]
-            variant = version_variant.replace(version, '').strip('-')
-            if version_variant != os.uname()[2] and variant in variants:
+        _keep, purge = packages.plan_kernel_purge(packages.get_inventory())
+        for kernel, headers in purge:
+            childs = [Package(header) for header in headers]
+            if kernel is not None:
+                # Show the headers under their kernel
+                kernel = Package(kernel)
                 self.pkgs.append(kernel)
-                for header in headers:
-                    if header.name.find(version) != -1:
-                        kernel.do_child(header)
-                        self.pkgs.append(header)
-            variants.append(variant)
+                for child in childs:
+                    kernel.do_child(child)
+            self.pkgs.extend(childs)
         return True if len(self.pkgs) != 0 else False
 
     def populate_treeview(self):
@@ -209,14 +242,9 @@ class Purge(MaintenanceDialog):
             for iter in piter.iterchildren():
                 iter[1], iter[5], iter[6], iter[7] = 'applications-other', True, False, True
 
-    def clear_cache(self):
-        del self.cache
-        gc.collect()
-
     def on_main_dlg_response(self, main_dlg, response):
         """Callbacks."""
         if response != Gtk.ResponseType.OK:
-            self.clear_cache()
             self.main_dlg.destroy()
             return
 
@@ -230,14 +258,13 @@ class Purge(MaintenanceDialog):
         self.apt_client.commit_packages(None, None, None, pkgs, None, None, False, \
                                             self.on_reply, self.on_error)
 
-    def on_prog_dlg_response(self, prog_dlg, response):
-        self.clear_cache()
-        super(Purge, self).on_prog_dlg_response(prog_dlg, response)
-
 
 class Clean(MaintenanceDialog):
     def __init__(self, parent):
         super(Clean, self).__init__(parent)
+        self.groups = []
+        self.files = 0
+        self.size = 0
         self.main_dlg.set_title('Καθαρισμός μνήμης πακέτων...')
         self.main_dlg_lbl_title.set_markup(
             '<b><big>Βρέθηκαν τα παρακάτω αρχεία στην μνήμη\n</big></b>')
@@ -247,35 +274,52 @@ class Clean(MaintenanceDialog):
             dialogs.InfoDialog('Δεν υπάρχουν αρχεία στην μνήμη πακέτων για διαγραφή.', 'Ειδοποίηση').showup()
             return
 
-        if len(self.pkgs) == 1:
+        if self.files == 1:
             self.main_dlg_lbl_space.set_markup(
                 '%s αρχείο βρέθηκε, %sB χώρου στο δίσκο θα ελευθερωθούν.' \
-                %(str(len(self.pkgs)), apt_pkg.size_to_str(sum(pkg.size for pkg in self.pkgs))))
+                %(str(self.files), apt_pkg.size_to_str(self.size)))
         else:
             self.main_dlg_lbl_space.set_markup(
                 '%s αρχεία βρέθηκαν, %sB χώρου στο δίσκο θα ελευθερωθούν.' \
-                %(str(len(self.pkgs)), apt_pkg.size_to_str(sum(pkg.size for pkg in self.pkgs))))
+                %(str(self.files), apt_pkg.size_to_str(self.size)))
         self.populate_treeview()
+        self.main_dlg_tview.connect('test-expand-row', self.on_main_dlg_tview_test_expand_row)
         self.main_dlg.show_all()
 
     def find(self):
-        archive_path = apt_pkg.config.find_dir('Dir::Cache::archives')
-        for dir in [archive_path, os.path.join(archive_path, 'partial')]:
-            for filename in os.listdir(dir):
-                if filename == 'lock':
-                    continue
-                path = os.path.join(dir, filename)
-                if os.path.isfile(path):
-                    self.pkgs.append(Package(path))
-        self.pkgs.sort(key=lambda x: x.name)
-        return True if len(self.pkgs) != 0 else False
+        self.groups = sorted(packages.scan_archives().values(), key=lambda x: x.name)
+        self.files = sum(len(group.files) for group in self.groups)
+        self.size = sum(group.size for group in self.groups)
+        return True if self.files != 0 else False
 
     def populate_treeview(self):
-        super(Clean, self).populate_treeview()
-        for row in self.main_dlg_tstore:
-            row[1] = 'package-x-generic'
-        self.main_dlg_tview.get_columns()[0].set_title('Αρχείο')
-
+        """Add a row per package; its files are added when it's expanded."""
+        for group in self.groups:
+            if len(group.files) == 1:
+                desc = '<b>%s</b>\n<small>%s</small>' %(group.name, group.files[0][1] \
+                                                        or os.path.basename(group.files[0][0]))
+            else:
+                desc = '<b>%s</b>\n<small>%d αρχεία</small>' %(group.name, len(group.files))
+            size = '%sB' %apt_pkg.size_to_str(group.size)
+            piter = self.main_dlg_tstore.append(None, [group, 'package-x-generic', desc, size, \
+                                                Gtk.IconSize.LARGE_TOOLBAR, None, None, False])
+            if len(group.files) > 1:
+                # A placeholder, so that the row can be expanded
+                self.main_dlg_tstore.append(piter, [None, None, '', '', \
+                                            Gtk.IconSize.SMALL_TOOLBAR, None, None, False])
+
+    def on_main_dlg_tview_test_expand_row(self, _tview, piter, _path):
+        """Replace the placeholder with the package files."""
+        placeholder = self.main_dlg_tstore.iter_children(piter)
+        if self.main_dlg_tstore[placeholder][0] is not None:
+            return False
+        for path, version, size in self.main_dlg_tstore[piter][0].files:
+            desc = '<b>%s</b>\n<small>%s</small>' %(os.path.basename(path), version)
+            size = '%sB' %apt_pkg.size_to_str(size)
+            self.main_dlg_tstore.append(piter, [path, 'package-x-generic', desc, size, \
+                                        Gtk.IconSize.SMALL_TOOLBAR, None, None, False])
+        self.main_dlg_tstore.remove(placeholder)
+        return False
 
     def on_main_dlg_response(self, main_dlg, response):
         """Callbacks."""
@@ -289,22 +333,25 @@ class Clean(MaintenanceDialog):
         if ask_dlg.showup() != Gtk.ResponseType.YES:
             return
 
-        pkgs = [pkg.name for pkg in self.pkgs]
         self.apt_client.clean(False, self.on_reply, self.on_error)
 
 
 class AutoRemove(MaintenanceDialog):
     def __init__(self, parent):
         super(AutoRemove, self).__init__(parent)
-        self.cache = apt.Cache()
-        self.cache.open()
+        self.cache = None
         self.main_dlg.set_title('Διαγραφή ορφανών πακέτων...')
         self.main_dlg_lbl_title.set_markup(
             '<b><big>Βρέθηκαν τα παρακάτω ορφανά πακέτα στο σύστημα\n</big></b>')
         self.main_dlg_img_lbl.set_from_icon_name('applications-other', Gtk.IconSize.SMALL_TOOLBAR)
         self.main_dlg_img_lbl.set_pixel_size(-1)
+        self.open_cache(self.on_cache_opened)
+
+    def on_cache_opened(self, cache):
+        """Find the orphan packages when the apt cache is ready."""
+        self.cache = cache
         if not self.find():
-            self.clear_cache()
+            self.main_dlg.destroy()
             dialogs.InfoDialog('Δεν υπάρχουν ορφανά πακέτα για διαγραφή.', 'Ειδοποίηση').showup()
             return
 
@@ -320,10 +367,9 @@ class AutoRemove(MaintenanceDialog):
         self.main_dlg.show_all()
 
     def find(self):
-        status_path = apt_pkg.config.find_file('Dir::State::status')
-        tagf = apt_pkg.TagFile(open(status_path))
-        self.pkgs = [Package(sect['Package'], self.cache) for sect in tagf if \
-                     self.cache['{}:{}'.format(sect['Package'], sect['Architecture'])].is_auto_removable]
+        inventory = packages.get_inventory()
+        self.pkgs = [Package(entry) for entry in inventory.by_state.get('installed', []) if \
+                     self.cache['{}:{}'.format(entry.name, entry.arch)].is_auto_removable]
         self.pkgs.sort(key=lambda x: x.name)
         return True if len(self.pkgs) != 0 else False
 
@@ -332,15 +378,9 @@ class AutoRemove(MaintenanceDialog):
         for row in self.main_dlg_tstore:
             row[1] = 'applications-other'
 
-    def clear_cache(self):
-        del self.cache
-        gc.collect()
-
-
     def on_main_dlg_response(self, main_dlg, response):
         """Callbacks."""
         if response != Gtk.ResponseType.OK:
-            self.clear_cache()
             self.main_dlg.destroy()
             return
 
@@ -353,7 +393,3 @@ class AutoRemove(MaintenanceDialog):
         pkgs = [pkg.name for pkg in self.pkgs]
         self.apt_client.commit_packages(None, None, None, pkgs, None, None, False, \
                                             self.on_reply, self.on_error)
-
-    def on_prog_dlg_response(self, prog_dlg, response):
-        self.clear_cache()
-        super(AutoRemove, self).on_prog_dlg_response(prog_dlg, response)
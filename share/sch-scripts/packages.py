@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# This file is part of sch-scripts, https://launchpad.net/sch-scripts
+# Copyright 2009-2018 the sch-scripts team, see AUTHORS.
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""Installed packages inventory and kernel purge planner."""
+
+import bisect
+import functools
+import os
+import re
+import shlex
+import sys
+import urllib.parse
+import apt
+import apt_pkg
+from twisted.internet import defer, threads
+
+apt_pkg.init()
+
+
+class Entry:
+    """The fields of a dpkg status stanza that sch-scripts cares about."""
+
+    def __init__(self, section):
+        self.name = section['Package']
+        self.arch = section.get('Architecture', '')
+        self.version = section.get('Version', '')
+        # Source may be missing, or be followed by a version in parentheses
+        self.source = section.get('Source', self.name).split()[0]
+        # Status is "want flag state", e.g. "install ok installed"
+        self.want, _flag, self.state = section.get('Status', '  ').split(' ', 2)
+        # Installed-Size is in KiB
+        self.size = int(section.get('Installed-Size', 0) or 0) * 1024
+        self.summary = section.get('Description', '').partition('\n')[0]
+
+    def __str__(self):
+        return str(self.__dict__)
+
+    def is_installed(self):
+        return self.want != 'deinstall' and self.state == 'installed'
+
+
+class Inventory:
+    """An index of the dpkg status file, by name prefix, source and state.
+
+    The status file is parsed only once; use get_inventory() to reuse the
+    same index for as long as the status file doesn't change.
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            path = apt_pkg.config.find_file('Dir::State::status')
+        self.path = path
+        self.mtime = os.stat(path).st_mtime
+        self.packages = {}
+        self.by_source = {}
+        self.by_state = {}
+        with open(path) as _file:
+            for section in apt_pkg.TagFile(_file):
+                entry = Entry(section)
+                self.packages[entry.name] = entry
+                self.by_source.setdefault(entry.source, []).append(entry)
+                self.by_state.setdefault(entry.state, []).append(entry)
+        self.names = sorted(self.packages)
+
+    def is_current(self):
+        """Return True if the status file hasn't changed since parsing it."""
+        try:
+            return os.stat(self.path).st_mtime == self.mtime
+        except OSError:
+            return False
+
+    def with_prefix(self, prefix):
+        """Return the entries whose names start with prefix."""
+        start = bisect.bisect_left(self.names, prefix)
+        end = bisect.bisect_left(self.names, prefix + '\uffff', start)
+        return [self.packages[name] for name in self.names[start:end]]
+
+    def installed(self, prefix=''):
+        """Return the installed entries whose names start with prefix."""
+        return [entry for entry in self.with_prefix(prefix) if entry.is_installed()]
+
+
+INVENTORY = None
+
+def get_inventory():
+    """Return the shared Inventory, reparsing the status file if it changed."""
+    global INVENTORY
+    if INVENTORY is None or not INVENTORY.is_current():
+        INVENTORY = Inventory()
+    return INVENTORY
+
+
+CACHE = None
+CACHE_STAMP = None
+CACHE_WAITING = None
+
+def cache_stamp():
+    """Return the mtimes of the files that invalidate the apt cache."""
+    stamp = []
+    for path in (apt_pkg.config.find_file('Dir::State::status'),
+                 apt_pkg.config.find_file('Dir::State::extended_states')):
+        try:
+            stamp.append(os.stat(path).st_mtime)
+        except OSError:
+            stamp.append(None)
+    return tuple(stamp)
+
+
+def open_cache(progress=None):
+    """Return a Deferred that fires with an up to date apt.Cache.
+
+    The cache is built in a thread, reporting to the apt OpProgress progress,
+    and it's kept warm until the dpkg status or the auto marks change.
+    """
+    global CACHE_WAITING
+    stamp = cache_stamp()
+    if CACHE is not None and CACHE_STAMP == stamp:
+        return defer.succeed(CACHE)
+    dfr = defer.Deferred()
+    if CACHE_WAITING is None:
+        CACHE_WAITING = []
+        build = threads.deferToThread(apt.Cache, progress)
+        build.addBoth(on_cache_built, stamp)
+    CACHE_WAITING.append(dfr)
+    return dfr
+
+
+def on_cache_built(result, stamp):
+    """Remember the new cache and pass the result to all the waiters."""
+    global CACHE, CACHE_STAMP, CACHE_WAITING
+    if isinstance(result, apt.Cache):
+        CACHE, CACHE_STAMP = result, stamp
+    waiting, CACHE_WAITING = CACHE_WAITING, None
+    for dfr in waiting:
+        dfr.callback(result)
+
+
+class DebGroup:
+    """The cached files of a package in the apt archives, and their size."""
+
+    def __init__(self, name):
+        self.name = name
+        self.size = 0
+        self.files = []
+
+    def add(self, path, version, size):
+        self.files.append((path, version, size))
+        self.size += size
+
+
+def split_deb_name(filename):
+    """Return the (name, version) of e.g. bash_4.4.18-2ubuntu1_amd64.deb."""
+    parts = filename.split('_')
+    if len(parts) != 3:
+        return filename, ''
+    return parts[0], urllib.parse.unquote(parts[1])
+
+
+def iter_archives(path=None):
+    """Yield (path, name, version, size) for the files in the apt archives.
+
+    The directories are read with os.scandir, reusing its cached stat results.
+    """
+    if path is None:
+        path = apt_pkg.config.find_dir('Dir::Cache::archives')
+    for directory in (path, os.path.join(path, 'partial')):
+        try:
+            entries = os.scandir(directory)
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.name == 'lock' or not entry.is_file():
+                    continue
+                name, version = split_deb_name(entry.name)
+                yield entry.path, name, version, entry.stat().st_size
+
+
+def scan_archives(path=None):
+    """Return a dict of DebGroups by package name for the apt archives."""
+    groups = {}
+    for file_path, name, version, size in iter_archives(path):
+        group = groups.get(name)
+        if group is None:
+            group = groups[name] = DebGroup(name)
+        group.add(file_path, version, size)
+    return groups
+
+
+def split_kernel_name(name, prefix):
+    """Return the (version, variant) of e.g. linux-image-4.15.0-20-generic."""
+    version_variant = name[len(prefix):]
+    version = re.match('[.0-9-]*', version_variant).group()
+    variant = version_variant[len(version):]
+    return version.rstrip('-'), variant
+
+
+def plan_kernel_purge(inventory, running=None):
+    """Decide which kernels and headers can be purged.
+
+    Keep the newest kernel of each variant and the running one, and the
+    headers of the kept kernel versions. Return (keep, purge), two lists of
+    (kernel, headers) tuples; kernel is None for orphan headers.
+    """
+    if running is None:
+        running = os.uname()[2]
+    kernels = [entry for entry in inventory.installed('linux-image-')
+               if entry.source != 'linux-meta']
+    headers = [entry for entry in inventory.installed('linux-headers-')
+               if entry.source != 'linux-meta']
+    kernels.sort(key=functools.cmp_to_key(
+        lambda x, y: apt_pkg.version_compare(x.version, y.version)), reverse=True)
+
+    keep = []
+    purge = []
+    variants = []
+    for kernel in kernels:
+        version, variant = split_kernel_name(kernel.name, 'linux-image-')
+        if not version or not variant:
+            continue
+        if variant in variants and kernel.name != 'linux-image-' + running:
+            purge.append((kernel, version))
+        else:
+            keep.append((kernel, version))
+            variants.append(variant)
+
+    by_version = {}
+    for header in headers:
+        version = split_kernel_name(header.name, 'linux-headers-')[0]
+        if version:
+            by_version.setdefault(version, []).append(header)
+    # Pop the kept versions first, so that their headers are never purged
+    keep = [(kernel, by_version.pop(version, [])) for kernel, version in keep]
+    purge = [(kernel, by_version.pop(version, [])) for kernel, version in purge]
+    purge.extend((None, orphans) for orphans in by_version.values())
+    return keep, purge
+
+
+def usage():
+    """Print usage info about packages.py."""
+    return """Χρήση: packages.py kernels
+
+Εντολές:
+    kernels
+        Εμφανίζει σε μορφή μεταβλητών φλοιού τους πυρήνες και τα headers
+        που θα διατηρηθούν (keep_kernels, keep_headers) και αυτά που
+        μπορούν να διαγραφούν (purge_kernels, purge_headers).
+"""
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2 or sys.argv[1] != 'kernels':
+        sys.stderr.write(usage() + "\n")
+        sys.exit(1)
+    KEEP, PURGE = plan_kernel_purge(get_inventory())
+    for var, plan in (('keep', KEEP), ('purge', PURGE)):
+        print("%s_kernels=%s" % (var, shlex.quote(
+            ' '.join(kernel.name for kernel, _headers in plan if kernel))))
+        print("%s_headers=%s" % (var, shlex.quote(
+            ' '.join(header.name for _kernel, headers in plan for header in headers))))
@@ -4,13 +4,20 @@
 """Parsers."""
 
 import csv
+import gzip
+import json
+import operator
 import os
-import configparser
-from io import StringIO, BytesIO
+import ipv4
 import libuser
 
 FIELDS_MAP = {'Όνομα χρήστη': 'name', 'Τελευταία αλλαγή κωδικού': 'lstchg', 'Κύρια ομάδα': 'gid', 'Όνομα κύριας ομάδας' : 'primary_group', 'Κέλυφος': 'shell', 'UID': 'uid', 'Γραφείο': 'office', 'Κρυπτογραφημένος κωδικός': 'password', 'Κωδικός': 'plainpw', 'Λήξη': 'expire', 'Μέγιστη διάρκεια': 'max', 'Προειδοποίηση': 'warn', 'Κατάλογος': 'directory', 'Ελάχιστη διάρκεια': 'min', 'Άλλο': 'other', 'Ομάδες': 'groups', 'Τηλ. γραφείου': 'wphone', 'Ανενεργός': 'inact', 'Ονοματεπώνυμο': 'rname', 'Τηλ. οικίας': 'hphone'}
 
+# The User attributes of the CSV_USER_FIELDS before and after 'Ομάδες'
+CSV_HEAD_ATTRS = ('name', 'uid', 'gid', 'primary_group', 'rname', 'office', 'wphone', 'hphone', 'other',
+                  'directory', 'shell')
+CSV_TAIL_ATTRS = ('lstchg', 'min', 'max', 'warn', 'inact', 'expire', 'password')
+
 class CSV:
     """Parser for Comma-separated values."""
 
@@ -18,7 +25,8 @@ class CSV:
         self.fields_map = FIELDS_MAP
 
     def parse(self, fname):
-        users_dict = csv.DictReader(open(fname))
+        opener = gzip.open if fname.endswith('.gz') else open
+        users_dict = csv.DictReader(opener(fname, 'rt', newline=''))
         users = {}
         groups = {}
         for user_d in users_dict:
@@ -70,23 +78,46 @@ class CSV:
 
 
     def write(self, fname, system, users):
-        _file = open(fname, 'w')
-        writer = csv.DictWriter(_file, fieldnames=libuser.CSV_USER_FIELDS)
-        writer.writerow(dict((n, n) for n in libuser.CSV_USER_FIELDS))
+        """Write the users to fname, gzip compressed if it ends in .gz."""
+        # The secondary groups are written as gname:gid pairs
+        gids = dict((name, group.gid) for name, group in system.groups.items())
+        opener = gzip.open if fname.endswith('.gz') else open
+        with opener(fname, 'wt', newline='') as _file:
+            writer = csv.writer(_file)
+            writer.writerow(libuser.CSV_USER_FIELDS)
+            writer.writerows(self.rows(users, gids))
+
+    @classmethod
+    def rows(cls, users, gids):
+        """Yield the CSV_USER_FIELDS values of each user; None is written as ''."""
+        head = operator.attrgetter(*CSV_HEAD_ATTRS)
+        tail = operator.attrgetter(*CSV_TAIL_ATTRS)
         for user in users:
-            u_dict = dict((key, user.__dict__[o_key] if user.__dict__[o_key] is not None else '') for key, o_key in self.fields_map.items())
-            u_dict['Κωδικός'] = '' # We don't have the plain password
-            u_dict['Ομάδες'] = list(u_dict['Ομάδες'])
-            # Convert the groups value to a proper gname:gid pairs formatted string
-            final_groups = u_dict['Ομάδες']
-            final_groups.remove(u_dict['Όνομα κύριας ομάδας'])
-            for i, gname in enumerate(final_groups):
-                gid = system.groups[gname].gid
-                final_groups[i] = ':'.join((final_groups[i], str(gid)))
-            u_dict['Ομάδες'] = ','.join(final_groups)
+            groups = ','.join('%s:%s' % (gname, gids[gname]) if gname in gids else gname
+                              for gname in user.groups if gname != user.primary_group)
+            # We don't have the plain password
+            yield head(user) + (groups,) + tail(user) + ('',)
 
-            writer.writerow(u_dict)
-        _file.close()
+
+class ParseReport:
+    """The problems that Passwd.parse found; each item has (file, line number, ...)."""
+
+    def __init__(self):
+        self.invalid = []
+        self.duplicates = []
+        self.orphans = []
+        # (user name, gid) of the users whose primary group wasn't found
+        self.missing_groups = []
+
+    def __bool__(self):
+        return bool(self.invalid or self.duplicates or self.orphans or self.missing_groups)
+
+    def __str__(self):
+        lines = ['%s:%d: Μη έγκυρη γραμμή: %s' % item for item in self.invalid]
+        lines += ['%s:%d: Διπλή εγγραφή: %s' % item for item in self.duplicates]
+        lines += ['%s:%d: Άγνωστος χρήστης: %s' % item for item in self.orphans]
+        lines += ['Δεν βρέθηκε η κύρια ομάδα του %s (GID %s)' % item for item in self.missing_groups]
+        return '\n'.join(lines)
 
 
 class Passwd():
@@ -101,111 +132,275 @@ class Passwd():
 
     @classmethod
     def parse(cls, pwd, spwd=None, grp=None):
-        new_set = libuser.Set()
+        """Parse the files in one pass each, indexing by name and gid.
 
-        with open(pwd) as _file:
-            reader = csv.reader(_file, delimiter=':', quoting=csv.QUOTE_NONE)
-            for row in reader:
-                usr = libuser.User()
-                usr.name = row[0]
-                usr.password = row[1]
-                usr.uid = int(row[2])
-                usr.gid = int(row[3])
-                gecos = row[4].split(',', 4)
-                gecos += [''] * (5 - len(gecos)) # Pad with empty strings so we have exactly 5 items
-                usr.rname, usr.office, usr.wphone, usr.hphone, usr.other = gecos
-                usr.directory = row[5]
-                usr.shell = row[6]
-                new_set.add_user(usr)
+        Invalid lines, duplicates and orphans are skipped and recorded in the
+        report attribute of the returned Set, a ParseReport.
+        """
+        users = {}
+        groups = {}
+        report = ParseReport()
+
+        for line_no, row in cls.rows(pwd, 7, report):
+            if row[0] in users:
+                report.duplicates.append((pwd, line_no, row[0]))
+                continue
+            try:
+                uid, gid = int(row[2]), int(row[3])
+            except ValueError:
+                report.invalid.append((pwd, line_no, ':'.join(row)))
+                continue
+            usr = libuser.User()
+            usr.name = row[0]
+            usr.password = row[1]
+            usr.uid = uid
+            usr.gid = gid
+            gecos = row[4].split(',', 4)
+            gecos += [''] * (5 - len(gecos)) # Pad with empty strings so we have exactly 5 items
+            usr.rname, usr.office, usr.wphone, usr.hphone, usr.other = gecos
+            usr.directory = row[5]
+            usr.shell = row[6]
+            users[usr.name] = usr
 
         if spwd:
-            with open(spwd) as _file:
-                reader = csv.reader(_file, delimiter=':', quoting=csv.QUOTE_NONE)
-                for row in reader:
-                    name = row[0]
-                    usr = new_set.users[name] # The user must exist in passwd
-                    usr.password = row[1]
-                    nums = ['lstchg', 'min', 'max', 'warn', 'inact', 'expire']
-                    for i, att in enumerate(nums, 2):
-                        try:
-                            usr.__dict__[att] = int(row[i])
-                        except:
-                            pass
+            seen = set()
+            nums = ['lstchg', 'min', 'max', 'warn', 'inact', 'expire']
+            for line_no, row in cls.rows(spwd, 8, report):
+                name = row[0]
+                if name in seen:
+                    report.duplicates.append((spwd, line_no, name))
+                    continue
+                seen.add(name)
+                usr = users.get(name)
+                if usr is None:
+                    report.orphans.append((spwd, line_no, name))
+                    continue
+                usr.password = row[1]
+                for i, att in enumerate(nums, 2):
+                    try:
+                        usr.__dict__[att] = int(row[i])
+                    except ValueError:
+                        pass
 
+        gids_map = {} # This is only used to set the primary_group User attribute
         if grp:
-            with open(grp) as _file:
-                reader = csv.reader(_file, delimiter=':', quoting=csv.QUOTE_NONE)
-                gids_map = {} # This is only used to set the primary_group User attribute
-                for row in reader:
-                    grup = libuser.Group()
-                    grup.name = row[0]
-                    grup.gid = int(row[2])
-                    members = row[3].split(',')
-                    if members == ['']:
-                        members = []
-                    grup.members = {}
-                    for name in members:
-                        grup.members[name] = new_set.users[name]
-                        new_set.users[name].groups.append(grup.name)
-
-                    new_set.add_group(grup)
-                    gids_map[grup.gid] = grup.name
-
-                for usr in new_set.users.values():
-                    usr.primary_group = gids_map[usr.gid]
-                    if usr.primary_group in usr.groups:
-                        usr.groups.remove(usr.primary_group)
-                    #usr.groups.append(usr.primary_group)
-
+            for line_no, row in cls.rows(grp, 4, report):
+                if row[0] in groups:
+                    report.duplicates.append((grp, line_no, row[0]))
+                    continue
+                try:
+                    gid = int(row[2])
+                except ValueError:
+                    report.invalid.append((grp, line_no, ':'.join(row)))
+                    continue
+                grup = libuser.Group(row[0], gid)
+                for name in row[3].split(','):
+                    if not name or name in grup.members:
+                        continue
+                    usr = users.get(name)
+                    if usr is None:
+                        report.orphans.append((grp, line_no, name))
+                        continue
+                    grup.members[name] = usr
+                    usr.groups.append(grup.name)
+                groups[grup.name] = grup
+                gids_map.setdefault(gid, grup.name)
+
+            for usr in users.values():
+                usr.primary_group = gids_map.get(usr.gid)
+                if usr.primary_group is None:
+                    report.missing_groups.append((usr.name, usr.gid))
+                    usr.primary_group = ''
+                elif usr.primary_group in usr.groups:
+                    usr.groups.remove(usr.primary_group)
+
+        # The relationships are already set, so don't use add_user/add_group
+        new_set = libuser.Set(users, groups)
+        new_set.report = report
         return new_set
 
+    @classmethod
+    def rows(cls, fname, min_fields, report):
+        """Yield the (line number, fields) of fname, reporting the invalid lines."""
+        with open(fname) as _file:
+            for line_no, line in enumerate(_file, 1):
+                line = line.rstrip('\n')
+                if not line or line.startswith('#'):
+                    continue
+                row = line.split(':')
+                if len(row) < min_fields or not row[0]:
+                    report.invalid.append((fname, line_no, line))
+                    continue
+                yield line_no, row
 
-class DHCP():
-    """Parser for Dynamic Host Configuration Protocol."""
+    @classmethod
+    def write(cls, dirname, system, users):
+        """Write the users to the passwd, shadow and group files of dirname.
+
+        The group file includes the primary and secondary groups of the users,
+        with only the exported users as members.
+        """
+        users = list(users)
+        names = set(user.name for user in users)
+        gnames = set(gname for user in users for gname in user.groups)
+        gnames.update(user.primary_group for user in users if user.primary_group)
+        os.makedirs(dirname, exist_ok=True)
+        with open(os.path.join(dirname, 'passwd'), 'w') as _file:
+            _file.writelines('%s:x:%s:%s:%s,%s,%s,%s,%s:%s:%s\n' % tuple(
+                '' if val is None else val for val in (user.name, user.uid, user.gid, user.rname,
+                                                       user.office, user.wphone, user.hphone,
+                                                       user.other, user.directory, user.shell))
+                             for user in users)
+        fd = os.open(os.path.join(dirname, 'shadow'), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as _file:
+            _file.writelines('%s:%s:%s:%s:%s:%s:%s:%s:\n' % tuple(
+                '' if val is None else val for val in (user.name, user.password, user.lstchg, user.min,
+                                                       user.max, user.warn, user.inact, user.expire))
+                             for user in users)
+        with open(os.path.join(dirname, 'group'), 'w') as _file:
+            # Only the secondary memberships are listed in the group file
+            _file.writelines('%s:x:%s:%s\n' % (group.name, group.gid, ','.join(
+                name for name, user in group.members.items()
+                if name in names and user.primary_group != group.name))
+                             for group in system.groups.values() if group.name in gnames)
+
+
+class JSONLines():
+    """Parser for typed JSON Lines, one user or group object per line."""
+
+    # The User attributes that are exported
+    USER_ATTRS = ('name', 'uid', 'gid', 'primary_group', 'rname', 'office', 'wphone', 'hphone', 'other',
+                  'directory', 'shell', 'groups', 'lstchg', 'min', 'max', 'warn', 'inact', 'expire',
+                  'password')
+
+    @classmethod
+    def write(cls, fname, system, users):
+        """Write the users, then their groups, to fname; gzip it if it ends in .gz."""
+        users = list(users)
+        names = set(user.name for user in users)
+        gnames = set(gname for user in users for gname in user.groups)
+        gnames.update(user.primary_group for user in users if user.primary_group)
+        opener = gzip.open if fname.endswith('.gz') else open
+        with opener(fname, 'wt') as _file:
+            for user in users:
+                record = dict((attr, getattr(user, attr)) for attr in cls.USER_ATTRS)
+                record['type'] = 'user'
+                _file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            for group in system.groups.values():
+                if group.name not in gnames:
+                    continue
+                record = {'type': 'group', 'name': group.name, 'gid': group.gid, 'password': group.password,
+                          'members': [name for name in group.members if name in names]}
+                _file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    @classmethod
+    def parse(cls, fname):
+        """Read a file written by write() in one pass."""
+        users = {}
+        groups = {}
+        opener = gzip.open if fname.endswith('.gz') else open
+        with opener(fname, 'rt') as _file:
+            for line in _file:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record.pop('type', None) == 'group':
+                    members = record.pop('members', [])
+                    group = libuser.Group(**record)
+                    group.members = dict((name, users[name]) for name in members if name in users)
+                    groups[group.name] = group
+                else:
+                    # Without the gid, User() doesn't look up the primary group in NSS
+                    user = libuser.User()
+                    user.__dict__.update(record)
+                    users[user.name] = user
+        return libuser.Set(users, groups)
+
+
+# (title, extension, parser) of the supported export formats
+EXPORTERS = [('CSV', '.csv', CSV), ('JSON Lines', '.jsonl', JSONLines),
+             ('passwd, shadow, group', '', Passwd)]
+
+
+def get_parser(fname):
+    """Return the parser for fname, based on its extension."""
+    name = fname[:-3] if fname.endswith('.gz') else fname
+    if name.endswith('.jsonl'):
+        return JSONLines()
+    return CSV()
+
+
+class IPConfig:
+    """The results of klibc ipconfig for an interface."""
+
+    # ipconfig keys => attributes
+    KEYS = {'DEVICE': 'device', 'PROTO': 'proto', 'IPV4ADDR': 'ip_add', 'IPV4NETMASK': 'mask',
+            'IPV4GATEWAY': 'route', 'IPV4BROADCAST': 'broadcast', 'HOSTNAME': 'hostname',
+            'DNSDOMAIN': 'domain'}
 
     def __init__(self):
-        self.dhcp_info = {}
-
-    def parse(self, interface):
-        config_file = None
-        file_run = '/run/net-%s.conf' % interface
-        file_tmp = '/tmp/net-%s.conf' % interface
-        if os.path.isfile(file_run):
-            config_file = file_run
-        elif os.path.isfile(file_tmp):
-            config_file = file_tmp
-
-        if not config_file:
-            return
-
-        vconfig_file = StringIO('[Root]\n%s' % open(config_file).read())
-        config = configparser.ConfigParser(allow_no_value=True)
-        config.readfp(vconfig_file)
-        try:
-            ip_add = config.get('Root', 'ipv4addr').strip("'")
-        except configparser.NoOptionError:
-            return
-
-        mask = config.get('Root', 'ipv4netmask').strip("'")
-        route = config.get('Root', 'ipv4gateway').strip("'")
-
-        try:
-            _dns0 = config.get('Root', 'ipv4dns0').strip("'")
-        except configparser.NoOptionError:
-            _dns0 = None
-
-        try:
-            _dns1 = config.get('Root', 'ipv4dns1').strip("'")
-        except configparser.NoOptionError:
-            _dns1 = None
-
-        try:
-            _dns2 = config.get('Root', 'ipv4dns2').strip("'")
-        except configparser.NoOptionError:
-            _dns2 = None
-
-        dnss = sorted([value for key, value in locals().items() if key.startswith('dns') and value and value != '0.0.0.0'])
-
-        self.dhcp_info.update(ip_add=ip_add, mask=mask, route=route, dnss=dnss)
-
-        return self.dhcp_info
+        self.device = None
+        self.proto = None
+        self.ip_add = None
+        self.mask = None
+        self.route = None
+        self.broadcast = None
+        self.hostname = None
+        self.domain = None
+        self.dnss = []
+
+    def __str__(self):
+        return str(self.__dict__)
+
+    def get_values(self):
+        """Return the values in the ip_dialog.Info format."""
+        return {'ip': self.ip_add, 'mask': self.mask, 'route': self.route, 'dnss': self.dnss}
+
+
+class DHCP():
+    """Parser for the klibc ipconfig results, e.g. /run/net-eth0.conf."""
+
+    @classmethod
+    def parse_file(cls, fname):
+        """Parse the KEY='value' lines of fname in one pass."""
+        config = IPConfig()
+        dnss = []
+        with open(fname) as _file:
+            for line in _file:
+                key, sep, value = line.strip().partition('=')
+                if not sep:
+                    continue
+                key = key.upper()
+                value = value.strip("'")
+                # Any number of IPV4DNS0, IPV4DNS1... entries
+                if key.startswith('IPV4DNS') and key[7:].isdigit():
+                    dnss.append((int(key[7:]), value))
+                elif key in IPConfig.KEYS:
+                    setattr(config, IPConfig.KEYS[key], value)
+        # Keep the servers order, skipping the unset ones (0.0.0.0)
+        config.dnss = [value for _i, value in sorted(dnss) if ipv4.is_host(value)]
+        return config
+
+    @classmethod
+    def parse(cls, interface):
+        """Return the IPConfig of interface, or None if it didn't get an address."""
+        for fname in ('/run/net-%s.conf' % interface, '/tmp/net-%s.conf' % interface):
+            if os.path.isfile(fname):
+                break
+        else:
+            return None
+
+        config = cls.parse_file(fname)
+        if not config.ip_add:
+            return None
+        return config
+
+    @classmethod
+    def parse_all(cls, interfaces):
+        """Return a dict with the IPConfigs of the interfaces that got an address."""
+        configs = {}
+        for interface in interfaces:
+            config = cls.parse(interface)
+            if config is not None:
+                configs[interface] = config
+        return configs
@@ -6,22 +6,25 @@
 
 import getpass
 import glob
+import itertools
 import locale
 import os
 import socket
 import subprocess
 import sys
+import time
 import gi
-from gi.repository import Gtk
+from gi.repository import Gtk, GObject
 
 from dbus.mainloop.glib import DBusGMainLoop
 from twisted.internet import gtk3reactor
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, threads
 import about_dialog
 import common
 import config
 import create_users
 import dialogs
+import disk_usage
 import export_dialog
 import group_form
 import import_dialog
@@ -30,6 +33,7 @@ import libuser
 import ltsp_info
 import maintenance
 import parsers
+import session
 import shared_folders
 import user_form
 import version
@@ -37,6 +41,9 @@ DBusGMainLoop(set_as_default=True)
 gtk3reactor.install()
 gi.require_version('Gtk', '3.0')
 
+# How many treeview rows to append on each idle callback
+POPULATE_BATCH = 200
+
 
 class Gui:
     def __init__(self):
@@ -56,6 +63,18 @@ class Gui:
         self.groups_filter = self.builder.get_object('groups_filter')
         self.users_model = self.builder.get_object('users_store')
         self.groups_model = self.builder.get_object('groups_store')
+        self.load_progressbar = self.builder.get_object('load_progressbar')
+        self.loading = False
+        self.populated = 0
+        self.populate_source = None
+        self.sort_ids = None
+        # The shared folder and homes bytes of each group, from disk_monitor
+        self.group_usage = {}
+        self.disk_monitor = None
+        for column, renderer, model_column in (('gtv_share_column', 'cellrenderertext19', 3),
+                                               ('gtv_homes_column', 'cellrenderertext20', 4)):
+            self.builder.get_object(column).set_cell_data_func(
+                self.builder.get_object(renderer), self.on_size_cell_data, model_column)
 
         self.show_private_groups = False
         self.show_system_groups = False
@@ -80,24 +99,25 @@ class Gui:
             menuitem.connect('toggled', self.on_mi_view_column_toggled, column)
             menuitem.set_active(title in visible)
             mn_view_columns.append(menuitem)
-        self.populate_treeviews()
 
-        self.queue = []
         self.system.connect_event(self.on_libuser_changed)
         self.main_window.show_all()
+        self.load_system()
 
 ## General helper functions
 
-    @classmethod
-    def edit_file(cls, filename):
-        """Function for editing a file."""
-        subprocess.Popen(['xdg-open', filename], stdin=open(os.devnull))
-        # TODO: Maybe throw an error message if not os.path.isfile(filename)
+    def edit_file(self, filename):
+        """Open a system file in the default editor, as root."""
+        session.run_as_root(['xdg-open', filename]).addErrback(self.on_run_failed)
 
-    @classmethod
-    def run_as_sudo_user(cls, cmd):
-        print('EXECUTE:\t' + '\t'.join(cmd))
-        sys.stdout.flush()
+    def run_as_sudo_user(self, cmd):
+        """Run cmd in the session of the user that started sch-scripts."""
+        return session.run_as_user(cmd).addErrback(self.on_run_failed)
+
+    def on_run_failed(self, fail):
+        fail.trap(session.SessionError)
+        text = "Αδυναμία εκτέλεσης εντολής:\n%s" % fail.getErrorMessage()
+        dialogs.ErrorDialog(text, "Σφάλμα").showup()
 
     def open_link(self, link):
         self.run_as_sudo_user(['xdg-open', link])
@@ -118,25 +138,120 @@ class Gui:
 
 ## INotify
 
-    def on_libuser_changed(self, _event):
-        self.queue.append(_event)
-        dif = defer.Deferred()
-        reactor.callLater(1, dif.callback, len(self.queue))
-        dif.addCallback(self.check_libuser_events)
-
-    def check_libuser_events(self, len_queue):
-        if len_queue == len(self.queue):
-            self.queue = []
+    def on_libuser_changed(self, changes):
+        """Called by libuser once per burst of user database changes."""
+        if changes.users or changes.groups:
             self.repopulate_treeviews()
+            if self.disk_monitor is not None:
+                self.disk_monitor.refresh()
 
 ## Groups and users treeviews
 
-    def populate_treeviews(self):
-        """Fill the users and groups treeviews from the system."""
-        for user in self.system.users.values():
-            self.users_model.append([user, user.uid, user.name, user.primary_group, user.rname, user.office, user.wphone, user.hphone, user.other, user.directory, user.shell, user.lstchg, user.min, user.max, user.warn, user.inact, user.expire])
-        for group in self.system.groups.values():
-            self.groups_model.append([group, group.gid, group.name])
+    def load_system(self):
+        """Load the users and groups in a thread, then fill the treeviews."""
+        for menu in ('mi_file', 'mi_groups', 'mi_users'):
+            self.builder.get_object(menu).set_sensitive(False)
+        self.loading = True
+        self.load_progressbar.set_text('Φόρτωση λογαριασμών...')
+        self.load_progressbar.show()
+        pulse = GObject.timeout_add(100, self.on_load_progressbar_pulse)
+        dfr = threads.deferToThread(self.system.load, True)
+        dfr.addCallback(self.on_system_loaded, pulse)
+        dfr.addErrback(self.on_system_load_failed, pulse)
+
+    def on_load_progressbar_pulse(self):
+        self.load_progressbar.pulse()
+        return True
+
+    def on_system_loaded(self, from_snapshot, pulse):
+        GObject.source_remove(pulse)
+        for menu in ('mi_file', 'mi_groups', 'mi_users'):
+            self.builder.get_object(menu).set_sensitive(True)
+        self.populate_treeviews()
+        if self.disk_monitor is None:
+            self.disk_monitor = disk_usage.Monitor(
+                self.system, self.shared_fold.config['SHARE_DIR'], self.on_disk_usage_updated)
+            self.disk_monitor.start()
+        # Any differences from the snapshot come in as libuser changes
+        if from_snapshot:
+            self.system.revalidate().addErrback(lambda fail: fail.printTraceback())
+
+    def on_system_load_failed(self, fail, pulse):
+        GObject.source_remove(pulse)
+        self.loading = False
+        self.load_progressbar.hide()
+        text = "Αδυναμία φόρτωσης των λογαριασμών χρηστών:\n%s\n\nΘέλετε να γίνει νέα προσπάθεια;" \
+            % fail.getErrorMessage()
+        if dialogs.AskDialog(text, "Σφάλμα").showup() == Gtk.ResponseType.YES:
+            self.load_system()
+            return
+        for menu in ('mi_file', 'mi_groups', 'mi_users'):
+            self.builder.get_object(menu).set_sensitive(True)
+
+    def populate_treeviews(self, callback=None):
+        """Fill the users and groups treeviews from the system.
+
+        The rows are appended in idle-time batches to keep the GUI responsive,
+        while sorting and group filtering wait until all of them are in.
+        Call callback when done.
+        """
+        if self.populate_source is not None:
+            GObject.source_remove(self.populate_source)
+        else:
+            self.sort_ids = [self.users_sort.get_sort_column_id(),
+                             self.groups_sort.get_sort_column_id()]
+            for model in (self.users_sort, self.groups_sort):
+                model.set_sort_column_id(Gtk.TREE_SORTABLE_UNSORTED_SORT_COLUMN_ID,
+                                         Gtk.SortType.ASCENDING)
+        self.loading = True
+        self.populated = 0
+        users = list(self.system.users.values())
+        groups = list(self.system.groups.values())
+        rows = itertools.chain(
+            ((self.users_model, [user, user.uid, user.name, user.primary_group, user.rname, user.office, user.wphone, user.hphone, user.other, user.directory, user.shell, user.lstchg, user.min, user.max, user.warn, user.inact, user.expire])
+             for user in users),
+            ((self.groups_model, [group, group.gid, group.name] + list(self.group_usage.get(group.name, (0, 0))))
+             for group in groups))
+        self.load_progressbar.set_text('Φόρτωση λογαριασμών...')
+        self.load_progressbar.set_fraction(0)
+        self.load_progressbar.show()
+        self.populate_source = GObject.idle_add(
+            self.populate_batch, rows, len(users) + len(groups), callback)
+
+    def populate_batch(self, rows, total, callback):
+        """Append the next batch of rows, return False after the last one."""
+        for model, row in itertools.islice(rows, POPULATE_BATCH):
+            model.append(row)
+            self.populated += 1
+        if self.populated < total:
+            self.load_progressbar.set_fraction(self.populated / total)
+            return True
+
+        self.populate_source = None
+        self.loading = False
+        for model, (sort_id, order) in zip((self.users_sort, self.groups_sort), self.sort_ids):
+            if sort_id is None:
+                sort_id, order = Gtk.TREE_SORTABLE_DEFAULT_SORT_COLUMN_ID, Gtk.SortType.ASCENDING
+            model.set_sort_column_id(sort_id, order)
+        self.users_filter.refilter()
+        self.load_progressbar.hide()
+        if callback:
+            callback()
+        return False
+
+    def on_disk_usage_updated(self, usage):
+        """Update the disk usage columns of the groups treeview."""
+        self.group_usage = usage
+        for row in self.groups_model:
+            sizes = usage.get(row[0].name, (0, 0))
+            if (row[3], row[4]) != sizes:
+                row[3], row[4] = sizes
+
+    @classmethod
+    def on_size_cell_data(cls, _column, renderer, model, rowiter, model_column):
+        """Show the bytes of model_column human readable, or nothing for 0."""
+        size = model[rowiter][model_column]
+        renderer.set_property('text', disk_usage.format_size(size) if size else '')
 
     def repopulate_treeviews(self):
         """Repopulate treeviews.
@@ -144,17 +259,18 @@ class Gui:
         Preserve the selected groups and users, clear and refill the treeviews
         and reselect the previously selected groups and users, if possible.
         """
-        groups_selection = self.groups_tree.get_selection()
-        users_selection = self.users_tree.get_selection()
         selected_groups = [i.name for i in self.get_selected_groups()]
         selected_users = [i.name for i in self.get_selected_users()]
 
         # Clear and refill the treeviews
         self.users_model.clear()
         self.groups_model.clear()
-        self.populate_treeviews()
+        self.populate_treeviews(lambda: self.reselect(selected_groups, selected_users))
 
-        # Reselect the previously selected groups and users, if possible
+    def reselect(self, selected_groups, selected_users):
+        """Reselect the previously selected groups and users, if possible."""
+        groups_selection = self.groups_tree.get_selection()
+        users_selection = self.users_tree.get_selection()
         groups_iters = dict((row[0].name, row.iter) for row in self.groups_sort)
         for gname in selected_groups:
             if gname in groups_iters:
@@ -167,6 +283,9 @@ class Gui:
     def set_user_visibility(self, model, rowiter, _options):
         """Set if a user is visible."""
         user = model[rowiter][0]
+        if self.loading:
+            # Group filtering is applied when loading finishes
+            return self.show_system_groups or not user.is_system_user()
         selected = self.get_selected_groups()
         # FIXME: The list comprehension here costs
         return (len(selected) == 0 and (self.show_system_groups or not user.is_system_user())) \
@@ -310,6 +429,12 @@ class Gui:
                 text = "Το αρχείο '%s' δεν περιέχει δεδομένα." % passwd
                 dialogs.ErrorDialog(text, "Σφάλμα").showup()
                 return False
+            if new_users.report:
+                lines = str(new_users.report).split('\n')
+                if len(lines) > 20:
+                    lines = lines[:20] + ['...και άλλα %d προβλήματα.' % (len(lines) - 20)]
+                text = "Οι παρακάτω εγγραφές παραλείφθηκαν:\n\n%s" % '\n'.join(lines)
+                dialogs.WarningDialog(text, "Προειδοποίηση").showup()
             chooser.destroy()
             import_dialog.ImportDialog(new_users)
         else:
@@ -321,7 +446,7 @@ class Gui:
 
         If the file is empty return false.
         """
-        chooser = Gtk.FileChooserDialog(title="Επιλέξτε το αρχείο CSV προς εισαγωγή",
+        chooser = Gtk.FileChooserDialog(title="Επιλέξτε το αρχείο CSV ή JSON Lines προς εισαγωγή",
                                         action=Gtk.FileChooserAction.OPEN,
                                         buttons=(Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
                                                  Gtk.STOCK_OK, Gtk.ResponseType.OK))
@@ -333,7 +458,7 @@ class Gui:
         resp = chooser.run()
         if resp == Gtk.ResponseType.OK:
             fname = chooser.get_filename()
-            new_users = parsers.CSV().parse(fname)
+            new_users = parsers.get_parser(fname).parse(fname)
             if len(new_users.users) == 0:
                 text = "Το αρχείο '%s' δεν περιέχει δεδομένα." % fname
                 dialogs.ErrorDialog(text, "Σφάλμα").showup()
@@ -459,11 +584,47 @@ class Gui:
         rm_homes_check.get_child().set_tooltip_text(homes_warn)
         rm_homes_check.show()
         vbox.pack_start(rm_homes_check, False, False, 12)
+        archive_check = Gtk.CheckButton("Αρχειοθέτηση των αρχικών καταλόγων στο %s πριν τη διαγραφή." % libuser.HOMES_ARCHIVE)
+        archive_check.set_sensitive(False)
+        rm_homes_check.connect('toggled', lambda check: archive_check.set_sensitive(check.get_active()))
+        archive_check.show()
+        vbox.pack_start(archive_check, False, False, 0)
         response = dlg.showup()
         if response == Gtk.ResponseType.YES:
             rm_homes = rm_homes_check.get_active()
-            for user in self.get_selected_users():
-                self.system.delete_user(user, rm_homes)
+            archive_dir = None
+            if rm_homes and archive_check.get_active():
+                archive_dir = os.path.join(libuser.HOMES_ARCHIVE, time.strftime('%Y%m%d-%H%M%S'))
+            # The GUI stays responsive while the homes are deleted in threads
+            deletion = self.system.delete_users(users, rm_homes, archive_dir)
+            progress = dialogs.ProgressDialog("Διαγραφή %d χρηστών..." % users_n, "Διαγραφή χρηστών",
+                                              deletion.cancel if rm_homes else None)
+            progress.set_transient_for(self.main_window)
+            deletion.progress = progress.set_progress
+            deletion.deferred.addCallback(self.on_users_deleted, deletion, progress)
+            deletion.deferred.addErrback(self.on_users_delete_failed, progress)
+
+    def on_users_deleted(self, errors, deletion, progress):
+        """Show what failed or was cancelled while deleting users."""
+        progress.destroy()
+        message = []
+        if errors:
+            message.append("Αποτυχία διαγραφής για τους χρήστες:")
+            message.extend("%s: %s" % (name, error) for name, error in errors)
+        if deletion.skipped:
+            message.append("Οι αρχικοί κατάλογοι των παρακάτω χρηστών δεν διαγράφηκαν λόγω ακύρωσης:")
+            message.append(', '.join(deletion.skipped))
+        if message:
+            dialogs.WarningDialog('\n'.join(message), "Διαγραφή χρηστών").showup()
+        elif deletion.archive_dir:
+            dialogs.InfoDialog("Οι αρχικοί κατάλογοι αρχειοθετήθηκαν στο %s." % deletion.archive_dir,
+                               "Διαγραφή χρηστών").showup()
+
+    def on_users_delete_failed(self, fail, progress):
+        progress.destroy()
+        fail.printTraceback()
+        dialogs.ErrorDialog("Σφάλμα κατά τη διαγραφή των χρηστών:\n%s" % fail.getErrorMessage(),
+                            "Διαγραφή χρηστών").showup()
 
     def on_mi_remove_user_activate(self, _widget):
         """Remove users from groups dialog."""
@@ -595,5 +756,6 @@ if __name__ == '__main__':
     elif len(sys.argv) >= 2:
         usage()
         sys.exit(1)
+    session.connect()
     Gui()
     reactor.run()
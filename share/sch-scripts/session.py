@@ -0,0 +1,121 @@
+# This file is part of sch-scripts, https://launchpad.net/sch-scripts
+# Copyright 2009-2018 the sch-scripts team, see AUTHORS.
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""Run commands as the session user or as root, with their results."""
+
+import json
+import os
+import socket
+import stat
+import sys
+from twisted.internet import defer, protocol, threads
+from twisted.protocols import basic
+import session_helper
+
+# The channel to the session helper, if sch-scripts was started through it
+CLIENT = None
+
+
+class SessionError(Exception):
+    """A command that couldn't be run or that failed."""
+
+
+class SessionClient(basic.Int32StringReceiver):
+    """Send requests to the session helper and fire their Deferreds."""
+    MAX_LENGTH = session_helper.MAX_MESSAGE
+
+    def __init__(self):
+        self.calls = {}
+        self.last_id = 0
+        self.closed = False
+
+    def call(self, cmd):
+        """Run cmd in the session; return a Deferred with its (status, error)."""
+        if self.closed:
+            return defer.fail(SessionError("Η σύνδεση με τη συνεδρία του χρήστη έκλεισε"))
+        self.last_id += 1
+        self.calls[self.last_id] = dfr = defer.Deferred()
+        self.sendString(json.dumps({'id': self.last_id, 'cmd': cmd}).encode('utf-8'))
+        return dfr
+
+    def stringReceived(self, string):
+        try:
+            result = json.loads(string.decode('utf-8'))
+            dfr = self.calls.pop(result['id'])
+        except (ValueError, KeyError, TypeError):
+            sys.stderr.write("Μη έγκυρη απάντηση από τη συνεδρία του χρήστη: %r\n" % string)
+            return
+        dfr.callback((result.get('status'), result.get('error', '')))
+
+    def lengthLimitExceeded(self, length):
+        sys.stderr.write("Μη έγκυρο μήκος απάντησης από τη συνεδρία του χρήστη: %d\n" % length)
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        self.closed = True
+        calls, self.calls = self.calls, {}
+        for dfr in calls.values():
+            dfr.errback(SessionError("Η σύνδεση με τη συνεδρία του χρήστη έκλεισε"))
+
+
+class SessionFactory(protocol.Factory):
+    """Return the one SessionClient of the adopted socket."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def buildProtocol(self, addr):
+        return self.client
+
+
+def connect(fd=0):
+    """Use fd, normally stdin, as the channel to the session helper.
+
+    Return False if fd isn't a socket, i.e. if sch-scripts wasn't started
+    through the helper. Call it after the reactor is installed.
+    """
+    global CLIENT
+    from twisted.internet import reactor
+    try:
+        if not stat.S_ISSOCK(os.fstat(fd).st_mode):
+            return False
+    except OSError:
+        return False
+    CLIENT = SessionClient()
+    reactor.adoptStreamConnection(fd, socket.AF_UNIX, SessionFactory(CLIENT))
+    # Keep the subprocesses from inheriting the socket, so that the helper
+    # sees it closed when the GUI exits
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, fd)
+    os.close(devnull)
+    return True
+
+
+def check(result, cmd):
+    """Return the status of a (status, error) result, raise SessionError on failure."""
+    status, error = result
+    if status:
+        raise SessionError("%s: %s" % (' '.join(str(arg) for arg in cmd),
+                                       error or "κωδικός εξόδου %d" % status))
+    return status
+
+
+def run_as_user(cmd):
+    """Run cmd as the user that started sch-scripts.
+
+    Return a Deferred that fires with the exit status, or None if it was
+    still running after a few seconds, or fails with SessionError.
+    """
+    if CLIENT is None:
+        return defer.fail(SessionError(
+            "Το sch-scripts δεν εκτελέστηκε μέσω του /usr/sbin/sch-scripts"))
+    dfr = CLIENT.call(cmd)
+    dfr.addCallback(check, cmd)
+    return dfr
+
+
+def run_as_root(cmd):
+    """Like run_as_user, but run cmd as root, in a thread."""
+    dfr = threads.deferToThread(session_helper.run, cmd)
+    dfr.addCallback(check, cmd)
+    return dfr
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# This file is part of sch-scripts, https://launchpad.net/sch-scripts
+# Copyright 2009-2018 the sch-scripts team, see AUTHORS.
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""Run commands in the user session, on behalf of the root GUI.
+
+The sch-scripts wrapper runs this helper as the user, and it starts the GUI
+through pkexec with one end of a socketpair as its stdin. The GUI sends
+requests over it and gets their results back, see session.py. Each message
+is a 4 byte big endian length followed by a JSON object:
+    request: {"id": 1, "cmd": ["xdg-open", "http://..."]}
+    result:  {"id": 1, "status": 0, "error": ""}
+status is null if the command was still running after RESULT_TIMEOUT.
+"""
+
+import concurrent.futures
+import json
+import os
+import pwd
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+
+HEADER = struct.Struct('!I')
+MAX_MESSAGE = 1024 * 1024
+# How many commands run at the same time; the rest wait for a worker
+WORKERS = 4
+# Seconds to wait for a command to exit before reporting that it started
+RESULT_TIMEOUT = 5
+# How much of the stderr of a failed command is reported
+MAX_ERROR = 4096
+# The commands that were still running after RESULT_TIMEOUT, to be reaped
+RUNNING = []
+RUNNING_LOCK = threading.Lock()
+
+
+def run(cmd, timeout=RESULT_TIMEOUT):
+    """Run cmd and return its (exit status, stderr).
+
+    The status is None if the command was still running after timeout, e.g.
+    when xdg-open started a browser without forking, and 127 if it couldn't
+    be executed. The command gets its own session, so that it survives
+    a Ctrl+C to sch-scripts.
+    """
+    reap()
+    try:
+        with tempfile.TemporaryFile() as errors:
+            proc = subprocess.Popen([str(arg) for arg in cmd], stdin=subprocess.DEVNULL,
+                                    stderr=errors, start_new_session=True)
+            try:
+                status = proc.wait(timeout)
+            except subprocess.TimeoutExpired:
+                with RUNNING_LOCK:
+                    RUNNING.append(proc)
+                return None, ''
+            errors.seek(0)
+            return status, errors.read(MAX_ERROR).decode('utf-8', 'replace').strip()
+    except (OSError, ValueError) as exc:
+        return 127, str(exc)
+
+
+def reap():
+    """Wait for the commands of RUNNING that exited, so they aren't zombies."""
+    with RUNNING_LOCK:
+        RUNNING[:] = [proc for proc in RUNNING if proc.poll() is None]
+
+
+def valid_request(request):
+    """Return True if request is a dict with an int id and a non empty cmd list."""
+    return isinstance(request, dict) and isinstance(request.get('id'), int) \
+        and isinstance(request.get('cmd'), list) and len(request['cmd']) > 0
+
+
+def pack(message):
+    """Return message as bytes, with its length prefix."""
+    data = json.dumps(message).encode('utf-8')
+    return HEADER.pack(len(data)) + data
+
+
+def read_messages(sock):
+    """Yield the messages of sock until it's closed."""
+    buf = b''
+    while True:
+        try:
+            data = sock.recv(65536)
+        except OSError:
+            return
+        if not data:
+            return
+        buf += data
+        while len(buf) >= HEADER.size:
+            length, = HEADER.unpack_from(buf)
+            if length > MAX_MESSAGE:
+                sys.stderr.write("Μη έγκυρο μήκος μηνύματος: %d\n" % length)
+                return
+            if len(buf) < HEADER.size + length:
+                break
+            data, buf = buf[HEADER.size:HEADER.size+length], buf[HEADER.size+length:]
+            yield json.loads(data.decode('utf-8'))
+
+
+class Helper:
+    """Serve the requests of the GUI with a pool of worker threads."""
+
+    def __init__(self, sock, workers=WORKERS):
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.pool = concurrent.futures.ThreadPoolExecutor(workers)
+
+    def serve(self):
+        """Handle the requests until the GUI closes its end."""
+        try:
+            for request in read_messages(self.sock):
+                if valid_request(request):
+                    self.pool.submit(self.handle, request)
+                elif isinstance(request, dict) and isinstance(request.get('id'), int):
+                    # Fail it, so that the Deferred of the GUI fires
+                    self.send({'id': request['id'], 'status': 127,
+                               'error': "Μη έγκυρη αίτηση: %r" % request})
+                else:
+                    sys.stderr.write("Μη έγκυρη αίτηση: %r\n" % (request,))
+        except ValueError as exc:
+            sys.stderr.write("Μη έγκυρο μήνυμα: %s\n" % exc)
+
+    def handle(self, request):
+        status, error = run(request['cmd'])
+        self.send({'id': request['id'], 'status': status, 'error': error})
+
+    def send(self, message):
+        data = pack(message)
+        with self.lock:
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                pass
+
+
+def drop_privileges():
+    """When started as root by sudo, run the commands as the sudo user."""
+    if os.geteuid() != 0 or not os.environ.get('SUDO_UID'):
+        return
+    entry = pwd.getpwuid(int(os.environ['SUDO_UID']))
+    os.initgroups(entry.pw_name, entry.pw_gid)
+    os.setgid(entry.pw_gid)
+    os.setuid(entry.pw_uid)
+    os.environ.update(HOME=entry.pw_dir, USER=entry.pw_name, LOGNAME=entry.pw_name)
+
+
+def usage():
+    """Print usage info about session_helper."""
+    return """Χρήση: session_helper.py <εντολή> [ΠΑΡΑΜΕΤΡΟΙ]
+
+Εκτελεί την εντολή με ένα socket ως standard input, και εκτελεί όσες
+εντολές ζητήσει αυτή μέσω του socket ως ο τρέχων χρήστης.
+"""
+
+
+def main(argv):
+    """Start argv with a socketpair as stdin and serve it; return its status."""
+    if len(argv) < 2 or argv[1] in ('-h', '--help'):
+        sys.stderr.write(usage())
+        return 1
+    ours, theirs = socket.socketpair()
+    try:
+        child = subprocess.Popen(argv[1:], stdin=theirs)
+    except OSError as exc:
+        sys.stderr.write("%s: %s\n" % (argv[1], exc))
+        return 127
+    theirs.close()
+    drop_privileges()
+    threading.Thread(target=Helper(ours).serve, daemon=True).start()
+    while True:
+        try:
+            return child.wait()
+        except KeyboardInterrupt:
+            # The GUI got the SIGINT too; wait for it to exit
+            continue
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
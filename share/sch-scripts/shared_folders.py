@@ -9,6 +9,7 @@ import shlex
 import stat
 import sys
 import subprocess
+import disk_usage
 import libuser
 
 # TODO: after the workshop, let's move the shared_folders ui into its own
@@ -26,6 +27,7 @@ class SharedFolders():
         else:
             self.system = system
         self.load_config()
+        self.system.connect_event(self.on_libuser_changed)
 
     def add(self, groups):
         """Add the specified groups to share_groups, and mount them."""
@@ -131,6 +133,18 @@ class SharedFolders():
             self.mount(dst)
         self.save_config()
 
+    def on_libuser_changed(self, changes):
+        """Remount the shared folders of the groups whose gid changed."""
+        groups = self.valid(list(changes.groups & set(self.system.share_groups)))
+        if not groups:
+            return
+        # The old gid is the one that the folder is mounted with
+        changed = [mount['group'] for mount in self.parse_mounts()
+                   if mount['group'] in groups
+                   and mount['gid'] != self.system.groups[mount['group']].gid]
+        if changed:
+            self.mount(changed)
+
     def parse_mounts(self):
         """Return a list of all bindfs mounts unset /home/Shared."""
         mounts = []
@@ -185,6 +199,17 @@ SHARE_GROUPS="%s"
             subprocess.call(["umount", "-l", point])
         return ret
 
+    def usage(self, groups=None, full=False):
+        """Return {group: bytes} of the shared folders of the specified groups.
+
+        Only the directories that changed since the last query are listed
+        again, unless full is True.
+        """
+        dirs = dict((group, self.config["SHARE_DIR/"] + group)
+                    for group in self.list_shared(groups))
+        totals = disk_usage.DiskUsage().update(dirs.values(), full=full)
+        return dict((group, totals[dir]) for group, dir in dirs.items() if dir in totals)
+
     def valid(self, groups=None):
         """Return which of the specified groups are defined in /etc/group."""
         if groups is None or groups == []:
@@ -202,6 +227,11 @@ def usage():
     add <ομάδες>
         Δημιουργεί φακέλους για τις καθορισμένες ομάδες, εάν δεν υπάρχουν
         ήδη, και τους προσαρτεί με χρήση του bindfs.
+    du [--full] <ομάδες>
+        Εμφανίζει το μέγεθος των κοινόχρηστων φακέλων των καθορισμένων
+        ομάδων, από το μεγαλύτερο στο μικρότερο. Ξαναδιαβάζονται μόνο οι
+        υποφάκελοι που άλλαξαν από την προηγούμενη φορά, εκτός εάν δοθεί
+        το --full.
     list-mounted <ομάδες>
         Εμφανίζει ποιες από τις καθορισμένες ομάδες έχουν προσαρτημένους
         φακέλους.
@@ -240,6 +270,11 @@ if __name__ == '__main__':
             sys.stderr.write(usage() + "\n")
             sys.exit(1)
         SF.add(GROUPS)
+    elif CMD == "du":
+        FULL = GROUPS[:1] == ["--full"]
+        USAGE = SF.usage(GROUPS[1:] if FULL else GROUPS, FULL)
+        for GROUP in sorted(USAGE, key=USAGE.get, reverse=True):
+            print("%s\t%s" % (disk_usage.format_size(USAGE[GROUP]), GROUP))
     elif CMD == "list-mounted":
         print(' '.join(SF.list_mounted(GROUPS)))
     elif CMD == "list-shared":
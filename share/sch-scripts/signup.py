@@ -11,11 +11,16 @@ import re
 import socket
 import sys
 import gi
-from gi.repository import Gtk
+from gi.repository import Gtk, GObject
 
 import iso843
 gi.require_version('Gtk', '3.0')
 
+# Milliseconds to wait for the typing to pause before asking the server
+VALIDATE_DELAY = 300
+# Seconds to wait for the reply to CHECK_USERNAMES; older servers ignore it
+CHECK_TIMEOUT = 5
+
 
 class Connection:
     """Connect to the server.
@@ -35,15 +40,21 @@ class Connection:
         self.p_reg = None
         self.u_reg = None
         self.n_reg = None
+        # Whether the server supports CHECK_USERNAMES, until it times out
+        self.check_many = True
 
     # TODO: Review the recv call, there should be a better way
     # TODO: Show exceptions in a graphical message
-    def _send(self, data):
+    def _send(self, data, timeout=None):
         """Send data to server."""
         if not data.endswith('\r\n'):
             data += '\r\n'
         self.sock.send(data.encode())
-        return self.sock.recv(4096).strip().decode()
+        self.sock.settimeout(timeout)
+        try:
+            return self.sock.recv(4096).strip().decode()
+        finally:
+            self.sock.settimeout(None)
 
     def close(self):
         """Close the server connection."""
@@ -68,6 +79,25 @@ class Connection:
         """Inform if the user exists."""
         return self._send("USER_EXISTS %s" % username) == "YES"
 
+    def check_usernames(self, usernames):
+        """Return the usernames that are invalid or taken, in a single request.
+
+        Servers without CHECK_USERNAMES are asked with USER_EXISTS per name.
+        """
+        if not usernames:
+            return []
+        if self.check_many:
+            try:
+                unavailable = self._send("CHECK_USERNAMES %s" % ','.join(usernames),
+                                         CHECK_TIMEOUT)
+            except socket.timeout:
+                self.check_many = False
+        if not self.check_many:
+            return [name for name in usernames if self.user_exists(name)]
+        if unavailable != '':
+            return unavailable.split(',')
+        return []
+
     def realname_regex(self):
         """Validate the real name."""
         if self.n_reg is None:
@@ -122,6 +152,8 @@ class UserForm(object):
         self.groups_tree = self.builder.get_object('groups_tree')
         self.groups_store = self.builder.get_object('groups_store')
         self.role_combo = self.builder.get_object('role_combo')
+        # The pending server checks, {field: GObject source}
+        self.sources = {}
         self.builder.connect_signals(self)
         # self.groups_store.set_sort_column_id(1, Gtk.SortType.ASCENDING)
         # Workaround the problem with starting with a sensitive button (but an empty model)
@@ -183,14 +215,32 @@ class UserForm(object):
 
         return sug
 
+    def schedule(self, field, func):
+        """Call func when the typing in field pauses, instead of on every keystroke."""
+        if field in self.sources:
+            GObject.source_remove(self.sources.pop(field))
+        self.sources[field] = GObject.timeout_add(VALIDATE_DELAY, self.on_schedule_timeout, field, func)
+        self.set_apply_sensitivity()
+
+    def on_schedule_timeout(self, field, func):
+        del self.sources[field]
+        func()
+        return False
+
     def on_realname_entry_changed(self, _widget):
         """Change the entry of the realname."""
-        name = _widget.get_text()
+        self.schedule('realname', self.check_realname)
+
+    def check_realname(self):
+        """Validate the realname and suggest the available usernames."""
+        name = self.realname.get_text()
         icon = self.get_icon(re.match(self.connection.realname_regex(), name, re.UNICODE))
         self.username_combo.remove_all()
         self.username_entry.set_text('')
         sug = self.get_suggestions(name)
-        sug = [opt for opt in sug if re.match(self.connection.username_regex(), opt, re.UNICODE) and not self.connection.user_exists(opt)]
+        sug = [opt for opt in sug if re.match(self.connection.username_regex(), opt, re.UNICODE)]
+        unavailable = self.connection.check_usernames(sug)
+        sug = [opt for opt in sug if opt not in unavailable]
         if sug:
             self.username_entry.set_text(sug[0])
             for opt in sug:
@@ -219,6 +269,10 @@ class UserForm(object):
 
     def on_username_entry_changed(self, _widget):
         """Change the username entry."""
+        self.schedule('username', self.check_username)
+
+    def check_username(self):
+        """Validate the username."""
         username = self.username_entry.get_text()
         valid_name = re.match(self.connection.username_regex(), username, re.UNICODE)
         free_name = not self.connection.user_exists(username)
@@ -228,7 +282,7 @@ class UserForm(object):
 
     def set_apply_sensitivity(self):
         icon = lambda x: self.builder.get_object(x).get_stock()[0]
-        opt = icon('username_valid') == icon('password_valid') == icon('retype_password_valid') == icon('realname_valid') == Gtk.STOCK_OK
+        opt = not self.sources and icon('username_valid') == icon('password_valid') == icon('retype_password_valid') == icon('realname_valid') == Gtk.STOCK_OK
 
         self.builder.get_object('apply_button').set_sensitive(opt)
 
@@ -279,6 +333,9 @@ class UserForm(object):
 
     def quit(self):
         """Close the dialog and disconnect from the server."""
+        for source in self.sources.values():
+            GObject.source_remove(source)
+        self.sources = {}
         self.dialog.destroy()
         if self.connection:
             self.connection.close()
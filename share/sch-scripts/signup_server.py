@@ -16,6 +16,7 @@ from twisted.protocols.basic import LineReceiver
 import common
 import config
 import dialogs
+import libuser
 import user_form
 gi.require_version('Gtk', '3.0')
 gtk3reactor.install()
@@ -85,6 +86,10 @@ class Registrations(LineReceiver):
             self.transport.loseConnection()
         elif cmd == "USER_EXISTS":
             self.sendLine(self.booltr(data in self.system.users))
+        elif cmd == "CHECK_USERNAMES":
+            names = data.split(',') if data else []
+            unavailable = self.system.validator.check_many('username', names)
+            self.sendLine(','.join(unavailable).encode())
         elif cmd == "REALNAME_REGEX":
             self.sendLine(b'.+')
         elif cmd == "USER_REGEX":
@@ -176,6 +181,7 @@ class UI:
         self.review_tb = self.builder.get_object('review_tb')
         self.selection = self.builder.get_object('treeview-selection')
         self.roles = {i : config.PARSER.get('Roles', i).replace('$$teachers', self.system.teachers) for i in config.PARSER.options('Roles')}
+        self.system.connect_event(self.on_libuser_changed)
         self.window.show()
 
     @classmethod
@@ -216,6 +222,19 @@ class UI:
         if user.password in [None, '']:
             user.password = '!'
 
+    def on_libuser_changed(self, changes):
+        """Reassign the ids of pending requests that are no longer free."""
+        if not changes.users and not changes.groups:
+            return
+        for row in self.requests_list:
+            user = row[0].user
+            if not self.system.uid_is_free(user.uid):
+                user.uid = None
+            if user.primary_group not in self.system.groups \
+                    and not self.system.gid_is_free(user.gid):
+                user.gid = None
+            self.user_autocomplete(user)
+
     def add_request(self, request):
         #object time applicant realname username role groups
         self.requests_list.append([request, self.strtime(request.time),
@@ -421,4 +440,5 @@ class SettingsDialog:
 
 if __name__ == '__main__':
     import libuser
+    libuser.SYSTEM.load()
     SettingsDialog(libuser.SYSTEM)
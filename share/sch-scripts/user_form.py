@@ -53,6 +53,10 @@ class UserForm(object):
         self.primary_group = None
         self.show_sys_groups = False
         self.active_from_role = []
+        # Indexes so that each keystroke costs constant time
+        self.group_iters = {}
+        self.gid_iters = {}
+        self.free_gid = None
 
         self.groups_filter.set_visible_func(self.groups_visible_func)
         self.groups_sort.set_sort_column_id(1, Gtk.SortType.ASCENDING)
@@ -60,7 +64,9 @@ class UserForm(object):
         # Fill the groups treeview
         # object, name, active, activatable, font weight, actually active, gid
         for group, group_obj in system.groups.items():
-            self.groups_store.append([group_obj, group, False, True, 400, False, group_obj.gid])
+            itr = self.groups_store.append([group_obj, group, False, True, 400, False, group_obj.gid])
+            self.group_iters[group] = itr
+            self.gid_iters.setdefault(group_obj.gid, itr)
 
         # Fill the shells combobox
         for shell in system.get_valid_shells():
@@ -70,6 +76,23 @@ class UserForm(object):
         for role, _groups in self.roles.items():
             self.role_combo.append_text(role)
 
+        self.dialog.connect('destroy', self.on_dialog_destroy)
+
+    def group_row(self, name=None, gid=None):
+        """Return the groups_store row of a group name or gid, or None."""
+        itr = self.group_iters.get(name) if gid is None else self.gid_iters.get(gid)
+        if itr is None:
+            return None
+        return self.groups_store[itr]
+
+    def gid_is_free(self, gid):
+        return self.system.gid_is_valid(gid) and gid not in self.gid_iters
+
+    def get_free_gid(self):
+        if self.free_gid is None:
+            self.free_gid = self.system.get_free_gid()
+        return self.free_gid
+
     def groups_visible_func(self, model, itr, _x):
         """Show the user's group."""
         primary_group = not model[itr][3] or self.username.get_text() in model[itr][0].members
@@ -94,30 +117,22 @@ class UserForm(object):
         self.active_from_role = []
 
         if role is not None:
-            groups = self.roles[role].split(',')
-            for row in self.groups_store:
-                if row[0].name in groups:
+            for name in self.roles[role].split(','):
+                row = self.group_row(name)
+                if row is not None:
                     row[2] = True
                     self.active_from_role.append(row)
 
 
     def on_uid_changed(self, _widget):
-        """Modify the user's id."""
-        uid = _widget.get_text()
-        uid_valid_icon = self.builder.get_object('uid_valid')
-        try:
-            uid = int(uid)
-        except:
-            uid_valid_icon.set_from_stock(Gtk.STOCK_CANCEL, Gtk.IconSize.BUTTON)
-            self.set_apply_sensitivity()
-            return
-
-        if (self.mode == 'edit' and uid == self.user.uid) or self.system.uid_is_free(uid):
-            icon = Gtk.STOCK_OK
-        else:
-            icon = Gtk.STOCK_CANCEL
-        uid_valid_icon.set_from_stock(icon, Gtk.IconSize.BUTTON)
+        """Modify the user's id; it's checked when the typing pauses."""
+        own = self.user.uid if self.mode == 'edit' else None
+        self.system.validator.submit(self, 'uid', 'uid', _widget.get_text(),
+                                     self.on_uid_checked, own)
         self.on_homedir_entry_changed(self.homedir)
+
+    def on_uid_checked(self, valid):
+        self.builder.get_object('uid_valid').set_from_stock(self.get_icon(valid), Gtk.IconSize.BUTTON)
         self.set_apply_sensitivity()
 
     def on_group_toggled(self, _widget, path):
@@ -215,22 +230,31 @@ class UserForm(object):
         self.set_apply_sensitivity()
 
     def on_username_entry_changed(self, _widget):
-        """Change the username entry."""
+        """Change the username entry; it's checked when the typing pauses."""
         username = self.username.get_text()
-        valid_name = self.system.name_is_valid(username)
-        free_name = username not in self.system.users
+        own = None
         if self.mode == 'edit':
-            free_name = free_name or username == self.user.name
+            own = self.user.name
         else:
             self.pgroup.set_text(username)
         self.homedir.set_text(os.path.join(libuser.HOME_PREFIX, username))
-        icon = self.get_icon(valid_name and free_name)
-        self.builder.get_object('username_valid').set_from_stock(icon, Gtk.IconSize.BUTTON)
+        self.system.validator.submit(self, 'username', 'username', username,
+                                     self.on_username_checked, own)
+        self.set_apply_sensitivity()
+
+    def on_username_checked(self, valid):
+        self.builder.get_object('username_valid').set_from_stock(self.get_icon(valid), Gtk.IconSize.BUTTON)
         self.set_apply_sensitivity()
 
     def on_homedir_entry_changed(self, _widget):
-        """Change the homedir entry."""
-        home = _widget.get_text()
+        """Change the homedir entry; it's checked when the typing pauses."""
+        self.system.validator.submit(self, 'homedir', 'home', self.homedir.get_text(),
+                                     self.on_homedir_checked)
+        self.set_apply_sensitivity()
+
+    def on_homedir_checked(self, home_stat):
+        """Check that the homedir isn't owned by someone else."""
+        home = self.homedir.get_text()
         try:
             gid = int(self.pgid.get_text())
         except:
@@ -242,9 +266,8 @@ class UserForm(object):
         valid_icon = self.builder.get_object('homedir_valid')
         valid_icon.set_tooltip_text("")
         valid_icon.set_from_stock(Gtk.STOCK_OK, Gtk.IconSize.BUTTON)
-        if os.path.isdir(home):
-            path_uid = os.stat(home).st_uid
-            path_gid = os.stat(home).st_gid
+        if home_stat is not None:
+            path_uid, path_gid = home_stat
             if path_uid != uid or path_gid != gid:
                 if self.mode == 'new' or self.user.directory != home:
                     valid_icon.set_from_stock(Gtk.STOCK_CANCEL, Gtk.IconSize.BUTTON)
@@ -263,12 +286,11 @@ class UserForm(object):
         icon = self.get_icon(self.system.name_is_valid(pgname))
         self.builder.get_object('pgroup_valid').set_from_stock(icon, Gtk.IconSize.BUTTON)
         if exists:
-            for row in self.groups_store:
-                if row[0].name == pgname:
-                    # Mark the group as primary in the tree
-                    self.set_group_primary(row)
-                    self.pgid.set_text(str(row[0].gid))
-                    break
+            row = self.group_row(pgname)
+            if row is not None:
+                # Mark the group as primary in the tree
+                self.set_group_primary(row)
+                self.pgid.set_text(str(row[0].gid))
         else:
             self.unset_primary()
             try:
@@ -276,8 +298,8 @@ class UserForm(object):
             except:
                 gid = None
 
-            if gid is not None and not self.system.gid_is_free(gid):
-                self.pgid.set_text(str(self.system.get_free_gid()))
+            if gid is not None and not self.gid_is_free(gid):
+                self.pgid.set_text(str(self.get_free_gid()))
         self.set_apply_sensitivity()
 
     def on_pgid_entry_changed(self, _widget):
@@ -291,16 +313,15 @@ class UserForm(object):
             self.set_apply_sensitivity()
             return
 
-        exists = not self.system.gid_is_free(gid)
+        exists = not self.gid_is_free(gid)
         icon = self.get_icon(self.system.gid_is_valid(gid))
         valid_icon.set_from_stock(icon, Gtk.IconSize.BUTTON)
         if exists:
-            for row in self.groups_store:
-                if row[0].gid == gid:
-                    # Mark the group as primary in the tree
-                    self.set_group_primary(row)
-                    self.pgroup.set_text(row[0].name)
-                    break
+            row = self.group_row(gid=gid)
+            if row is not None:
+                # Mark the group as primary in the tree
+                self.set_group_primary(row)
+                self.pgroup.set_text(row[0].name)
         else:
             self.unset_primary()
             username = self.username.get_text()
@@ -321,7 +342,7 @@ class UserForm(object):
 
     def set_apply_sensitivity(self):
         icon = lambda x: self.builder.get_object(x).get_stock()[0]
-        sen = icon('username_valid') == icon('uid_valid') == icon('password_valid') == icon('password_retype_valid') == icon('full_name_valid') == icon('office_valid') == icon('office_phone_valid') == icon('home_phone_valid') == icon('other_valid') == icon('homedir_valid') == icon('pgid_valid') == icon('pgroup_valid') == Gtk.STOCK_OK
+        sen = not self.system.validator.pending(self) and icon('username_valid') == icon('uid_valid') == icon('password_valid') == icon('password_retype_valid') == icon('full_name_valid') == icon('office_valid') == icon('office_phone_valid') == icon('home_phone_valid') == icon('other_valid') == icon('homedir_valid') == icon('pgid_valid') == icon('pgroup_valid') == Gtk.STOCK_OK
 
         self.builder.get_object('apply_button').set_sensitive(sen)
 
@@ -329,6 +350,9 @@ class UserForm(object):
         """Close the dialog."""
         self.dialog.destroy()
 
+    def on_dialog_destroy(self, _widget):
+        self.system.validator.cancel(self)
+
     def on_cancel_clicked(self, _widget):
         """Cancel the procedure and closes the dialog."""
         self.dialog.destroy()
@@ -489,14 +513,15 @@ class ReviewUserDialog(UserForm):
         self.pgroup.set_text(user.primary_group)
         self.pgid.set_text(str(user.gid))
         # Activate the groups in which the user belongs and mark the primary
-        for row in self.groups_store:
-            for grup in user.groups:
-                if grup == row[0].name:
-                    row[2] = True
-                    row[5] = True
-            if row[1] == user.primary_group:
-                self.primary_group = row
-                self.set_group_primary(row)
+        for grup in user.groups:
+            row = self.group_row(grup)
+            if row is not None:
+                row[2] = True
+                row[5] = True
+        row = self.group_row(user.primary_group)
+        if row is not None:
+            self.primary_group = row
+            self.set_group_primary(row)
 
         if role:
             for rol in self.role_combo.get_model():